@@ -0,0 +1,79 @@
+"""Pack hero lineups
+
+Revision ID: 3b5e0c9a7d21
+Revises: c71c3f058b8c
+Create Date: 2026-10-18 12:20:41.118532
+
+"""
+import json
+import struct
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b5e0c9a7d21'
+down_revision = 'c71c3f058b8c'
+branch_labels = None
+depends_on = None
+
+# Ten little-endian unsigned 16 bit hero IDs, radiant then dire, as
+# `db_util.pack_heroes`
+LINEUP = struct.Struct('<10H')
+BATCH_SIZE = 10000
+
+
+def backfill(columns, convert):
+    """Page through `dota_matches` by match ID, setting the columns named by
+    the keys of the dictionary returned by `convert(row)`."""
+
+    conn = op.get_bind()
+    select = sa.text("SELECT match_id, {} FROM dota_matches WHERE "
+                     "match_id>:last ORDER BY match_id LIMIT :limit".format(
+                         ", ".join(columns)))
+
+    last = -1
+    while True:
+        rows = conn.execute(select, {'last': last,
+                                     'limit': BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+
+        params = []
+        for row in rows:
+            values = convert(row)
+            values['match_id'] = row[0]
+            params.append(values)
+
+        update = sa.text("UPDATE dota_matches SET {} WHERE match_id="
+                         ":match_id".format(", ".join(
+                             "{0}=:{0}".format(t) for t in params[0]
+                             if t != 'match_id')))
+        conn.execute(update, params)
+        last = rows[-1][0]
+
+
+def upgrade():
+    """Replace the `radiant_heroes`/`dire_heroes` JSON strings with a single
+    BINARY(20) `heroes` column."""
+
+    op.add_column('dota_matches', sa.Column('heroes', sa.BINARY(20)))
+    backfill(['radiant_heroes', 'dire_heroes'], lambda row: {
+        'heroes': LINEUP.pack(*(json.loads(row[1]) + json.loads(row[2])))})
+    op.drop_column('dota_matches', 'radiant_heroes')
+    op.drop_column('dota_matches', 'dire_heroes')
+
+
+def downgrade():
+    """Restore the JSON string lineups"""
+
+    op.add_column('dota_matches', sa.Column('radiant_heroes', sa.CHAR(32)))
+    op.add_column('dota_matches', sa.Column('dire_heroes', sa.CHAR(32)))
+
+    def unpack(row):
+        heroes = list(LINEUP.unpack(row[1]))
+        return {'radiant_heroes': str(heroes[:5]),
+                'dire_heroes': str(heroes[5:])}
+
+    backfill(['heroes'], unpack)
+    op.drop_column('dota_matches', 'heroes')
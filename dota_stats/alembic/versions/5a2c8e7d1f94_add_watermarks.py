@@ -0,0 +1,35 @@
+"""Add watermarks
+
+Revision ID: 5a2c8e7d1f94
+Revises: 6e0b93f4c8a2
+Create Date: 2026-10-18 15:12:44.906215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a2c8e7d1f94'
+down_revision = '6e0b93f4c8a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create `dota_watermarks`, starting the `start_time` watermark at the
+    newest match"""
+
+    op.create_table(
+        "dota_watermarks",
+        sa.Column('name', sa.String(32), primary_key=True),
+        sa.Column('value', sa.BigInteger, nullable=False),
+        mysql_engine='MyISAM')
+    op.execute("INSERT INTO dota_watermarks (name, value) SELECT "
+               "'start_time', MAX(start_time) FROM dota_matches HAVING "
+               "MAX(start_time) IS NOT NULL")
+
+
+def downgrade():
+    """Drop `dota_watermarks`"""
+    op.drop_table("dota_watermarks")
@@ -0,0 +1,68 @@
+"""Partition by day
+
+Revision ID: 6e0b93f4c8a2
+Revises: d4a7e2f91b36
+Create Date: 2026-10-18 14:27:09.351774
+
+"""
+import time
+from datetime import datetime
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6e0b93f4c8a2'
+down_revision = 'd4a7e2f91b36'
+branch_labels = None
+depends_on = None
+
+# Table, partitioning column and primary key before partitioning. MySQL
+# requires the partitioning column in every unique key.
+TABLES = [("dota_matches", "start_time", ["match_id"]),
+          ("dota_match_players", "start_time", ["match_id", "hero"]),
+          ("dota_hero_win_rate", "time", ["time_hero_skill"])]
+DAY = 24*60*60
+AHEAD = 7           # Days of partitions past today, as `db_util`
+MAX_DAYS = 365      # Older rows share the first partition
+
+
+def clauses(bounds):
+    """Daily partitions with upper `bounds`, then the catch-all, as
+    `db_util.partition_clauses`"""
+
+    parts = ["PARTITION p{} VALUES LESS THAN ({})".format(
+        datetime.utcfromtimestamp(t - DAY).strftime("%Y%m%d"), t)
+             for t in bounds]
+    parts.append("PARTITION pfuture VALUES LESS THAN MAXVALUE")
+    return ", ".join(parts)
+
+
+def upgrade():
+    """Add the time column to the primary keys and range partition by day,
+    from the oldest row to `AHEAD` days past today."""
+
+    conn = op.get_bind()
+    today = int(time.time()) // DAY * DAY
+
+    for table, column, key in TABLES:
+        first = conn.execute("SELECT MIN({}) FROM {}".format(
+            column, table)).scalar()
+        first = today if first is None else int(first) // DAY * DAY
+        first = max(min(first, today), today - MAX_DAYS*DAY)
+
+        op.execute("ALTER TABLE {0} MODIFY {1} BIGINT NOT NULL, DROP PRIMARY "
+                   "KEY, ADD PRIMARY KEY ({2})".format(
+                       table, column, ", ".join(key + [column])))
+        op.execute("ALTER TABLE {0} PARTITION BY RANGE ({1}) ({2})".format(
+            table, column, clauses(range(first + DAY,
+                                         today + (AHEAD + 1)*DAY + 1, DAY))))
+
+
+def downgrade():
+    """Remove partitioning and restore the primary keys"""
+
+    for table, column, key in TABLES:
+        op.execute("ALTER TABLE {} REMOVE PARTITIONING".format(table))
+        op.execute("ALTER TABLE {0} DROP PRIMARY KEY, ADD PRIMARY KEY ({1}), "
+                   "MODIFY {2} BIGINT NULL".format(table, ", ".join(key),
+                                                  column))
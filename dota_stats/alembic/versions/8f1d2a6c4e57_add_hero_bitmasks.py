@@ -0,0 +1,82 @@
+"""Add hero bitmasks
+
+Revision ID: 8f1d2a6c4e57
+Revises: 3b5e0c9a7d21
+Create Date: 2026-10-18 13:02:17.664120
+
+"""
+import struct
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '8f1d2a6c4e57'
+down_revision = '3b5e0c9a7d21'
+branch_labels = None
+depends_on = None
+
+# Packed lineup and bitmask layout, as `db_util.pack_heroes` and
+# `dotautil.Bitmask`
+LINEUP = struct.Struct('<10H')
+CHUNK_BITS = 64
+NUM_CHUNKS = 3
+MASK_COLUMNS = ["{}_mask_{}".format(team, chunk) for team in
+                ('radiant', 'dire') for chunk in range(NUM_CHUNKS)]
+BATCH_SIZE = 10000
+
+
+def masks(heroes):
+    """Bitmask chunks of `heroes`"""
+
+    chunks = [0] * NUM_CHUNKS
+    for hero in heroes:
+        chunks[hero // CHUNK_BITS] |= 1 << (hero % CHUNK_BITS)
+    return chunks
+
+
+def upgrade():
+    """Add per team hero bitmask columns, filled from the packed lineups, and
+    an index covering the columns hero queries filter on."""
+
+    for column in MASK_COLUMNS:
+        op.add_column('dota_matches', sa.Column(
+            column, mysql.BIGINT(unsigned=True), nullable=False,
+            server_default='0'))
+
+    conn = op.get_bind()
+    select = sa.text("SELECT match_id, heroes FROM dota_matches WHERE "
+                     "match_id>:last ORDER BY match_id LIMIT :limit")
+    update = sa.text("UPDATE dota_matches SET {} WHERE match_id=:match_id".
+                     format(", ".join("{0}=:{0}".format(t) for t in
+                                      MASK_COLUMNS)))
+
+    last = -1
+    while True:
+        rows = conn.execute(select, {'last': last,
+                                     'limit': BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+
+        params = []
+        for match_id, heroes in rows:
+            heroes = LINEUP.unpack(heroes)
+            values = dict(zip(MASK_COLUMNS, masks(heroes[:5]) +
+                              masks(heroes[5:])))
+            values['match_id'] = match_id
+            params.append(values)
+        conn.execute(update, params)
+        last = rows[-1][0]
+
+    op.create_index('ix_hero_masks', 'dota_matches',
+                    ['api_skill', 'start_time', 'radiant_win'] +
+                    MASK_COLUMNS)
+
+
+def downgrade():
+    """Drop the bitmasks"""
+
+    op.drop_index('ix_hero_masks', 'dota_matches')
+    for column in MASK_COLUMNS:
+        op.drop_column('dota_matches', column)
@@ -0,0 +1,43 @@
+"""Add dirty hours
+
+Revision ID: b83f1d6e2a07
+Revises: 5a2c8e7d1f94
+Create Date: 2026-10-18 15:58:30.417652
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83f1d6e2a07'
+down_revision = '5a2c8e7d1f94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create `dota_dirty_hours`, flagging every hour bucket of the existing
+    matches so the first incremental aggregation covers them, as
+    `db_util.hour_buckets`"""
+
+    op.create_table(
+        "dota_dirty_hours",
+        sa.Column('hour', sa.BigInteger, primary_key=True,
+                  autoincrement=False),
+        sa.Column('skill', sa.Integer, primary_key=True,
+                  autoincrement=False),
+        sa.Column('marked', sa.BigInteger, nullable=False,
+                  server_default=sa.text("0")),
+        mysql_engine='MyISAM')
+    op.execute("INSERT IGNORE INTO dota_dirty_hours (hour, skill) SELECT "
+               "DISTINCT start_time DIV 3600 * 3600 + 3600, api_skill FROM "
+               "dota_matches")
+    op.execute("INSERT IGNORE INTO dota_dirty_hours (hour, skill) SELECT "
+               "DISTINCT start_time, api_skill FROM dota_matches WHERE "
+               "start_time MOD 3600 = 0")
+
+
+def downgrade():
+    """Drop `dota_dirty_hours`"""
+    op.drop_table("dota_dirty_hours")
@@ -0,0 +1,122 @@
+"""Add match players
+
+Revision ID: d4a7e2f91b36
+Revises: 8f1d2a6c4e57
+Create Date: 2026-10-18 13:41:52.208817
+
+"""
+import json
+import struct
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7e2f91b36'
+down_revision = '8f1d2a6c4e57'
+branch_labels = None
+depends_on = None
+
+# Packed lineup, as `db_util.pack_heroes`
+LINEUP = struct.Struct('<10H')
+
+# The JSON `items` lists hold the active item slots then the backpack, as
+# returned by the API at the time. Current responses have the neutral item
+# as seventh active slot and three backpack slots, older matches have long
+# been purged.
+JSON_SLOTS = ('item_0', 'item_1', 'item_2', 'item_3', 'item_4', 'item_5',
+              'item_neutral', 'backpack_0', 'backpack_1', 'backpack_2')
+ITEM_SLOTS = JSON_SLOTS + ('backpack_3',)
+COLUMNS = ('match_id', 'hero', 'start_time', 'radiant', 'player_slot',
+           'gold_spent') + ITEM_SLOTS
+BATCH_SIZE = 5000
+
+
+def batches(conn, columns):
+    """Rows of `dota_matches` in match ID order, `BATCH_SIZE` at a time"""
+
+    select = sa.text("SELECT {} FROM dota_matches WHERE match_id>:last "
+                     "ORDER BY match_id LIMIT :limit".format(
+                         ", ".join(['match_id'] + columns)))
+    last = -1
+    while True:
+        rows = conn.execute(select, {'last': last,
+                                     'limit': BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+        yield rows
+        last = rows[-1][0]
+
+
+def upgrade():
+    """Create `dota_match_players` from the `items` and `gold_spent` JSON
+    columns, which are then dropped."""
+
+    unsigned = mysql.SMALLINT(unsigned=True)
+    op.create_table(
+        "dota_match_players",
+        sa.Column('match_id', sa.BigInteger, primary_key=True),
+        sa.Column('hero', unsigned, primary_key=True, autoincrement=False),
+        sa.Column('start_time', sa.BigInteger),
+        sa.Column('radiant', mysql.TINYINT),
+        sa.Column('player_slot', mysql.TINYINT(unsigned=True)),
+        sa.Column('gold_spent', sa.Integer),
+        *[sa.Column(t, unsigned) for t in ITEM_SLOTS],
+        mysql_engine='MyISAM')
+    op.create_index('ix_players_hero_time', 'dota_match_players',
+                    ['hero', 'start_time', 'gold_spent'])
+    op.create_index('ix_players_start_time', 'dota_match_players',
+                    ['start_time'])
+
+    conn = op.get_bind()
+    insert = sa.text("INSERT INTO dota_match_players ({}) VALUES ({})".format(
+        ", ".join(COLUMNS), ", ".join(":" + t for t in COLUMNS)))
+
+    for rows in batches(conn, ['start_time', 'heroes', 'items',
+                               'gold_spent']):
+        params = []
+        for match_id, start_time, heroes, items, gold_spent in rows:
+            items = json.loads(items)
+            gold_spent = json.loads(gold_spent)
+            for i, hero in enumerate(LINEUP.unpack(heroes)):
+                row = dict.fromkeys(COLUMNS)
+                row.update(zip(JSON_SLOTS, items[str(hero)]))
+                row.update(match_id=match_id, hero=hero,
+                           start_time=start_time, radiant=int(i < 5),
+                           gold_spent=gold_spent[str(hero)])
+                params.append(row)
+        conn.execute(insert, params)
+
+    op.drop_column('dota_matches', 'items')
+    op.drop_column('dota_matches', 'gold_spent')
+
+
+def downgrade():
+    """Rebuild the JSON columns and drop `dota_match_players`"""
+
+    op.add_column('dota_matches', sa.Column('items', sa.VARCHAR(1024)))
+    op.add_column('dota_matches', sa.Column('gold_spent', sa.VARCHAR(1024)))
+
+    conn = op.get_bind()
+    select = sa.text("SELECT match_id, hero, gold_spent, {} FROM "
+                     "dota_match_players WHERE match_id>=:first AND "
+                     "match_id<=:last".format(", ".join(ITEM_SLOTS)))
+    update = sa.text("UPDATE dota_matches SET items=:items, gold_spent="
+                     ":gold_spent WHERE match_id=:match_id")
+
+    for rows in batches(conn, []):
+        players = conn.execute(select, {'first': rows[0][0],
+                                        'last': rows[-1][0]}).fetchall()
+        matches = {}
+        for player in players:
+            items, gold_spent = matches.setdefault(player[0], ({}, {}))
+            items[player[1]] = [t for t in player[3:] if t is not None]
+            gold_spent[player[1]] = player[2]
+
+        if matches:
+            conn.execute(update, [
+                {'match_id': k, 'items': json.dumps(v[0]),
+                 'gold_spent': json.dumps(v[1])} for k, v in matches.items()])
+
+    op.drop_table("dota_match_players")
@@ -5,13 +5,13 @@ import sys
 import datetime as dt
 import argparse
 import os
-import json
 import pandas as pd
 import mariadb
 import numpy as np
 
 sys.path.append("..")
 from dotautil import MLEncoding # pylint: disable=import-error, wrong-import-position
+from db_util import decode_heroes # pylint: disable=import-error, wrong-import-position
 
 def main():
     """Main entry point"""
@@ -45,7 +45,7 @@ def main():
         database=os.environ['DOTA_DATABASE'])
     cursor=conn.cursor()
 
-    stmt="SELECT start_time, match_id, radiant_heroes, dire_heroes, "
+    stmt="SELECT start_time, match_id, heroes, "
     stmt+="radiant_win FROM dota_matches WHERE start_time>={0} and "
     stmt+="start_time<{1} and api_skill={2}"
     stmt=stmt.format(
@@ -69,8 +69,9 @@ def main():
     radiant_win=np.array([t[-1] for t in rows])
 
     # First order effects
-    rad_heroes = [json.loads(t[2]) for t in rows]
-    dire_heroes = [json.loads(t[3]) for t in rows]
+    heroes = decode_heroes([t[2] for t in rows])
+    rad_heroes = heroes[:, :5].tolist()
+    dire_heroes = heroes[:, 5:].tolist()
 
     y_data, x1_data, x2_data, x3_data = MLEncoding.create_features(\
         rad_heroes, dire_heroes, radiant_win)
@@ -29,23 +29,9 @@ BASE_URL="https://www.dotabuff.com"
 #------------------------------------------------------------------------------
 # Step #1: Prior based on gold spent in recent matches
 #------------------------------------------------------------------------------
-def sort_heroes_gold(heroes_json, gold_json):
-    """Sort heroes by gold spent. Inputs are hero list in JSON, a gold/hero
-    dictionary. Returns a list of heroes. Nominal probability set to 1%.
-    """
-
-    heroes = json.loads(heroes_json)
-    gold_dict = json.loads(gold_json)
-
-    gold = []
-    for this_hero in heroes:
-        gold.append(gold_dict[str(this_hero)])
-
-    return [b for _, b in sorted(zip(gold,heroes), reverse=True)]
-
 def prior_from_matches(limit):
     """Based on <limit> matches return a farm position probability based on
-    gold spent.
+    gold spent. Positions are ranked within each team in the database.
     """
 
     # Database fetch
@@ -56,24 +42,18 @@ def prior_from_matches(limit):
         database=os.environ['DOTA_DATABASE'])
     cursor=conn.cursor()
 
-    stmt= "SELECT match_id, radiant_heroes, dire_heroes, gold_spent FROM "
-    stmt+="dota_matches LIMIT {}".format(limit)
-    cursor.execute(stmt)
+    stmt= "SELECT hero, position, COUNT(*) FROM (SELECT p.hero, ROW_NUMBER() "
+    stmt+="OVER (PARTITION BY p.match_id, p.radiant ORDER BY p.gold_spent "
+    stmt+="DESC, p.hero DESC) AS position FROM dota_match_players p JOIN "
+    stmt+="(SELECT match_id FROM dota_matches LIMIT {}) m ON "
+    stmt+="p.match_id=m.match_id) ranked GROUP BY hero, position"
+    cursor.execute(stmt.format(limit))
     rows=cursor.fetchall()
 
-    # Process each row
+    # Hero by position counts
     position_array = np.zeros([meta.NUM_HEROES, 5])
-    positions = range(5)
-    for row in rows:
-        radiant = sort_heroes_gold(row[1], row[3])
-        for rhero, pos in zip(radiant, positions):
-            i_hero = meta.HEROES.index(rhero)
-            position_array[i_hero, pos]+=1
-
-        dire = sort_heroes_gold(row[2], row[3])
-        for dhero, pos in zip(dire, positions):
-            i_hero = meta.HEROES.index(dhero)
-            position_array[i_hero, pos] += 1
+    for hero, position, count in rows:
+        position_array[meta.HEROES.index(hero), position-1] = count
 
     # Create dataframe and normalize...
     df_prior_spent = pd.DataFrame(position_array)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Stand-in for the `IDOTA2Match_570` Steam API endpoints used by `fetch.py`.
+
+Serves synthetic `GetMatchHistory` pages and `GetMatchDetails` payloads for
+a fixed pool of matches, with configurable latency, throttling (429/503)
+rates and data volume. Matches are generated deterministically from their
+match ID, so history and detail responses agree with each other and between
+runs.
+
+    python -m dota_stats.benchmarks.fake_steam --port 8000 --matches 20000
+    DOTA_API_URL=http://127.0.0.1:8000 ./fetch.sh all 1
+
+`FakeSteam.start` runs the server on a background thread, this is what the
+throughput benchmark (`fetch_throughput.py`) uses.
+"""
+import time
+import random
+import asyncio
+import argparse
+import threading
+from collections import Counter
+import numpy as np
+from aiohttp import web
+from dota_stats import meta
+
+TOP_MATCH_ID = 5000000000
+SLOTS = [0, 1, 2, 3, 4, 128, 129, 130, 131, 132]
+ITEM_IDS = sorted({t['id'] for t in meta.ITEMS.values()})
+
+
+class FakeSteam:
+    """Synthetic match pool and the aiohttp application serving it.
+
+        matches:    number of matches in the pool
+        latency:    mean seconds per response (uniform +/- 50%)
+        error_429:  probability a request is answered 429 Too Many Requests
+        error_503:  probability a request is answered 503 Unavailable
+        reject:     share of matches with a lobby type `fetch.py` discards
+        span:       seconds between the oldest and newest match
+        page_size:  matches per `GetMatchHistory` page
+        abilities:  ability upgrades per player, pads details to a realistic
+                    payload size
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, matches=20000, latency=0.0, error_429=0.0,
+                 error_503=0.0, reject=0.2, span=24*3600, page_size=100,
+                 abilities=20, seed=0):
+        self.latency = latency
+        self.error_429 = error_429
+        self.error_503 = error_503
+        self.reject = reject
+        self.page_size = page_size
+        self.abilities = abilities
+        self.seed = seed
+        self.stats = Counter()
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+        # Newest match first, as the API pages
+        self.match_ids = TOP_MATCH_ID - np.arange(matches, dtype=np.int64)
+        self.start_times = int(time.time()) - np.linspace(
+            0, span, matches).astype(np.int64)
+
+        heroes = list(meta.HERO_DICT.keys())
+        self.lineups = np.array([self._rng(t).sample(heroes, 10) for t in
+                                 self.match_ids.tolist()], dtype=np.int64)
+        self.by_hero = {hero: self.match_ids[(self.lineups == hero).any(
+            axis=1)] for hero in heroes}
+
+    def _rng(self, match_id):
+        return random.Random(match_id * 1000003 + self.seed)
+
+    def _index(self, match_id):
+        idx = TOP_MATCH_ID - match_id
+        if 0 <= idx < len(self.match_ids):
+            return idx
+        return None
+
+    def lobby_type(self, match_id):
+        """Lobby type of a match, `reject` of them are bot matches."""
+        return 4 if self._rng(match_id).random() < self.reject else 7
+
+    def history(self, hero, start_at_match_id):
+        """`GetMatchHistory` result for `hero` (0 = all)."""
+
+        ids = self.by_hero.get(hero, self.match_ids)
+        first = int(np.searchsorted(-ids, -start_at_match_id))
+        page = ids[first:first + self.page_size].tolist()
+
+        matches = []
+        for match_id in page:
+            lineup = self.lineups[self._index(match_id)].tolist()
+            matches.append({
+                'match_id': match_id,
+                'match_seq_num': match_id,
+                'start_time': int(self.start_times[self._index(match_id)]),
+                'lobby_type': self.lobby_type(match_id),
+                'radiant_team_id': 0,
+                'dire_team_id': 0,
+                'players': [{'account_id': 4294967295, 'player_slot': slot,
+                             'hero_id': hero_id}
+                            for slot, hero_id in zip(SLOTS, lineup)],
+            })
+
+        return {'status': 1, 'num_results': len(matches),
+                'total_results': len(ids),
+                'results_remaining': max(0, len(ids) - first - len(page)),
+                'matches': matches}
+
+    def details(self, match_id):
+        """`GetMatchDetails` result."""
+
+        idx = self._index(match_id)
+        if idx is None:
+            return {'error': 'Match ID not found'}
+
+        rng = self._rng(match_id)
+        players = []
+        for slot, hero_id in zip(SLOTS, self.lineups[idx].tolist()):
+            player = {'account_id': rng.randint(1, 2**31),
+                      'player_slot': slot, 'hero_id': hero_id}
+            for i in range(6):
+                player['item_{}'.format(i)] = rng.choice(ITEM_IDS)
+            for i in range(3):
+                player['backpack_{}'.format(i)] = rng.choice([0] + ITEM_IDS)
+            player['item_neutral'] = rng.choice([0] + ITEM_IDS)
+            player.update({
+                'kills': rng.randint(0, 20), 'deaths': rng.randint(0, 15),
+                'assists': rng.randint(0, 30),
+                'leaver_status': 0 if rng.random() < 0.98 else 2,
+                'last_hits': rng.randint(0, 500),
+                'denies': rng.randint(0, 30),
+                'gold_per_min': rng.randint(200, 800),
+                'xp_per_min': rng.randint(200, 900),
+                'level': rng.randint(10, 30),
+                'hero_damage': rng.randint(0, 50000),
+                'tower_damage': rng.randint(0, 10000),
+                'hero_healing': rng.randint(0, 5000),
+                'gold': rng.randint(0, 5000),
+                'gold_spent': rng.randint(5000, 40000),
+                'scaled_hero_damage': rng.randint(0, 50000),
+                'scaled_tower_damage': rng.randint(0, 10000),
+                'scaled_hero_healing': rng.randint(0, 5000),
+                'ability_upgrades': [
+                    {'ability': rng.randint(5000, 9000), 'time': 60*i,
+                     'level': i + 1} for i in range(self.abilities)],
+            })
+            players.append(player)
+
+        return {
+            'players': players,
+            'radiant_win': rng.random() < 0.5,
+            'duration': rng.randint(900, 3600),
+            'pre_game_duration': 90,
+            'start_time': int(self.start_times[idx]),
+            'match_id': match_id,
+            'match_seq_num': match_id,
+            'tower_status_radiant': 0,
+            'tower_status_dire': 0,
+            'barracks_status_radiant': 0,
+            'barracks_status_dire': 0,
+            'cluster': 123,
+            'first_blood_time': 60,
+            'lobby_type': self.lobby_type(match_id),
+            'human_players': 10,
+            'leagueid': 0,
+            'positive_votes': 0,
+            'negative_votes': 0,
+            'game_mode': 22,
+            'flags': 1,
+            'engine': 1,
+            'radiant_score': rng.randint(10, 60),
+            'dire_score': rng.randint(10, 60),
+        }
+
+    async def _respond(self, endpoint, result):
+        """Common latency and error handling."""
+
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        draw = random.random()
+        if draw < self.error_429:
+            self.stats[(endpoint, 429)] += 1
+            return web.Response(status=429)
+        if draw < self.error_429 + self.error_503:
+            self.stats[(endpoint, 503)] += 1
+            return web.Response(status=503)
+
+        self.stats[(endpoint, 200)] += 1
+        return web.json_response({'result': result()})
+
+    async def _history(self, request):
+        query = request.query
+        return await self._respond('history', lambda: self.history(
+            int(query.get('hero_id', 0)),
+            int(query.get('start_at_match_id', TOP_MATCH_ID))))
+
+    async def _details(self, request):
+        return await self._respond('details', lambda: self.details(
+            int(request.query['match_id'])))
+
+    def app(self):
+        """The aiohttp application."""
+
+        app = web.Application()
+        app.router.add_get('/IDOTA2Match_570/GetMatchHistory/V001/',
+                           self._history)
+        app.router.add_get('/IDOTA2Match_570/GetMatchDetails/V001/',
+                           self._details)
+        return app
+
+    def start(self, host='127.0.0.1', port=8000):
+        """Serve on a background thread, returns the base URL."""
+
+        ready = threading.Event()
+
+        async def serve():
+            self._runner = web.AppRunner(self.app(), access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, host, port).start()
+            ready.set()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="fake-steam",
+                                        daemon=True)
+        self._thread.start()
+        ready.wait()
+        return "http://{}:{}".format(host, port)
+
+    def stop(self):
+        """Stop a server started with `start`."""
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def add_arguments(parser):
+    """Server options, shared with the throughput benchmark."""
+
+    parser.add_argument('--matches', type=int, default=20000,
+                        help='Matches in the synthetic pool')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Mean response latency in seconds')
+    parser.add_argument('--error-429', type=float, default=0.01,
+                        help='Share of requests answered 429')
+    parser.add_argument('--error-503', type=float, default=0.01,
+                        help='Share of requests answered 503')
+    parser.add_argument('--reject', type=float, default=0.2,
+                        help='Share of matches with a discarded lobby type')
+
+
+def from_arguments(opts):
+    """FakeSteam configured from parsed `add_arguments` options."""
+
+    return FakeSteam(matches=opts.matches, latency=opts.latency,
+                     error_429=opts.error_429, error_503=opts.error_503,
+                     reject=opts.reject)
+
+
+def main():
+    """Run the fake API until interrupted."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_arguments(parser)
+    opts = parser.parse_args()
+
+    fake = from_arguments(opts)
+    print("Serving {} matches on http://{}:{}".format(
+        len(fake.match_ids), opts.host, opts.port))
+    web.run_app(fake.app(), host=opts.host, port=opts.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""End-to-end throughput of the fetch pipeline against the fake Steam API
+(`fake_steam.py`), for the thread engine, the async engine and batched
+database writes.
+
+    python -m dota_stats.benchmarks.fetch_throughput --heroes 5
+
+Each configuration runs in a fresh (forked) process which crawls the same
+heroes into the database configured by `DOTA_DB_URI` and reports:
+
+    matches/min     matches written per minute of wall clock
+    p50/p99 ms      API request latency as seen by `fetch_url`, estimated
+                    from the `dota_fetch_api_latency_seconds` histogram
+                    (slowest endpoint)
+    requests        API requests made, including throttled ones
+    writes/s        rows per second of time spent in `write_matches`
+"""
+import os
+import time
+import asyncio
+import argparse
+import multiprocessing
+from requests.adapters import HTTPAdapter
+
+os.environ.setdefault('DOTA_THREADS', '16')
+os.environ.setdefault('STEAM_KEY', 'benchmark')
+
+# pylint: disable=wrong-import-position
+from dota_stats import meta, pipeline
+from dota_stats.fetch_async import fetch_heroes_async
+from dota_stats.rate_limit import AdaptiveRateLimiter
+from dota_stats.benchmarks import fake_steam
+
+ENDPOINTS = ['GetMatchHistory', 'GetMatchDetails']
+
+# Engine and batch size (0 = row by row, None = --batch) per configuration
+CONFIGS = {
+    'threads': ('threads', 0),
+    'async': ('async', 0),
+    'batch': ('threads', None),
+    'async-batch': ('async', None),
+}
+
+
+def run_config(name, url, units, opts, results):
+    """Crawl `units` with configuration `name`, put stats on `results`."""
+
+    engine, batch_size = CONFIGS[name]
+    if batch_size is None:
+        batch_size = opts.batch
+
+    pipeline.API_URL = url
+    pipeline.NUM_THREADS = opts.threads
+    pipeline.HTTP.mount('http://', HTTPAdapter(pool_maxsize=opts.threads))
+    pipeline.LIMITER = AdaptiveRateLimiter(rate=opts.rate, max_rate=opts.rate)
+    pipeline.log.setLevel(opts.log_level)
+
+    writer = pipeline.MatchWriter(batch_size=batch_size)
+    writer.start()
+    start = time.time()
+    try:
+        if engine == 'async':
+            asyncio.run(fetch_heroes_async(writer, units, opts.concurrency))
+        else:
+            pipeline.fetch_heroes(writer, units)
+    finally:
+        writer.close()
+    elapsed = time.time() - start
+
+    latency = pipeline.API_LATENCY
+    results.put({
+        'config': name,
+        'matches': writer.written,
+        'seconds': elapsed,
+        'per_min': 60 * writer.written / elapsed,
+        'p50': 1000 * max(latency.quantile(0.5, endpoint=t) for t in
+                          ENDPOINTS),
+        'p99': 1000 * max(latency.quantile(0.99, endpoint=t) for t in
+                          ENDPOINTS),
+        'requests': sum(pipeline.API_REQUESTS.values().values()),
+        'writes': writer.written / max(writer.write_time, 1e-9),
+    })
+
+
+def main():
+    """Start the fake API and run every configuration against it."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--configs', default='threads,async,batch',
+                        help='Comma separated, any of ' + ", ".join(CONFIGS))
+    parser.add_argument('--heroes', type=int, default=5,
+                        help='Number of heroes to crawl')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='Threads, thread engine')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='Requests in flight, async engine')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='Rows per statement, batch configurations')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='Rate limit, requests/second')
+    parser.add_argument('--url', help='Use an already running fake API')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--log-level', default='WARNING')
+    fake_steam.add_arguments(parser)
+    opts = parser.parse_args()
+
+    configs = opts.configs.split(",")
+    for name in configs:
+        if name not in CONFIGS:
+            parser.error("Unknown configuration: {}".format(name))
+
+    fake = None
+    url = opts.url
+    if url is None:
+        fake = fake_steam.from_arguments(opts)
+        url = fake.start(port=opts.port)
+
+    units = [(hero, 1) for hero in list(meta.HERO_DICT.keys())[:opts.heroes]]
+
+    # Fresh process per configuration, the fetch globals (index of seen
+    # matches, limiter, metrics) start from scratch each time.
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    rows = []
+    for name in configs:
+        proc = ctx.Process(target=run_config,
+                           args=(name, url, units, opts, results))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            print("{} failed with exit code {}".format(name, proc.exitcode))
+            continue
+        rows.append(results.get())
+
+    if fake is not None:
+        fake.stop()
+
+    print("{0:12} {1:>8} {2:>8} {3:>11} {4:>8} {5:>8} {6:>9} {7:>10}".format(
+        "config", "matches", "seconds", "matches/min", "p50 ms", "p99 ms",
+        "requests", "writes/s"))
+    for row in rows:
+        print("{config:12} {matches:8d} {seconds:8.1f} {per_min:11.0f} "
+              "{p50:8.1f} {p99:8.1f} {requests:9d} {writes:10.0f}".format(
+                  **row))
+
+
+if __name__ == "__main__":
+    main()
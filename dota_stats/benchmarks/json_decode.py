@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Compare the stdlib and orjson paths for decoding `GetMatchDetails`
+responses, using the match fixtures in `dota_stats/testing`.
+
+    python -m dota_stats.benchmarks.json_decode [--number N]
+
+Each fixture is wrapped as an API response and run through `decode_json`
+and `parse_match` (filtered matches count, the work is the same), timings
+are microseconds per match.
+"""
+import os
+import glob
+import argparse
+import timeit
+from dota_stats import pipeline
+from dota_stats.match_parse import ParseException, parse_match
+
+TESTING = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "testing")
+
+
+def load_responses():
+    """Raw `GetMatchDetails` responses built from the fixtures."""
+
+    responses = {}
+    for path in sorted(glob.glob(os.path.join(TESTING, "*.json"))):
+        with open(path, "rb") as file_handle:
+            responses[os.path.basename(path)] = b'{"result": ' + \
+                file_handle.read() + b'}'
+    return responses
+
+
+def decode(raw):
+    """Decode step of `parse_response`."""
+    return pipeline.decode_json(raw)['result']
+
+
+def decode_parse(raw):
+    """Decode and parse a response as the fetch hot path does."""
+
+    match = decode(raw)
+    match.setdefault('api_skill', 1)
+    try:
+        return parse_match(match)
+    except (ParseException, KeyError, ValueError):
+        return None
+
+
+def run(responses, number):
+    """Time each stage for the current decoder, returns {stage: usec}."""
+
+    results = {}
+    for name, raw in responses.items():
+        results[(name, 'decode')] = timeit.timeit(
+            lambda raw=raw: decode(raw), number=number) / number * 1e6
+        results[(name, 'decode+parse')] = timeit.timeit(
+            lambda raw=raw: decode_parse(raw), number=number) / number * 1e6
+    return results
+
+
+def main():
+    """Run both paths and print a comparison table."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='Iterations per fixture and stage')
+    opts = parser.parse_args()
+
+    if pipeline.orjson is None:
+        parser.error("orjson is not installed, nothing to compare")
+
+    responses = load_responses()
+    fast = run(responses, opts.number)
+
+    orjson, pipeline.orjson = pipeline.orjson, None
+    try:
+        stdlib = run(responses, opts.number)
+    finally:
+        pipeline.orjson = orjson
+
+    print("{0:18} {1:13} {2:>10} {3:>10} {4:>8}".format(
+        "fixture", "stage", "stdlib us", "orjson us", "speedup"))
+    for key in sorted(stdlib):
+        print("{0:18} {1:13} {2:10.1f} {3:10.1f} {4:7.1f}x".format(
+            key[0], key[1], stdlib[key], fast[key], stdlib[key] / fast[key]))
+
+    total_std = sum(v for k, v in stdlib.items() if k[1] == 'decode+parse')
+    total_fast = sum(v for k, v in fast.items() if k[1] == 'decode+parse')
+    print("decode+parse total: {:.1f} us stdlib, {:.1f} us orjson, "
+          "{:.1f}x".format(total_std, total_fast, total_std / total_fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Compare `win_rate_pick_rate.parse_records` with the per match loop it
+replaced, on synthetic matches.
+
+    python -m dota_stats.benchmarks.win_rate [--matches N]
+
+The loop decodes JSON lineups (the `radiant_heroes`/`dire_heroes` columns
+of the time) into six Python lists then groups and merges with pandas.
+`parse_records` decodes packed lineups, maps hero IDs to positions in
+`meta.HEROES` and counts with `np.bincount`. Both are given the rows as a
+database cursor would, and must return the same counts.
+"""
+import json
+import time
+import argparse
+import collections
+import numpy as np
+import pandas as pd
+from dota_stats import db_util, meta, win_rate_pick_rate
+
+LegacyRow = collections.namedtuple(
+    'LegacyRow', ['radiant_win', 'radiant_heroes', 'dire_heroes'])
+Row = collections.namedtuple('Row', ['radiant_win', 'heroes'])
+CHUNK = 100000
+
+
+def legacy_parse_records(matches):
+    """`parse_records` before packed lineups"""
+
+    rad_heroes = []
+    radiant_win = []
+    radiant_count = []
+    dire_heroes = []
+    dire_win = []
+    dire_count = []
+
+    for match in matches:
+        rhs = json.loads(match.radiant_heroes)
+        dhs = json.loads(match.dire_heroes)
+
+        for hero in rhs:
+            rad_heroes.append(hero)
+            radiant_count.append(1)
+            if match.radiant_win == 1:
+                radiant_win.append(1)
+            else:
+                radiant_win.append(0)
+
+        for hero in dhs:
+            dire_heroes.append(hero)
+            dire_count.append(1)
+            if match.radiant_win == 1:
+                dire_win.append(0)
+            else:
+                dire_win.append(1)
+
+    df_radiant = pd.DataFrame({'hero': rad_heroes,
+                               'radiant_win': radiant_win,
+                               'radiant_total': radiant_count})
+    df_radiant = df_radiant.groupby("hero").sum()
+    df_radiant.reset_index(inplace=True)
+
+    df_dire = pd.DataFrame({'hero': dire_heroes,
+                            'dire_win': dire_win,
+                            'dire_total': dire_count})
+    df_dire = df_dire.groupby("hero").sum()
+    df_dire.reset_index(inplace=True)
+
+    df_total = pd.DataFrame({'hero':  meta.HEROES})
+
+    df_total = df_total.merge(df_radiant, how='left', on='hero').\
+        merge(df_dire, how='left', on='hero')
+    df_total = df_total.fillna(0)
+
+    return df_total
+
+
+def synthetic_matches(count, seed):
+    """`count` random lineups of ten distinct heroes, (n, 10) array, and
+    results"""
+
+    rng = np.random.default_rng(seed)
+    heroes = np.array(meta.HEROES)
+    lineups = []
+    for i in range(0, count, CHUNK):
+        size = min(CHUNK, count - i)
+        picks = rng.random((size, meta.NUM_HEROES)).argpartition(
+            db_util.LINEUP_SIZE, axis=1)[:, :db_util.LINEUP_SIZE]
+        lineups.append(heroes[picks])
+    return np.concatenate(lineups), rng.integers(0, 2, count)
+
+
+def timed(func, *args):
+    """Result and seconds of `func(*args)`"""
+
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    """Build the rows and time both implementations."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--matches', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    opts = parser.parse_args()
+
+    lineups, results = synthetic_matches(opts.matches, opts.seed)
+    legacy_rows = [LegacyRow(int(r), json.dumps(h[:5]), json.dumps(h[5:]))
+                   for h, r in zip(lineups.tolist(), results)]
+    rows = [Row(int(r), db_util.pack_heroes(h[:5], h[5:]))
+            for h, r in zip(lineups.tolist(), results)]
+
+    legacy, legacy_time = timed(legacy_parse_records, legacy_rows)
+    current, current_time = timed(win_rate_pick_rate.parse_records, rows)
+    _, count_time = timed(win_rate_pick_rate.count_heroes, lineups,
+                          results == 1)
+
+    pd.testing.assert_frame_equal(legacy, current, check_dtype=False)
+
+    print("{0:>10} matches".format(opts.matches))
+    print("{0:26} {1:>9} {2:>9}".format("", "seconds", "speedup"))
+    for name, seconds in [("legacy loop", legacy_time),
+                          ("parse_records", current_time),
+                          ("count_heroes (no decode)", count_time)]:
+        print("{0:26} {1:9.3f} {2:8.0f}x".format(name, seconds,
+                                                 legacy_time / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Coordinator mode, `fetch.py --workers N`.
+
+The crawl is spread over worker processes. Every (hero, skill) pair is a
+work unit in a queue in the shared crawl state database
+(`crawl_state.WorkQueue`). Workers (`run_worker`) lease units, renew the
+lease after each page and abandon a unit whose lease has passed to another
+worker. The coordinator (`run_coordinator`) reports progress, releases the
+units of a crashed worker and starts a replacement.
+
+Shared state (limiter, index of seen matches, claims, ...) is looked up on
+`pipeline` at call time, workers inherit it from the coordinator on fork.
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import multiprocessing
+from dota_stats import meta, metrics, pipeline
+from dota_stats.db_util import dispose_engines
+from dota_stats.crawl_state import ClaimTable, WorkQueue, CheckpointTable
+from dota_stats.pipeline import LeaseLost, MatchWriter, log, fetch_heroes, \
+    index_path, log_rejections, start_metrics, close_state
+from dota_stats.fetch_async import fetch_heroes_async
+
+LEASE_TIME = 600       # Seconds a work unit lease lasts without renewal
+REPORT_TIME = 30       # Seconds between coordinator progress reports
+
+WORK_UNITS = metrics.REGISTRY.gauge(
+    'dota_fetch_work_units', 'Coordinator work units by state', ('state',))
+
+
+def leased_units(work, owner):
+    """Yield (hero, skill) units leased from the shared work queue, marking
+    each one complete when the next is requested. Completing a unit whose
+    lease was lost does nothing."""
+
+    while True:
+        unit = work.lease(owner, LEASE_TIME)
+        if unit is None:
+            return
+        yield unit
+        work.complete(owner, *unit)
+
+
+def run_worker(owner, index, opts):
+    """Crawler process number `index` in coordinator mode. Leases (hero,
+    skill) units until none remain, renewing the lease and reporting
+    progress every page. Written matches go to a journal of the worker's
+    own, merged into the snapshot by the coordinator."""
+
+    # Connections pooled by the coordinator (`seed_match_ids`) belong to it
+    dispose_engines()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+
+    # Share the API budget between the worker processes
+    pipeline.LIMITER.rate /= opts.workers
+    pipeline.LIMITER.max_rate /= opts.workers
+
+    pipeline.MATCH_IDS.open_journal(index_path(opts), owner)
+    path = os.path.join(opts.cache_dir, "crawl.db")
+    pipeline.CLAIMS.open(path)
+    if not opts.replay:
+        pipeline.CHECKPOINTS.open(path)
+    work = WorkQueue()
+    work.open(path)
+
+    def on_page(hero, skill, pages, matches):
+        if not work.renew(owner, hero, skill, LEASE_TIME, pages, matches):
+            raise LeaseLost()
+
+    textfile = start_metrics(opts, index)
+    writer = MatchWriter()
+    writer.start()
+    try:
+        if opts.engine == 'async':
+            asyncio.run(fetch_heroes_async(writer, leased_units(work, owner),
+                                           opts.concurrency, on_page))
+        else:
+            fetch_heroes(writer, leased_units(work, owner), on_page)
+    finally:
+        writer.close()
+        close_state()
+        work.close()
+        if textfile is not None:
+            textfile.close()
+
+    log_rejections()
+
+
+def reset_crawl_state(path, rescan):
+    """Purge claims past the match horizon and, with `rescan`, drop the
+    history checkpoints, before the workers start."""
+
+    claims = ClaimTable()
+    claims.open(path)
+    claims.purge(int(time.time()) - pipeline.MATCH_HORIZON*24*3600)
+    claims.close()
+
+    if rescan:
+        checkpoints = CheckpointTable()
+        checkpoints.open(path)
+        checkpoints.reset()
+        checkpoints.close()
+
+
+def report_progress(work):
+    """Log and export the state of the work units, returns the number of
+    units by state."""
+
+    states, leased = work.summary()
+    for state in ['pending', 'leased', 'done']:
+        WORK_UNITS.set(states.get(state, 0), state=state)
+    log.info("Work units: %d pending, %d leased, %d done",
+             states.get('pending', 0), states.get('leased', 0),
+             states.get('done', 0))
+    for owner, hero, skill, pages, matches in leased:
+        log.info("  %s hero %-20s skill %d pages %4d matches %6d", owner,
+                 meta.HERO_DICT[hero], skill, pages, matches)
+    return states
+
+
+def start_worker(owner, index, opts):
+    """Fork worker process `owner`, returns it and its number `index`."""
+
+    proc = multiprocessing.Process(target=run_worker,
+                                   args=(owner, index, opts), name=owner)
+    proc.start()
+    return proc, index
+
+
+def run_coordinator(units, opts):
+    """Spread (hero, skill) `units` over `opts.workers` crawler processes.
+    Workers lease units from a queue in the shared crawl state database, a
+    crashed worker's units are released and the worker is replaced."""
+
+    path = os.path.join(opts.cache_dir, "crawl.db")
+    reset_crawl_state(path, opts.rescan)
+
+    work = WorkQueue()
+    work.open(path)
+    work.seed(units)
+
+    workers = {}
+    for i in range(opts.workers):
+        owner = "w{}".format(i)
+        workers[owner] = start_worker(owner, i, opts)
+
+    textfile = start_metrics(opts)
+    restarts = 0
+    while workers:
+        time.sleep(REPORT_TIME)
+        states = report_progress(work)
+
+        for owner, (proc, index) in list(workers.items()):
+            if proc.is_alive():
+                continue
+            del workers[owner]
+            if proc.exitcode == 0:
+                continue
+
+            log.error("Worker %s exited with %d", owner, proc.exitcode)
+            work.release(owner)
+            if states.get('pending', 0) + states.get('leased', 0) > 0 and \
+                    restarts < opts.workers:
+                restarts += 1
+                owner = "{}r{}".format(owner, restarts)
+                workers[owner] = start_worker(owner, index, opts)
+
+    work.close()
+    if textfile is not None:
+        textfile.close()
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""Crawl state shared by all `fetch.py` processes on a machine. State is kept
+in a small SQLite database (WAL mode) in the fetch cache directory, so the
+three skill level jobs and every thread within them see the same state.
+
+    - ClaimTable: match IDs leased for a detail fetch, each match is
+      fetched by one worker at a time across heroes and skill levels.
+    - WorkQueue: (hero, skill) work units leased to crawler processes, a
+      lease which is not renewed expires and the unit is picked up again.
+    - CheckpointTable: per (hero, skill) time of the last completed sweep
+      of the match history and the position of a sweep in progress.
+"""
+import sqlite3
+import threading
+import time
+
+
+def connect(path):
+    """Open the crawl state database, safe to share between threads as long
+    as callers serialize access."""
+
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class ClaimTable:
+    """Claim set for match IDs. A claim is a lease which lasts `duration`
+    seconds unless it is confirmed once the match is written, so a match
+    whose fetch failed, or whose claimant crashed, can be claimed again.
+    Until `open` is called every claim succeeds, so a single process
+    behaves as if it were alone."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self, path):
+        """Attach to the crawl state database at `path`."""
+
+        with self._lock:
+            self._conn = connect(path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS match_claims (match_id INTEGER "
+                "PRIMARY KEY, start_time INTEGER, lease_until REAL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_claims_start_time ON "
+                "match_claims (start_time)")
+
+    def claim(self, match_ids, start_times, duration):
+        """Claim matches for `duration` seconds, returns the IDs this caller
+        now owns. IDs confirmed, or claimed by anyone (including this
+        process) and not yet expired, are left out."""
+
+        if self._conn is None:
+            return list(match_ids)
+
+        now = time.time()
+        claimed = []
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for match_id, start_time in zip(match_ids, start_times):
+                cursor.execute(
+                    "INSERT INTO match_claims VALUES (?, ?, ?) ON CONFLICT "
+                    "(match_id) DO UPDATE SET lease_until=excluded."
+                    "lease_until WHERE lease_until<?",
+                    (match_id, start_time, now + duration, now))
+                if cursor.rowcount == 1:
+                    claimed.append(match_id)
+            cursor.execute("COMMIT")
+        return claimed
+
+    def confirm(self, match_ids):
+        """Make claims permanent, the matches are dealt with."""
+        self._update("UPDATE match_claims SET lease_until=NULL WHERE "
+                     "match_id=?", match_ids)
+
+    def release(self, match_ids):
+        """Give up unconfirmed claims, e.g. after a failed fetch or write."""
+        self._update("DELETE FROM match_claims WHERE match_id=? AND "
+                     "lease_until IS NOT NULL", match_ids)
+
+    def pending(self, match_ids):
+        """Returns the IDs of `match_ids` no process has written yet: claims
+        which are not confirmed, and matches without a claim (released).
+        Without claims nothing is known to be outstanding."""
+
+        if self._conn is None:
+            return []
+        with self._lock:
+            rows = [self._conn.execute(
+                "SELECT lease_until IS NULL FROM match_claims WHERE "
+                "match_id=?", (t,)).fetchone() for t in match_ids]
+        return [t for t, row in zip(match_ids, rows)
+                if row is None or not row[0]]
+
+    def _update(self, stmt, match_ids):
+        """Run `stmt` for each of `match_ids` in one transaction."""
+
+        if self._conn is None or not match_ids:
+            return
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany(stmt, [(t,) for t in match_ids])
+            cursor.execute("COMMIT")
+
+    def purge(self, before):
+        """Forget claims for matches which started before `before`."""
+
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM match_claims WHERE start_time<?",
+                               (before,))
+
+    def close(self):
+        """Close the database connection."""
+
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class WorkQueue:
+    """Leased queue of (hero, skill) work units with per-unit progress."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self, path):
+        """Attach to the crawl state database at `path`."""
+
+        with self._lock:
+            self._conn = connect(path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS work_units (hero INTEGER, skill "
+                "INTEGER, state TEXT, owner TEXT, lease_until REAL, pages "
+                "INTEGER, matches INTEGER, PRIMARY KEY (hero, skill))")
+
+    def seed(self, units):
+        """Start a new sweep over `units`, a list of (hero, skill)."""
+
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DELETE FROM work_units")
+            cursor.executemany(
+                "INSERT INTO work_units VALUES (?, ?, 'pending', NULL, 0, 0, "
+                "0)", units)
+            cursor.execute("COMMIT")
+
+    def lease(self, owner, duration):
+        """Lease the next pending (or expired) unit to `owner` for `duration`
+        seconds. Returns (hero, skill), or None when the sweep is done."""
+
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            row = cursor.execute(
+                "SELECT hero, skill FROM work_units WHERE state='pending' OR "
+                "(state='leased' AND lease_until<?) ORDER BY state DESC, "
+                "skill, hero LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                cursor.execute(
+                    "UPDATE work_units SET state='leased', owner=?, "
+                    "lease_until=? WHERE hero=? AND skill=?",
+                    (owner, now + duration, row[0], row[1]))
+            cursor.execute("COMMIT")
+        return None if row is None else tuple(row)
+
+    def renew(self, owner, hero, skill, duration, pages, matches):
+        """Extend the lease and record progress. Returns False if the lease
+        has been lost to another worker."""
+
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE work_units SET lease_until=?, pages=?, matches=? "
+                "WHERE hero=? AND skill=? AND owner=? AND state='leased'",
+                (time.time() + duration, pages, matches, hero, skill, owner))
+            return cursor.rowcount == 1
+
+    def complete(self, owner, hero, skill):
+        """Mark a unit as done."""
+
+        with self._lock:
+            self._conn.execute(
+                "UPDATE work_units SET state='done' WHERE hero=? AND skill=? "
+                "AND owner=?", (hero, skill, owner))
+
+    def release(self, owner):
+        """Return all units leased by `owner` (e.g. a crashed worker) to the
+        queue."""
+
+        with self._lock:
+            self._conn.execute(
+                "UPDATE work_units SET state='pending', owner=NULL WHERE "
+                "owner=? AND state='leased'", (owner,))
+
+    def summary(self):
+        """Returns count of units by state and the units currently leased
+        as (owner, hero, skill, pages, matches)."""
+
+        with self._lock:
+            states = dict(self._conn.execute(
+                "SELECT state, COUNT(*) FROM work_units GROUP BY state"))
+            leased = self._conn.execute(
+                "SELECT owner, hero, skill, pages, matches FROM work_units "
+                "WHERE state='leased' ORDER BY owner").fetchall()
+        return states, leased
+
+    def close(self):
+        """Close the database connection."""
+
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class CheckpointTable:
+    """Match history checkpoints. A sweep pages backward from the newest
+    match and may stop once it is past the matches which can have finished
+    since `swept`, the time the last completed sweep started. `started` and
+    `cursor` are the start time and `start_at_match_id` of the next page of
+    an unfinished sweep. Until `open` is called there are no checkpoints and
+    every sweep is a full one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self, path):
+        """Attach to the crawl state database at `path`."""
+
+        with self._lock:
+            self._conn = connect(path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (hero INTEGER, skill "
+                "INTEGER, swept REAL, started REAL, cursor INTEGER, updated "
+                "REAL, PRIMARY KEY (hero, skill))")
+
+    def get(self, hero, skill):
+        """Returns (swept, started, cursor), each may be None."""
+
+        if self._conn is None:
+            return None, None, None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT swept, started, cursor FROM checkpoints WHERE hero=? "
+                "AND skill=?", (hero, skill)).fetchone()
+        return (None, None, None) if row is None else tuple(row)
+
+    def advance(self, hero, skill, started, cursor):
+        """Record that everything in the sweep which started at `started`
+        down to (not including) `cursor` has been dealt with."""
+
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO checkpoints VALUES (?, ?, NULL, ?, ?, ?) ON "
+                "CONFLICT (hero, skill) DO UPDATE SET started=excluded."
+                "started, cursor=excluded.cursor, updated=excluded.updated",
+                (hero, skill, started, cursor, time.time()))
+
+    def finish(self, hero, skill, started):
+        """Close the sweep which started at `started`."""
+
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO checkpoints VALUES (?, ?, ?, NULL, NULL, ?) ON "
+                "CONFLICT (hero, skill) DO UPDATE SET swept=MAX("
+                "COALESCE(swept, 0), excluded.swept), started=NULL, "
+                "cursor=NULL, updated=excluded.updated",
+                (hero, skill, started, time.time()))
+
+    def reset(self):
+        """Forget all checkpoints, the next sweeps are full ones."""
+
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints")
+
+    def close(self):
+        """Close the database connection."""
+
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
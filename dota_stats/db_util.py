@@ -3,19 +3,35 @@
 classes and functionality.
 """
 import os
+import time
 import argparse
 import logging
 import sys
+import threading
 from datetime import datetime as dt
-from sqlalchemy import create_engine, Column, CHAR, VARCHAR, BigInteger, \
-    Integer, String
-from sqlalchemy.dialects.mysql import TINYINT
+import numpy as np
+from sqlalchemy import create_engine, func, text, Column, CHAR, BINARY, \
+    BigInteger, Integer, String
+from sqlalchemy.dialects.mysql import BIGINT, SMALLINT, TINYINT, insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
+from dota_stats.dotautil import Bitmask
 
 DB_URI = os.environ['DOTA_DB_URI']
 Base = declarative_base()
 
+# Connection pool of the process wide engines, see `get_engine`. Connections
+# are checked with a ping when taken from the pool and replaced after
+# `POOL_RECYCLE` seconds, before MySQL's `wait_timeout` drops them.
+POOL_SIZE = int(os.environ.get('DOTA_DB_POOL_SIZE', 5))
+POOL_OVERFLOW = int(os.environ.get('DOTA_DB_POOL_OVERFLOW', 10))
+POOL_RECYCLE = int(os.environ.get('DOTA_DB_POOL_RECYCLE', 3600))
+POOL_PRE_PING = int(os.environ.get('DOTA_DB_PRE_PING', 1)) != 0
+
+# Engine and thread local session registry per (URI, process ID)
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
 # Logging
 log = logging.getLogger("purge")
 if int(os.environ['DOTA_LOGGING']) == 0:
@@ -29,6 +45,42 @@ fmt = logging.Formatter(
 ch.setFormatter(fmt)
 log.addHandler(ch)
 
+# Hero lineups are packed into `dota_matches.heroes` as ten little-endian
+# unsigned 16 bit hero IDs, radiant then dire, see `pack_heroes`
+HERO_DTYPE = np.dtype('<u2')
+LINEUP_SIZE = 10
+
+# Tables range partitioned by day on their time column. Each daily partition
+# holds the times before the following midnight UTC, `FUTURE_PARTITION`
+# catches anything past the last one and is kept empty by pre-creating
+# `PARTITION_AHEAD` days of partitions.
+PARTITIONED_TABLES = [("dota_matches", "start_time"),
+                      ("dota_match_players", "start_time"),
+                      ("dota_hero_win_rate", "time")]
+FUTURE_PARTITION = "pfuture"
+PARTITION_AHEAD = 7
+DAY = 24*60*60
+HOUR = 60*60
+
+# Chunked purge of tables which are not partitioned, see `delete_chunked`
+PURGE_CHUNK = 10000
+PURGE_PAUSE = 0.5
+PURGE_MAX_LOCK = 0.5
+
+# Watermarks (`dota_watermarks`) are cached in process for `WATERMARK_TTL`
+# seconds, see `get_watermark`
+WATERMARK_TTL = float(os.environ.get('DOTA_WATERMARK_TTL', 10))
+START_TIME = "start_time"       # Newest `dota_matches.start_time`
+
+# Counters of `dota_hero_win_rate`, see `win_rate_deltas`
+WIN_RATE_COUNTS = ('radiant_win', 'radiant_total', 'dire_win', 'dire_total')
+
+# Item slots of `dota_match_players`, named as in the API response. Older
+# responses have a fourth backpack slot instead of the neutral item.
+ITEM_SLOTS = ('item_0', 'item_1', 'item_2', 'item_3', 'item_4', 'item_5',
+              'item_neutral', 'backpack_0', 'backpack_1', 'backpack_2',
+              'backpack_3')
+
 # ----------------------------------------------------------------------------
 # ORM Classes
 # ----------------------------------------------------------------------------
@@ -40,19 +92,62 @@ class Match(Base):
     __tablename__ = 'dota_matches'
 
     match_id = Column(BigInteger, primary_key=True)
-    start_time = Column(BigInteger)
-    radiant_heroes = Column(CHAR(32))
-    dire_heroes = Column(CHAR(32))
+    start_time = Column(BigInteger, primary_key=True)
+    heroes = Column(BINARY(2*LINEUP_SIZE))
     radiant_win = Column(TINYINT)
     api_skill = Column(Integer)
-    items = Column(VARCHAR(1024))
-    gold_spent = Column(VARCHAR(1024))
+
+    # Hero bitmasks, see `dotautil.Bitmask`
+    radiant_mask_0 = Column(BIGINT(unsigned=True), nullable=False, default=0)
+    radiant_mask_1 = Column(BIGINT(unsigned=True), nullable=False, default=0)
+    radiant_mask_2 = Column(BIGINT(unsigned=True), nullable=False, default=0)
+    dire_mask_0 = Column(BIGINT(unsigned=True), nullable=False, default=0)
+    dire_mask_1 = Column(BIGINT(unsigned=True), nullable=False, default=0)
+    dire_mask_2 = Column(BIGINT(unsigned=True), nullable=False, default=0)
+
+    @property
+    def radiant_heroes(self):
+        """Radiant hero IDs"""
+        return unpack_heroes(self.heroes)[0]
+
+    @property
+    def dire_heroes(self):
+        """Dire hero IDs"""
+        return unpack_heroes(self.heroes)[1]
 
     def __repr__(self):
         return '<Match %r Radiant %r Dire %r>' % (
             self.match_id, self.radiant_heroes, self.dire_heroes)
 
 
+class MatchPlayer(Base):
+    """Player of a match, hero, gold spent and final items. `start_time`
+    and the team are copied from the match so per hero aggregates need no
+    join, `player_slot` is NULL for rows migrated from the JSON columns."""
+    __tablename__ = 'dota_match_players'
+
+    match_id = Column(BigInteger, primary_key=True)
+    hero = Column(SMALLINT(unsigned=True), primary_key=True)
+    start_time = Column(BigInteger, primary_key=True)
+    radiant = Column(TINYINT)
+    player_slot = Column(TINYINT(unsigned=True))
+    gold_spent = Column(Integer)
+    item_0 = Column(SMALLINT(unsigned=True))
+    item_1 = Column(SMALLINT(unsigned=True))
+    item_2 = Column(SMALLINT(unsigned=True))
+    item_3 = Column(SMALLINT(unsigned=True))
+    item_4 = Column(SMALLINT(unsigned=True))
+    item_5 = Column(SMALLINT(unsigned=True))
+    item_neutral = Column(SMALLINT(unsigned=True))
+    backpack_0 = Column(SMALLINT(unsigned=True))
+    backpack_1 = Column(SMALLINT(unsigned=True))
+    backpack_2 = Column(SMALLINT(unsigned=True))
+    backpack_3 = Column(SMALLINT(unsigned=True))
+
+    def __repr__(self):
+        return '<MatchPlayer %r Hero %r>' % (self.match_id, self.hero)
+
+
 class FetchSummary(Base):
     """Base class for fetch summary stats"""
     __tablename__ = 'dota_fetch_summary'
@@ -61,12 +156,31 @@ class FetchSummary(Base):
     rec_count = Column(Integer)
 
 
+class Watermark(Base):
+    """Named high water marks, e.g. the newest match start time, maintained
+    by the writers so readers don't have to aggregate"""
+    __tablename__ = "dota_watermarks"
+
+    name = Column(String(32), primary_key=True)
+    value = Column(BigInteger, nullable=False)
+
+
+class DirtyHour(Base):
+    """`dota_hero_win_rate` hour buckets (by end time) which received matches
+    since they were last aggregated, see `mark_dirty_hours`"""
+    __tablename__ = "dota_dirty_hours"
+
+    hour = Column(BigInteger, primary_key=True)
+    skill = Column(Integer, primary_key=True)
+    marked = Column(BigInteger, nullable=False, server_default=text("0"))
+
+
 class HeroWinRate(Base):
     """Win rate/pick rate revised table"""
     __tablename__ = "dota_hero_win_rate"
 
     time_hero_skill = Column(String(128), primary_key=True)
-    time = Column(BigInteger)
+    time = Column(BigInteger, primary_key=True)
     hero = Column(Integer)
     skill = Column(Integer)
     radiant_win = Column(Integer)
@@ -75,68 +189,588 @@ class HeroWinRate(Base):
     dire_total = Column(Integer)
 
 # pylint: enable=too-few-public-methods, no-member
+# -----------------------------------------------------------------------------
+# Hero lineups
+# -----------------------------------------------------------------------------
+
+
+def pack_heroes(radiant_heroes, dire_heroes):
+    """Pack two lineups of five hero IDs into a `dota_matches.heroes`
+    value. Hero order within each team is kept."""
+
+    heroes = list(radiant_heroes) + list(dire_heroes)
+    if len(heroes) != LINEUP_SIZE:
+        raise ValueError("Expected {} heroes, got {}".format(
+            LINEUP_SIZE, heroes))
+    return np.array(heroes, dtype=HERO_DTYPE).tobytes()
+
+
+def unpack_heroes(packed):
+    """Radiant and dire hero ID lists of a packed `heroes` value."""
+
+    heroes = np.frombuffer(packed, dtype=HERO_DTYPE).tolist()
+    return heroes[:LINEUP_SIZE//2], heroes[LINEUP_SIZE//2:]
+
+
+def lineup_columns(radiant_heroes, dire_heroes):
+    """`dota_matches` columns describing a lineup, the packed `heroes` and
+    the per team hero bitmasks."""
+
+    columns = {'heroes': pack_heroes(radiant_heroes, dire_heroes)}
+    for team, heroes in zip(Bitmask.TEAMS, (radiant_heroes, dire_heroes)):
+        columns.update(zip(Bitmask.columns(team), Bitmask.encode(heroes)))
+    return columns
+
+
+def decode_heroes(values):
+    """Decode a sequence of packed `heroes` values in one pass. Returns an
+    integer array of shape (len(values), 10), radiant heroes in columns 0-4
+    and dire heroes in columns 5-9."""
+
+    heroes = np.frombuffer(b"".join(values), dtype=HERO_DTYPE)
+    return heroes.reshape(-1, LINEUP_SIZE).astype(np.int64)
+
+
 # -----------------------------------------------------------------------------
 # Database Functions
 # -----------------------------------------------------------------------------
 
 
+def get_engine(uri=None):
+    """Return the engine for `uri` (default `DB_URI`), shared by every caller
+    in this process. Connections come from its pool, callers only need to
+    close (return) what they check out."""
+
+    return _registry(uri)[0]
+
+
+def get_session(uri=None):
+    """Return the session of the calling thread, bound to `get_engine(uri)`.
+    Every thread gets its own session, `remove_sessions` discards it."""
+
+    return _registry(uri)[1]()
+
+
+def remove_sessions():
+    """Close and discard the calling thread's sessions, e.g. at the end of a
+    web request."""
+
+    for _, sessions in list(_ENGINES.values()):
+        sessions.remove()
+
+
+def dispose_engines():
+    """Drop the engines inherited from the parent after a fork. Their pooled
+    connections are left open for the parent (closing them would close the
+    parent's sockets), the child connects afresh on first use."""
+
+    with _ENGINES_LOCK:
+        for key in [t for t in _ENGINES if t[1] != os.getpid()]:
+            engine, _ = _ENGINES.pop(key)
+            engine.dispose(close=False)
+
+
+def _registry(uri):
+    """Engine and scoped session factory for `uri`, created on first use"""
+
+    key = (DB_URI if uri is None else uri, os.getpid())
+    with _ENGINES_LOCK:
+        if key not in _ENGINES:
+            engine = create_engine(key[0], echo=False,
+                                   pool_size=POOL_SIZE,
+                                   max_overflow=POOL_OVERFLOW,
+                                   pool_recycle=POOL_RECYCLE,
+                                   pool_pre_ping=POOL_PRE_PING)
+            _ENGINES[key] = (engine, scoped_session(
+                sessionmaker(bind=engine)))
+        return _ENGINES[key]
+
+
 def connect_database():
-    """Connect to database and return session"""
-    engine = create_engine(DB_URI, echo=False)
-    s_maker = sessionmaker()
-    s_maker.configure(bind=engine)
-    session = s_maker()
+    """Return the shared engine and the calling thread's session"""
 
-    return engine, session
+    return get_engine(), get_session()
 
 
-def get_max_start_time():
-    """Return the most recent start time"""
+def upsert_rows(session, table, rows, batch_size):
+    """Write `rows` (list of dictionaries keyed by column) into `table` using
+    multi-row `INSERT ... ON DUPLICATE KEY UPDATE` statements of at most
+    `batch_size` rows. All statements are committed once at the end."""
+
+    update_cols = [c.name for c in table.columns if not c.primary_key]
+
+    for i in range(0, len(rows), batch_size):
+        stmt = insert(table).values(rows[i:i+batch_size])
+        stmt = stmt.on_duplicate_key_update(
+            {col: stmt.inserted[col] for col in update_cols})
+        session.execute(stmt)
+
+    session.commit()
 
-    engine, _ = connect_database()
-    with engine.connect() as conn:
-        rows = conn.execute("select max(start_time) from dota_matches")
-    return int(rows.first()[0])
 
+def get_max_start_time(max_age=None):
+    """Return the most recent start time, from the `START_TIME` watermark"""
+    return get_watermark(START_TIME, max_age)
 
-def purge_database(days):
-    """Purge all records older than `days` relative to current time."""
 
-    now = dt.utcnow().timestamp()
-    cutoff = int(now - (days*24*60*60))
+def hero_filter(allies=(), enemies=(), team=None):
+    """SQL condition for matches with all of `allies` on `team` ('radiant',
+    'dire' or None for either) and all of `enemies` on the other team. Uses
+    the hero bitmask columns only."""
 
-    engine, _ = connect_database()
+    if not allies and not enemies:
+        raise ValueError("No heroes to filter on")
 
-    tbl_col = [
-                ("dota_matches", "start_time"),
-                ("dota_hero_win_rate", "time"),
-               ]
+    terms = []
+    for side in Bitmask.TEAMS if team is None else (team,):
+        other = Bitmask.TEAMS[1 - Bitmask.TEAMS.index(side)]
+        terms.append("({} AND {})".format(Bitmask.contains(side, allies),
+                                          Bitmask.contains(other, enemies)))
+    return "(" + " OR ".join(terms) + ")"
+
+
+def _hero_where(allies, enemies, team, begin, end, skill):
+    """WHERE clause for `find_matches` and `count_matches`"""
+
+    terms = [hero_filter(allies, enemies, team)]
+    if begin is not None:
+        terms.append("start_time>={}".format(int(begin)))
+    if end is not None:
+        terms.append("start_time<={}".format(int(end)))
+    if skill is not None:
+        terms.append("api_skill={}".format(int(skill)))
+    return " AND ".join(terms)
+
+
+# pylint: disable=too-many-arguments
+def find_matches(allies=(), enemies=(), team=None, begin=None, end=None,
+                 skill=None):
+    """Matches with all of `allies` on one team and all of `enemies` on the
+    other, see `hero_filter`, optionally restricted to a start time range
+    and skill level. Returns rows of (match_id, start_time, heroes,
+    radiant_win)."""
+
+    stmt = "SELECT match_id, start_time, heroes, radiant_win FROM " \
+           "dota_matches WHERE {};".format(
+               _hero_where(allies, enemies, team, begin, end, skill))
+
+    engine = get_engine()
     with engine.connect() as conn:
-        for table, col in tbl_col:
-            stmt = "SELECT COUNT(*) FROM {0} WHERE {1}<={2}".format(
-                table, col, cutoff)
-            num_delete = conn.execute(stmt)
+        return conn.execute(stmt).fetchall()
+
+
+def count_matches(allies=(), enemies=(), team=None, begin=None, end=None,
+                  skill=None):
+    """Number of matches found by `find_matches` and the number of those
+    won by the team of `allies` (or the team facing `enemies`)."""
+
+    stmt = "SELECT COUNT(*), SUM(CASE WHEN {0} THEN radiant_win ELSE " \
+           "1-radiant_win END) FROM dota_matches WHERE {1};".format(
+               hero_filter(allies, enemies, 'radiant'),
+               _hero_where(allies, enemies, team, begin, end, skill))
+
+    engine = get_engine()
+    with engine.connect() as conn:
+        total, wins = conn.execute(stmt).first()
+    return int(total), int(wins or 0)
+# pylint: enable=too-many-arguments
+
+
+def partition_name(bound):
+    """Name of the daily partition with upper bound `bound` (a midnight UTC
+    timestamp), e.g. p20201121 for times before 2020-11-22."""
+    return "p" + dt.utcfromtimestamp(bound - DAY).strftime("%Y%m%d")
+
+
+def partition_clauses(bounds):
+    """PARTITION definitions for daily upper `bounds` and the catch-all"""
+
+    clauses = ["PARTITION {} VALUES LESS THAN ({})".format(
+        partition_name(t), t) for t in bounds]
+    clauses.append("PARTITION {} VALUES LESS THAN MAXVALUE".format(
+        FUTURE_PARTITION))
+    return ", ".join(clauses)
 
-            stmt = "SELECT COUNT(*) FROM {0} WHERE {1}>{2}".format(
-                table, col, cutoff)
-            num_save = conn.execute(stmt)
 
-            log.info("{0:20} purging = {1:15}".format(
-                table, num_delete.first()[0]))
-            log.info("{0:20} saving  = {1:15}".format(
-                table, num_save.first()[0]))
+def get_partitions(conn, table):
+    """Daily partitions of `table` as (name, upper bound, estimated rows),
+    oldest first. Empty if `table` is not partitioned."""
+
+    stmt = "SELECT PARTITION_NAME, PARTITION_DESCRIPTION, TABLE_ROWS FROM " \
+           "information_schema.PARTITIONS WHERE TABLE_SCHEMA=DATABASE() " \
+           "AND TABLE_NAME='{}' AND PARTITION_NAME IS NOT NULL ORDER BY " \
+           "PARTITION_ORDINAL_POSITION".format(table)
+    return [(name, int(bound), int(rows or 0)) for name, bound, rows in
+            conn.execute(stmt) if name != FUTURE_PARTITION]
+
+
+def create_partitions(days_ahead=PARTITION_AHEAD):
+    """Make sure daily partitions exist up to `days_ahead` days past today
+    by splitting the catch-all partition. The catch-all is empty in normal
+    operation, so this is a metadata change."""
+
+    target = (int(time.time()) // DAY + days_ahead + 1) * DAY
+
+    engine = get_engine()
+    with engine.connect() as conn:
+        for table, _ in PARTITIONED_TABLES:
+            partitions = get_partitions(conn, table)
+            if not partitions:
+                log.warning("%s is not partitioned", table)
+                continue
+
+            bounds = list(range(partitions[-1][1] + DAY, target + 1, DAY))
+            if not bounds:
+                continue
+
+            stmt = "ALTER TABLE {0} REORGANIZE PARTITION {1} INTO ({2})".\
+                format(table, FUTURE_PARTITION, partition_clauses(bounds))
+            conn.execute(stmt)
+            log.info("{0:20} created {1} to {2}".format(
+                table, partition_name(bounds[0]), partition_name(bounds[-1])))
+
+
+def estimate_rows(conn, table, where):
+    """Number of rows of `table` matching `where` as estimated by the
+    optimizer (`EXPLAIN`) from index statistics, without scanning."""
+
+    result = conn.execute("EXPLAIN SELECT 1 FROM {0} WHERE {1}".format(
+        table, where))
+    column = list(result.keys()).index('rows')
+    return sum(int(t[column] or 0) for t in result)
+
+
+# pylint: disable=too-many-arguments
+def delete_chunked(conn, table, col, cutoff, chunk_size=PURGE_CHUNK,
+                   pause=PURGE_PAUSE, max_lock=PURGE_MAX_LOCK):
+    """Delete the rows of `table` with `col`<=`cutoff`, oldest first, in
+    ranges of about `chunk_size` rows of the `col` index. Each `DELETE` only
+    holds the table lock briefly: the chunk shrinks when a `DELETE` takes
+    longer than `max_lock` seconds, grows back to `chunk_size` when it is
+    fast, and other clients get `pause` seconds between chunks. Safe to
+    interrupt, running it again carries on with the oldest remaining rows.
+    Returns the number of rows deleted."""
+
+    total = estimate_rows(conn, table, "{0}<={1}".format(col, cutoff))
+    deleted = 0
+    last = None
+    size = chunk_size
+    reported = time.time()
+
+    while True:
+        where = "{0}<={1}".format(col, cutoff)
+        if last is not None:
+            where += " AND {0}>{1}".format(col, last)
+
+        # Upper end of the next chunk, the `size`th oldest remaining row
+        bound = conn.execute("SELECT {0} FROM {1} WHERE {2} ORDER BY {0} "
+                             "LIMIT 1 OFFSET {3}".format(
+                                 col, table, where, size - 1)).scalar()
+        if bound is None:
+            bound = cutoff
+
+        start = time.time()
+        result = conn.execute("DELETE FROM {0} WHERE {1} AND {2}<={3}".format(
+            table, where, col, bound))
+        elapsed = time.time() - start
+        deleted += max(result.rowcount, 0)
+
+        if time.time() - reported > 10 or bound >= cutoff:
+            log.info("{0:20} purged  {1:15} of ~{2}".format(
+                table, deleted, total))
+            reported = time.time()
+        if bound >= cutoff:
+            return deleted
+
+        last = bound
+        if elapsed > max_lock:
+            size = max(size // 2, 100)
+        elif elapsed < max_lock / 4:
+            size = min(size * 2, chunk_size)
+        time.sleep(pause)
+
+
+def purge_database(days, chunk_size=None, pause=PURGE_PAUSE,
+                   max_lock=PURGE_MAX_LOCK):
+    """Purge all records older than `days` relative to current time. Daily
+    partitions entirely before the cutoff are dropped, so up to a day more
+    than `days` is kept. Tables which are not partitioned fall back to a
+    `DELETE`, or to `delete_chunked` if `chunk_size` is set. Partitions are
+    then pre-created, see `create_partitions`."""
+
+    cutoff = int(time.time() - days*DAY)
+    partitioned = False
+
+    engine = get_engine()
+
+    with engine.connect() as conn:
+        for table, col in PARTITIONED_TABLES:
+            partitions = get_partitions(conn, table)
+            if partitions:
+                # Always keep the newest daily partition
+                partitioned = True
+                drop = [t for t in partitions[:-1] if t[1] <= cutoff + 1]
+                log.info("{0:20} purging ~ {1:15}".format(
+                    table, sum(t[2] for t in drop)))
+                log.info("{0:20} saving  ~ {1:15}".format(
+                    table, sum(t[2] for t in partitions[len(drop):])))
+                if drop:
+                    stmt = "ALTER TABLE {0} DROP PARTITION {1}".format(
+                        table, ", ".join(t[0] for t in drop))
+                    conn.execute(stmt)
+                continue
+
+            log.info("{0:20} purging ~ {1:15}".format(
+                table, estimate_rows(conn, table, "{0}<={1}".format(
+                    col, cutoff))))
+            log.info("{0:20} saving  ~ {1:15}".format(
+                table, estimate_rows(conn, table, "{0}>{1}".format(
+                    col, cutoff))))
+
+            if chunk_size:
+                delete_chunked(conn, table, col, cutoff, chunk_size, pause,
+                               max_lock)
+                continue
 
             log.info("Beginning record DELETE")
             stmt = "DELETE FROM {0} WHERE {1}<={2}".format(table, col, cutoff)
             conn.execute(stmt)
             log.info("End record DELETE")
 
+    if partitioned:
+        create_partitions()
+# pylint: enable=too-many-arguments
+
+
+# -----------------------------------------------------------------------------
+# Watermarks
+# -----------------------------------------------------------------------------
+_WATERMARKS = {}                        # name: (value, monotonic time read)
+_WATERMARK_SUBSCRIBERS = []
+_WATERMARK_CHANGED = threading.Condition()
+
+
+def get_watermark(name, max_age=None):
+    """Return watermark `name`, read from `dota_watermarks` at most
+    `max_age` (default `WATERMARK_TTL`) seconds ago. A missing `START_TIME`
+    watermark is computed from `dota_matches` and stored. Returns None
+    while there is nothing to mark."""
+
+    max_age = WATERMARK_TTL if max_age is None else max_age
+    with _WATERMARK_CHANGED:
+        value, read = _WATERMARKS.get(name, (None, None))
+    if read is not None and time.monotonic() - read < max_age:
+        return value
+
+    with get_engine().connect() as conn:
+        value = conn.execute("SELECT value FROM dota_watermarks WHERE "
+                             "name='{}'".format(name)).scalar()
+        if value is None and name == START_TIME:
+            value = conn.execute("SELECT MAX(start_time) FROM "
+                                 "dota_matches").scalar()
+            if value is not None:
+                conn.execute(_advance_stmt(name, value))
+
+    if value is not None:
+        _set_watermark(name, int(value))
+    return value if value is None else int(value)
+
+
+def advance_watermark(session, value, name=START_TIME):
+    """Raise watermark `name` to `value`, it never moves back. Commits
+    `session`."""
+
+    session.execute(_advance_stmt(name, value))
+    session.commit()
+    _set_watermark(name, value)
+
+
+def reset_watermarks():
+    """Forget cached watermarks, e.g. after the database is rebuilt"""
+    with _WATERMARK_CHANGED:
+        _WATERMARKS.clear()
+
+
+def subscribe_watermark(callback):
+    """Call `callback(name, value)` whenever this process sees a watermark
+    advance, by its own writes or on reading a newer value."""
+    _WATERMARK_SUBSCRIBERS.append(callback)
+
+
+def unsubscribe_watermark(callback):
+    """Undo `subscribe_watermark`"""
+    _WATERMARK_SUBSCRIBERS.remove(callback)
+
+
+def wait_for_watermark(after, name=START_TIME, timeout=None, interval=None):
+    """Block until watermark `name` is past `after`, woken by writes in this
+    process and polling `dota_watermarks` every `interval` (default
+    `WATERMARK_TTL`) seconds for other processes' writes. Returns the new
+    value, or None on `timeout`."""
+
+    interval = WATERMARK_TTL if interval is None else interval
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        value = get_watermark(name, interval)
+        if value is not None and value > after:
+            return value
+
+        wait = interval
+        if deadline is not None:
+            wait = min(wait, deadline - time.monotonic())
+            if wait <= 0:
+                return None
+        with _WATERMARK_CHANGED:
+            cached = _WATERMARKS.get(name, (None, None))[0]
+            if cached is None or cached <= after:
+                _WATERMARK_CHANGED.wait(wait)
+
+
+def _advance_stmt(name, value):
+    """Upsert of watermark `name` which keeps the larger value"""
+
+    table = Watermark.__table__
+    stmt = insert(table).values(name=name, value=value)
+    return stmt.on_duplicate_key_update(
+        value=func.greatest(table.c.value, stmt.inserted.value))
+
+
+def _set_watermark(name, value):
+    """Cache watermark `name`, notify subscribers if it advanced"""
+
+    with _WATERMARK_CHANGED:
+        old = _WATERMARKS.get(name, (None, None))[0]
+        if old is not None and value < old:
+            value = old
+        _WATERMARKS[name] = (value, time.monotonic())
+        advanced = old is None or value > old
+        if advanced:
+            _WATERMARK_CHANGED.notify_all()
+
+    if advanced:
+        for callback in list(_WATERMARK_SUBSCRIBERS):
+            callback(name, value)
+
+
+# -----------------------------------------------------------------------------
+# Win rate aggregation
+# -----------------------------------------------------------------------------
+
+
+def hour_buckets(start_time):
+    """End times of the `dota_hero_win_rate` hour buckets a match starting at
+    `start_time` is counted in. Buckets span [end - 1 hour, end] inclusive,
+    so a match starting exactly on the hour is in two."""
+
+    end = start_time // HOUR * HOUR + HOUR
+    if start_time % HOUR == 0:
+        return [end - HOUR, end]
+    return [end]
+
+
+def mark_dirty_hours(session, matches):
+    """Flag the hour buckets of `matches`, (start time, skill) pairs, for
+    re-aggregation. A bucket which is already flagged has its `marked`
+    count bumped, see `clear_dirty_hours`. Commits `session`."""
+
+    rows = {(hour, skill) for start_time, skill in matches
+            for hour in hour_buckets(start_time)}
+    if not rows:
+        return
+
+    table = DirtyHour.__table__
+    stmt = insert(table).values(
+        [{'hour': hour, 'skill': skill} for hour, skill in sorted(rows)])
+    session.execute(stmt.on_duplicate_key_update(marked=table.c.marked + 1))
+    session.commit()
+
+
+def get_dirty_hours(conn, skill, end):
+    """Flagged hour buckets of `skill` up to `end`, as a dictionary of
+    `marked` counts by hour in ascending order."""
+
+    return dict(conn.execute(
+        "SELECT hour, marked FROM dota_dirty_hours WHERE skill={} AND "
+        "hour<={} ORDER BY hour".format(skill, end)).fetchall())
+
+
+def clear_dirty_hours(conn, skill, hours):
+    """Clear the flags of `hours`, as returned by `get_dirty_hours`, once
+    they are aggregated. A bucket marked again since, by a match written
+    while it was being read, keeps its flag."""
+
+    items = sorted(hours.items())
+    for i in range(0, len(items), PURGE_CHUNK):
+        conn.execute("DELETE FROM dota_dirty_hours WHERE skill={} AND "
+                     "(hour, marked) IN ({})".format(skill, ", ".join(
+                         "({}, {})".format(hour, marked)
+                         for hour, marked in items[i:i+PURGE_CHUNK])))
+
+
+def win_rate_key(end_time, hero, skill):
+    """`dota_hero_win_rate.time_hero_skill` of a bucket"""
+    return "{0}_H{1:03}_S{2}".format(end_time, hero, skill)
+
+
+def win_rate_deltas(matches):
+    """Accumulate `dota_hero_win_rate` counts of `matches` (parsed
+    summaries) per (hour bucket, hero, skill), as `parse_records` does per
+    bucket. Returns rows of counts to add."""
+
+    counts = {}
+    for summary in matches:
+        radiant_win = int(summary['radiant_win'] == 1)
+        teams = ((summary['radiant_heroes'], 'radiant', radiant_win),
+                 (summary['dire_heroes'], 'dire', 1 - radiant_win))
+        for hour in hour_buckets(summary['start_time']):
+            for heroes, team, win in teams:
+                for hero in heroes:
+                    row = counts.setdefault(
+                        (hour, hero, summary['api_skill']),
+                        dict.fromkeys(WIN_RATE_COUNTS, 0))
+                    row[team + '_win'] += win
+                    row[team + '_total'] += 1
+
+    return [dict(row, time_hero_skill=win_rate_key(hour, hero, skill),
+                 time=hour, hero=hero, skill=skill)
+            for (hour, hero, skill), row in sorted(counts.items())]
+
+
+def apply_win_rate_deltas(session, rows, batch_size=1000):
+    """Add `win_rate_deltas` rows onto `dota_hero_win_rate`, creating
+    buckets as needed. Commits `session`."""
+
+    table = HeroWinRate.__table__
+    for i in range(0, len(rows), batch_size):
+        stmt = insert(table).values(rows[i:i+batch_size])
+        stmt = stmt.on_duplicate_key_update(
+            {col: table.c[col] + stmt.inserted[col]
+             for col in WIN_RATE_COUNTS})
+        session.execute(stmt)
+    session.commit()
+
+
+def existing_matches(session, match_ids):
+    """The subset of `match_ids` already in `dota_matches`"""
+
+    if not match_ids:
+        return set()
+    rows = session.execute(text(
+        "SELECT match_id FROM dota_matches WHERE match_id IN ({})".format(
+            ", ".join(str(int(t)) for t in match_ids))))
+    return {t[0] for t in rows}
+
+
+# -----------------------------------------------------------------------------
+# Database creation
+# -----------------------------------------------------------------------------
+
 
 def create_database():
     """Create the clean database tables"""
 
     # Drop all of the tables
-    engine, _ = connect_database()
+    engine = get_engine()
     with engine.connect() as conn:
         for table in engine.table_names():
             conn.execute("DROP TABLE {};".format(table))
@@ -176,12 +810,28 @@ if __name__ == "__main__":
     parser.add_argument('--purge', action='store', type=int,
                         help='Purge the database of records older than PURGE '
                              'from the current time.')
+    parser.add_argument('--chunk-size', action='store', type=int,
+                        help='Purge tables which are not partitioned '
+                             'CHUNK_SIZE rows at a time.')
+    parser.add_argument('--chunk-pause', action='store', type=float,
+                        default=PURGE_PAUSE,
+                        help='Seconds between purge chunks.')
+    parser.add_argument('--max-lock', action='store', type=float,
+                        default=PURGE_MAX_LOCK,
+                        help='Target seconds per purge chunk, larger chunks '
+                             'are split.')
+    parser.add_argument('--partitions', action='store', type=int,
+                        metavar='DAYS',
+                        help='Create daily partitions up to DAYS days ahead.')
 
     opts = parser.parse_args()
 
     if opts.create:
         create_database()
     elif opts.purge is not None:
-        purge_database(opts.purge)
+        purge_database(opts.purge, opts.chunk_size, opts.chunk_pause,
+                       opts.max_lock)
+    elif opts.partitions is not None:
+        create_partitions(opts.partitions)
     else:
         parser.print_help()
@@ -52,6 +52,77 @@ class TimeMethods:
         return text, begin, end
 
 
+class Bitmask:
+    """Hero bitmasks for `dota_matches`. Hero ID `n` is bit `n % 64` of
+    chunk `n // 64` and each team is stored as `NUM_CHUNKS` BIGINT UNSIGNED
+    columns, `radiant_mask_0`, `radiant_mask_1`, ... Matches containing a set
+    of heroes are then found with bitwise AND instead of decoding lineups.
+    """
+
+    CHUNK_BITS = 64
+    NUM_CHUNKS = 3
+    TEAMS = ('radiant', 'dire')
+
+    @classmethod
+    def columns(cls, team):
+        """Mask column names of `team`"""
+
+        if team not in cls.TEAMS:
+            raise ValueError("Unknown team: {}".format(team))
+        return ["{}_mask_{}".format(team, t) for t in range(cls.NUM_CHUNKS)]
+
+    @classmethod
+    def encode(cls, heroes):
+        """List of `NUM_CHUNKS` integers with the bits of `heroes` set"""
+
+        chunks = [0] * cls.NUM_CHUNKS
+        for hero in heroes:
+            chunk, bit = divmod(int(hero), cls.CHUNK_BITS)
+            if hero < 0 or chunk >= cls.NUM_CHUNKS:
+                raise ValueError("Hero ID out of bitmask range: {}".format(
+                    hero))
+            chunks[chunk] |= 1 << bit
+        return chunks
+
+    @classmethod
+    def decode(cls, chunks):
+        """Sorted hero IDs set in `chunks`"""
+
+        heroes = []
+        for i, chunk in enumerate(chunks):
+            for bit in range(cls.CHUNK_BITS):
+                if int(chunk) >> bit & 1:
+                    heroes.append(i * cls.CHUNK_BITS + bit)
+        return heroes
+
+    @classmethod
+    def encode_array(cls, heroes):
+        """Vectorized `encode`, `heroes` is an integer array of shape
+        (matches, heroes per match). Returns uint64 array of shape
+        (matches, NUM_CHUNKS)."""
+
+        heroes = np.asarray(heroes, dtype=np.int64)
+        if heroes.size and (heroes.min() < 0 or
+                            heroes.max() >= cls.NUM_CHUNKS * cls.CHUNK_BITS):
+            raise ValueError("Hero ID out of bitmask range")
+
+        masks = np.zeros((heroes.shape[0], cls.NUM_CHUNKS), dtype=np.uint64)
+        rows = np.repeat(np.arange(heroes.shape[0]), heroes.shape[1])
+        bits = np.left_shift(np.uint64(1),
+                             (heroes % cls.CHUNK_BITS).astype(np.uint64))
+        np.bitwise_or.at(masks, (rows, (heroes // cls.CHUNK_BITS).reshape(
+            -1)), bits.reshape(-1))
+        return masks
+
+    @classmethod
+    def contains(cls, team, heroes):
+        """SQL condition, true when all of `heroes` are on `team`"""
+
+        terms = ["({0} & {1}) = {1}".format(col, mask) for col, mask in
+                 zip(cls.columns(team), cls.encode(heroes)) if mask]
+        return " AND ".join(terms) if terms else "1=1"
+
+
 class MLEncoding:
     """Methods to one-hot encode and decode hero information for machine
     learning applications.
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Asyncio fetch engine, `fetch.py --engine async`.
+
+Runs the pipeline of `pipeline.py` on an asyncio event loop
+(`fetch_heroes_async`). A single `aiohttp` session is shared by all requests,
+a semaphore bounds the number of `GetMatchDetails` calls in flight, and the
+next `GetMatchHistory` page is requested while the details of the previous
+page are still being fetched and parsed.
+
+Shared state (limiter, response cache, ...) is looked up on `pipeline` at
+call time, so it is the same for both engines.
+"""
+import time
+import asyncio
+from functools import partial
+from dota_stats import meta, pipeline
+from dota_stats.pipeline import APIException, LeaseLost, HistorySweep, \
+    API_REQUESTS, HISTORY_EMPTY, MATCH_NOT_FOUND, HEADERS, log, \
+    cached_result, record_response, sleep_schedule, endpoint_name, \
+    details_url, history_url, check_match, claim_matches, summarize_page, \
+    unit_callback
+
+try:
+    import aiohttp
+except ImportError:     # Only required for the async engine
+    aiohttp = None
+
+
+async def fetch_url_async(http, url):
+    """Asyncio version of `pipeline.fetch_url`, `http` is the shared
+    `aiohttp.ClientSession`."""
+
+    cached = cached_result(url)
+    if cached is not None:
+        return cached
+
+    backoff = 0
+    for sleep in sleep_schedule():
+        await asyncio.sleep(backoff)
+        await pipeline.LIMITER.acquire_async()
+        backoff = sleep
+        sent = time.monotonic()
+        try:
+            async with http.get(url, headers=HEADERS) as resp:
+                content = await resp.read()
+                status_code, reason = resp.status, resp.reason
+        except aiohttp.ClientConnectionError as conn_error:
+            API_REQUESTS.inc(endpoint=endpoint_name(url), status='error')
+            log.error("Connection error: %r", conn_error)
+        except asyncio.TimeoutError as timeout_error:
+            API_REQUESTS.inc(endpoint=endpoint_name(url), status='error')
+            log.error("Timeout error: %r", timeout_error)
+        else:
+            result = record_response(url, sent, status_code, content,
+                                     reason)
+            if result is not None:
+                return result
+            if status_code in (429, 503):
+                backoff = 0
+
+    raise ValueError("Could not fetch (timeout?): {}".format(url))
+
+
+async def fetch_match_async(http, match_id, skill):
+    """Asyncio version of `pipeline.fetch_match`"""
+
+    url = details_url(match_id)
+
+    match = {}
+    for _ in range(10):
+        match = await fetch_url_async(http, url)
+        if 'start_time' in match.keys() or pipeline.RESPONSES.replay:
+            break
+
+        log.error("Match ID not found: %s", str(match_id))
+        MATCH_NOT_FOUND.inc()
+        pipeline.RESPONSES.evict(url)
+        await asyncio.sleep(1)
+
+    return check_match(match, match_id, skill)
+
+
+async def process_match_async(http, semaphore, skill, match_id):
+    """Fetch a single match on the event loop, `semaphore` bounds the number
+    of detail requests in flight."""
+
+    try:
+        async with semaphore:
+            return await fetch_match_async(http, match_id, skill)
+    except APIException as e_msg:
+        log.error("{0:30.30} {1}". format("API Error", str(e_msg)))
+        return None
+
+
+async def fetch_matches_loop_async(http, skill, start_at_match_id, hero):
+    """Asyncio version of `pipeline.fetch_matches_loop`"""
+    url = history_url(skill, start_at_match_id, hero)
+
+    resp = {}
+    for retry in range(20):
+        resp = await fetch_url_async(http, url)
+
+        log.error("num_results (try %d) %d", retry, resp['num_results'])
+
+        # If we found results, break out of loop
+        if resp['num_results'] > 0 or pipeline.RESPONSES.replay:
+            break
+
+        HISTORY_EMPTY.inc()
+        pipeline.RESPONSES.evict(url)
+        await asyncio.sleep(1)
+
+    return resp
+
+
+async def write_page_async(writer, match_ids, tasks, hero, skill):
+    """Wait for one page of detail tasks for `match_ids`, parse it and queue
+    the valid matches."""
+
+    if not tasks:
+        return
+
+    summaries = summarize_page(match_ids, await asyncio.gather(*tasks),
+                               hero, skill)
+    for summary in summaries:
+        await writer.put_async(summary)
+
+    log.info("%d valid matches queued for database (%d waiting)",
+             len(summaries), writer.queue.qsize())
+
+
+async def fetch_matches_async(writer, sweep, http, semaphore, on_page=None):
+    """Asyncio version of `pipeline.fetch_matches`, over the history of
+    `sweep`. Detail requests for a page are scheduled as tasks and the next
+    history page is fetched while they run, a page is written once the
+    following page has been scheduled.
+    """
+    hero, skill = sweep.hero, sweep.skill
+    counter = 1
+    num_matches = 0
+    start = time.time()
+    pending = [], []    # Match IDs and detail tasks of the previous page
+
+    while not sweep.done:
+        log.info("Fetching more matches: %d", counter)
+
+        cursor = sweep.start_at_match_id
+        resp = await fetch_matches_loop_async(http, skill, cursor, hero)
+
+        match_ids = claim_matches(sweep.page(resp), sweep)
+        tasks = [asyncio.ensure_future(process_match_async(
+            http, semaphore, skill, match_id)) for match_id in match_ids]
+
+        # Details for the previous page have been running while this page
+        # was requested, finish them off while the new page runs.
+        await write_page_async(writer, *pending, hero, skill)
+        pending = match_ids, tasks
+        await writer.after_write_async(partial(sweep.checkpoint, cursor))
+        log.debug("Rate limit %(rate).2f/s, %(waiting)d waiting",
+                  pipeline.LIMITER.stats())
+
+        num_matches += len(resp['matches'])
+        if on_page is not None:
+            try:
+                on_page(counter, num_matches)
+            except LeaseLost:
+                # Details already claimed are written, the rest of the
+                # sweep is left to the unit's new owner
+                await write_page_async(writer, *pending, hero, skill)
+                raise
+
+        counter = counter+1
+
+    await write_page_async(writer, *pending, hero, skill)
+    await writer.after_write_async(sweep.finish)
+
+    log.debug("Matches per minute: %s",
+              str(60*counter/(time.time()-start)))
+
+
+async def fetch_heroes_async(writer, units, concurrency, on_page=None):
+    """Main loop over (hero, skill) `units` for the async engine. One HTTP
+    session is kept open for the whole run, `concurrency` limits detail
+    requests in flight.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as http:
+        counter = 1
+        for hero, skill in units:
+            log.info("-----------------------------------------------------")
+            log.info(">>>>>>>> Hero: %s %d Skill: %d <<<<<<<<",
+                     meta.HERO_DICT[hero], counter, skill)
+            log.info("-----------------------------------------------------")
+            try:
+                await fetch_matches_async(
+                    writer, HistorySweep(hero, skill), http, semaphore,
+                    unit_callback(on_page, hero, skill))
+            except LeaseLost:
+                log.error("Lease lost: hero %d skill %d", hero, skill)
+            counter += 1
@@ -9,7 +9,7 @@ import argparse
 import datetime as dt
 import pandas as pd
 import pytz
-from dota_stats.db_util import FetchSummary, connect_database
+from dota_stats.db_util import FetchSummary, get_engine, get_session
 from dota_stats import dotautil
 
 
@@ -28,7 +28,7 @@ def get_health_summary(days, timezone, hour=True):
     """
 
     # Database connection
-    engine, _ = connect_database()
+    engine = get_engine()
 
     # Get TZ offsets, do everything relative to current TZ offset
     local_tz = pytz.timezone(timezone)
@@ -132,7 +132,8 @@ def main():
     parser.add_argument("horizon_days", type=int)
     opts = parser.parse_args()
 
-    engine, session = connect_database()
+    engine = get_engine()
+    session = get_session()
     rows = fetch_rows(opts.horizon_days, engine)
     print("Records: {}".format(rows.rowcount))
 
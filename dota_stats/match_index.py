@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Compact, bounded index of recently seen match IDs used by `fetch.py` to
+avoid fetching the same match twice.
+
+Entries live in two aligned, sorted `int64` numpy arrays (match ID and start
+time, 16 bytes per match) rather than a dictionary of boxed integers. New
+entries go into a small dictionary which is merged into the arrays once it
+holds `buffer_size` entries. Merging also evicts entries older than the
+horizon and, if the index is still over `max_size`, the oldest entries.
+
+The index can be persisted so `fetch.py` starts without scanning the
+database. `save` writes a snapshot of the sorted arrays (`.npy`), and
+`record` appends matches to a journal next to the snapshot as they are
+written, so a crashed run loses nothing. Worker processes sharing a
+snapshot each append to a journal of their own. `load` reads the snapshot
+and replays the journals.
+"""
+import os
+import glob
+import threading
+import time
+import numpy as np
+
+
+class MatchIndex:
+    """Thread-safe set of match IDs with start times.
+
+        horizon:        seconds, entries older than now-horizon are evicted
+        max_size:       maximum number of entries kept in the arrays
+        buffer_size:    number of new entries held before a merge
+    """
+
+    def __init__(self, horizon, max_size=2000000, buffer_size=4096):
+        self.horizon = horizon
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._times = np.zeros(0, dtype=np.int64)
+        self._buffer = {}
+        self._journal = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids) + len(self._buffer)
+
+    def __contains__(self, match_id):
+        with self._lock:
+            return self._contains(match_id)
+
+    def _contains(self, match_id):
+        """Membership test, lock must be held."""
+        if match_id in self._buffer:
+            return True
+        idx = np.searchsorted(self._ids, match_id)
+        return idx < len(self._ids) and self._ids[idx] == match_id
+
+    def add(self, match_id, start_time):
+        """Add a match, returns False if it was already present."""
+
+        with self._lock:
+            if self._contains(match_id):
+                return False
+            self._buffer[match_id] = start_time
+            if len(self._buffer) >= self.buffer_size:
+                self._merge()
+            return True
+
+    def update(self, match_ids, start_times):
+        """Bulk add, e.g. when seeding from the database."""
+
+        with self._lock:
+            self._merge(np.asarray(match_ids, dtype=np.int64),
+                        np.asarray(start_times, dtype=np.int64))
+
+    def discard(self, match_ids):
+        """Remove matches, e.g. added on claim but never written."""
+
+        if not match_ids:
+            return
+        with self._lock:
+            for match_id in match_ids:
+                self._buffer.pop(match_id, None)
+            drop = np.isin(self._ids, np.asarray(match_ids, dtype=np.int64))
+            if drop.any():
+                self._ids, self._times = self._ids[~drop], self._times[~drop]
+
+    def compact(self):
+        """Merge buffered entries and apply eviction now."""
+
+        with self._lock:
+            self._merge()
+
+    def load(self, path):
+        """Load a snapshot written by `save` and replay its journals. Returns
+        False if there is no snapshot."""
+
+        if not os.path.exists(path):
+            return False
+
+        snapshot = np.load(path, mmap_mode='r')
+        with self._lock:
+            if len(self._ids) == 0 and not self._buffer:
+                # Snapshot is already sorted and unique, skip the merge sort
+                keep = snapshot[1] >= int(time.time()) - self.horizon
+                self._ids = np.array(snapshot[0][keep], dtype=np.int64)
+                self._times = np.array(snapshot[1][keep], dtype=np.int64)
+            else:
+                self._merge(np.array(snapshot[0]), np.array(snapshot[1]))
+
+        self.replay(path)
+        return True
+
+    def replay(self, path):
+        """Merge the journals next to the snapshot at `path`, e.g. those of
+        worker processes which have exited."""
+
+        for name in journals(path):
+            journal = np.fromfile(name, dtype='<i8')
+            journal = journal[:len(journal) // 2 * 2].reshape(-1, 2)
+            if len(journal) == 0:
+                continue
+            with self._lock:
+                self._merge(journal[:, 0].astype(np.int64),
+                            journal[:, 1].astype(np.int64))
+
+    def save(self, path):
+        """Write a snapshot of the index to `path` and truncate the journal.
+        Worker journals are removed, `load` or `replay` must have merged
+        them."""
+
+        with self._lock:
+            self._merge()
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as file_handle:
+                np.save(file_handle, np.stack([self._ids, self._times]))
+            os.replace(tmp, path)
+
+            # Everything in the journals is in the snapshot now
+            for name in journals(path):
+                if name != path + ".journal":
+                    os.remove(name)
+            reopen = self._journal is not None
+            if reopen:
+                self._journal.close()
+            with open(path + ".journal", "wb"):
+                pass
+            if reopen:
+                self._journal = open(path + ".journal", "ab")
+
+    def open_journal(self, path, worker=None):
+        """Start appending `record`ed matches to the journal for `path`, or
+        to the journal of process `worker`."""
+
+        name = path + ".journal"
+        if worker is not None:
+            name += "." + worker
+        with self._lock:
+            self._journal = open(name, "ab")
+
+    def record(self, match_ids, start_times):
+        """Append matches which are safely dealt with (written to the
+        database or rejected) to the journal."""
+
+        pairs = np.stack([np.asarray(match_ids, dtype='<i8'),
+                          np.asarray(start_times, dtype='<i8')], axis=1)
+        with self._lock:
+            if self._journal is not None:
+                self._journal.write(pairs.tobytes())
+                self._journal.flush()
+
+    def close(self):
+        """Close the journal."""
+
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _merge(self, new_ids=None, new_times=None):
+        """Merge buffer (and optional arrays) into the sorted arrays, evict
+        old entries. Lock must be held."""
+
+        ids = [self._ids, np.fromiter(self._buffer.keys(), dtype=np.int64,
+                                      count=len(self._buffer))]
+        times = [self._times, np.fromiter(self._buffer.values(),
+                                          dtype=np.int64,
+                                          count=len(self._buffer))]
+        if new_ids is not None:
+            ids.append(new_ids)
+            times.append(new_times)
+        ids = np.concatenate(ids)
+        times = np.concatenate(times)
+        self._buffer = {}
+
+        # Horizon
+        keep = times >= int(time.time()) - self.horizon
+        ids, times = ids[keep], times[keep]
+
+        # Memory ceiling, keep the most recent matches
+        if len(ids) > self.max_size:
+            newest = np.argsort(times, kind='stable')[-self.max_size:]
+            ids, times = ids[newest], times[newest]
+
+        ids, idx = np.unique(ids, return_index=True)
+        self._ids, self._times = ids, times[idx]
+
+
+def journals(path):
+    """Journal files of the snapshot at `path`, the main one first."""
+
+    workers = sorted(glob.glob(glob.escape(path) + ".journal.*"))
+    if os.path.exists(path + ".journal"):
+        return [path + ".journal"] + workers
+    return workers
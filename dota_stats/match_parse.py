@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""Validation and parsing of `GetMatchDetails` responses for `fetch.py`.
+
+A page of matches is parsed in one go with `parse_matches`:
+`validate_matches` applies the filtering conditions to the whole page in
+columnar form, one helper per check, and `parse_players` builds the summary
+of each valid match in a single pass over its players. `parse_match` is the
+single match version.
+"""
+from collections import Counter
+from operator import itemgetter
+import numpy as np
+from dota_stats import meta
+
+MIN_MATCH_LEN = 1200
+
+# Match filters, see `validate_matches`
+VALID_GAME_MODES = ["game_mode_all_pick",
+                    "game_mode_captains_mode",
+                    "game_mode_random_draft",
+                    "game_mode_single_draft",
+                    "game_mode_all_random",
+                    "game_mode_least_played",
+                    "game_mode_captains_draft",
+                    "game_mode_all_draft"]
+VALID_LOBBY_TYPES = [0, 2, 7, 9, 13]
+HERO_IDS = np.array(list(meta.HERO_DICT.keys()))
+PLAYER_REJECTIONS = {1: "Null Hero ID", 3: "Feeding", 4: "No items"}
+
+# Leading columns of a player row, followed by the item and backpack slots
+PLAYER_COLUMNS = ('hero_id', 'player_slot', 'leaver_status', 'kills',
+                  'deaths', 'gold_per_min', 'gold_spent')
+
+PLAYER_FIELDS = [
+    "account_id",
+    "player_slot",
+    "hero_id",
+    "item_0",
+    "item_1",
+    "item_2",
+    "item_3",
+    "item_4",
+    "item_5",
+    "backpack_0",
+    "backpack_1",
+    "backpack_2",
+    "kills",
+    "deaths",
+    "assists",
+    "leaver_status",
+    "last_hits",
+    "denies",
+    "gold_per_min",
+    "xp_per_min",
+    "level",
+    "hero_damage",
+    "tower_damage",
+    "hero_healing",
+    "gold",
+    "gold_spent",
+    "scaled_hero_damage",
+    "scaled_tower_damage",
+    "scaled_hero_healing"
+]
+
+
+class ParseException(Exception):
+    """Used to indicate a parse error in the JSON from Valve API"""
+
+
+def player_fields(player):
+    """Item and backpack keys of a player, in response order. The active
+    items include the neutral item slot when the API reports one."""
+
+    items = tuple(t for t in player.keys() if t[0:4] == 'item')
+    backpack = tuple(t for t in player.keys() if t[0:8] == 'backpack')
+    return items, backpack
+
+
+def parse_players(rows, slots):
+    """Single pass over the player rows (see `PLAYER_COLUMNS`, followed by
+    the item and backpack `slots`) of a validated match. Heroes are sorted by
+    farm once all players have been seen. Returns the radiant and dire
+    heroes and a `dota_match_players` style dictionary per player."""
+
+    radiant = []
+    dire = []
+    players = []
+
+    for row in rows:
+        hero = row[0]
+        if row[1] <= 4:
+            radiant.append((row[5], hero))
+        else:
+            dire.append((row[5], hero))
+
+        # Net worth, active items, then backpack
+        player = dict(zip(slots, row[7:]))
+        player.update(hero=hero, radiant=int(row[1] <= 4),
+                      player_slot=row[1], gold_spent=row[6])
+        players.append(player)
+
+    # Sort heroes by farm -- probably not correct but good first pass
+    radiant.sort(reverse=True)
+    dire.sort(reverse=True)
+
+    return [t for _, t in radiant], [t for _, t in dire], players
+
+
+def reject(result, valid, mask, reason, messages=None):
+    """Record `reason` for the still valid matches in `mask`, which are no
+    longer valid afterwards."""
+
+    for i in np.flatnonzero(valid & mask):
+        result[i] = (reason, reason if messages is None else
+                     "{}: {}".format(reason, messages[i]))
+    valid[mask] = False
+
+
+def check_matches(matches, result, valid):
+    """Match level filters: game mode, duration, lobby type and missing
+    players."""
+
+    modes = [meta.MODE_ENUM[str(m['game_mode'])]['name'] for m in matches]
+    duration = np.array([m['duration'] for m in matches], dtype=np.int64)
+    lobby = np.array([m['lobby_type'] for m in matches], dtype=np.int64)
+
+    reject(result, valid, ~np.isin(modes, VALID_GAME_MODES), "Bad Mode",
+           modes)
+    reject(result, valid, duration < MIN_MATCH_LEN, "Min Length")
+
+    unknown = valid & ~np.isin(lobby, list(meta.LOBBY_ENUM.values()))
+    if unknown.any():
+        raise ValueError("Unknown lobby type: {}".format(
+            matches[np.flatnonzero(unknown)[0]]['match_id']))
+    reject(result, valid, ~np.isin(lobby, VALID_LOBBY_TYPES), "Lobby Type")
+
+    # Bail if Missing players
+    reject(result, valid, np.array([bool(ok) and {} in m['players'] for ok, m
+                                    in zip(valid, matches)]), "Min Players")
+
+
+def player_rows(matches, result, valid):
+    """Store the player rows of the valid matches in `result`. A player with
+    missing fields counts as a missing player. Returns the matches grouped
+    by the layout of the item slots, as {(items, backpack): indexes}."""
+
+    groups = {}
+    for i in np.flatnonzero(valid):
+        players = matches[i]['players']
+        fields = player_fields(players[0]) if players else ((), ())
+        getter = itemgetter(*PLAYER_COLUMNS, *fields[0], *fields[1])
+        try:
+            result[i] = list(map(getter, players))
+        except KeyError:
+            result[i] = ("Min Players", "Min Players")
+            continue
+        groups.setdefault((len(fields[0]), len(fields[1])), []).append(i)
+    return groups
+
+
+def player_codes(cols, num_items):
+    """Player level filters, for each player row the first filter it fails
+    (see `PLAYER_REJECTIONS`, 2 is an unknown hero) or 0."""
+
+    hero, kills, deaths = cols[:, 0], cols[:, 3], cols[:, 4]
+    no_items = np.zeros(len(cols), dtype=bool)
+    if num_items > 0:
+        no_items = (cols[:, 7:7+num_items] == 0).all(axis=1)
+    return np.select([hero == 0, ~np.isin(hero, HERO_IDS),
+                      (deaths > 30) & (kills < 5), no_items],
+                     [1, 2, 3, 4], 0)
+
+
+def check_players(matches, result, idx, layout):
+    """Player level filters (null hero, feeding, no items, leaver) over the
+    player rows of matches `idx`, which share the item slot `layout`."""
+
+    counts = [len(result[i]) for i in idx]
+    owner = np.repeat(np.arange(len(idx)), counts)
+    cols = np.array([row for i in idx for row in result[i]],
+                    dtype=np.int64).reshape(-1, len(PLAYER_COLUMNS) +
+                                            sum(layout))
+    code = player_codes(cols, layout[0])
+
+    # DOTA_LEAVER_NONE = 0;
+    # DOTA_LEAVER_DISCONNECTED = 1;
+    # DOTA_LEAVER_DISCONNECTED_TOO_LONG = 2;
+    # DOTA_LEAVER_ABANDONED = 3;
+    # DOTA_LEAVER_AFK = 4;
+    # DOTA_LEAVER_NEVER_CONNECTED = 5;
+    # DOTA_LEAVER_NEVER_CONNECTED_TOO_LONG = 6;
+    leaver = np.bincount(owner, weights=cols[:, 2] > 1,
+                         minlength=len(idx)) > 0
+
+    # First failing player decides the reason, checked in player order
+    failed = np.flatnonzero(code)
+    first = dict(zip(*np.unique(owner[failed], return_index=True)))
+    for j, i in enumerate(idx):
+        if j in first:
+            reason = int(code[failed[first[j]]])
+            if reason == 2:
+                raise ValueError("Missing hero: {}".format(
+                    matches[i]['match_id']))
+            reason = PLAYER_REJECTIONS[reason]
+            result[i] = (reason, reason)
+        elif leaver[j]:
+            result[i] = ("Leaver", "Leaver")
+
+
+def validate_matches(matches):
+    """Apply the match filters to a page of matches in columnar form. Match
+    level filters (`check_matches`) run first, player level filters
+    (`check_players`) then run over the player rows of the surviving
+    matches. Returns a list with, for each match, either the rejection as
+    (reason, message) or the player rows."""
+
+    result = [None]*len(matches)
+    if len(matches) == 0:
+        return result
+
+    valid = np.ones(len(matches), dtype=bool)
+    check_matches(matches, result, valid)
+    for layout, idx in player_rows(matches, result, valid).items():
+        check_players(matches, result, idx, layout)
+
+    return result
+
+
+def summarize(match, rows):
+    """Summary of a validated match, see `validate_matches`."""
+
+    items, backpack = player_fields(match['players'][0])
+    radiant_heroes, dire_heroes, players = parse_players(rows,
+                                                         items + backpack)
+
+    return {
+        'match_id': match['match_id'],
+        'start_time': match['start_time'],
+        'radiant_heroes': radiant_heroes,
+        'dire_heroes': dire_heroes,
+        'radiant_win': match['radiant_win'],
+        'api_skill': match['api_skill'],
+        'players': players,
+    }
+
+
+def parse_matches(matches):
+    """Parse a page of matches. Returns the summaries of the valid matches
+    and a `Counter` of rejected matches by reason."""
+
+    summaries = []
+    rejections = Counter()
+    for match, result in zip(matches, validate_matches(matches)):
+        if isinstance(result, tuple):
+            rejections[result[0]] += 1
+        else:
+            summaries.append(summarize(match, result))
+
+    return summaries, rejections
+
+
+def parse_match(match):
+    """Parse match info from main API endpoint, raises `ParseException`
+    with the reason if the match is filtered out. Single match version of
+    `parse_matches`.
+    """
+    result = validate_matches([match])[0]
+    if isinstance(result, tuple):
+        raise ParseException(result[1])
+
+    return summarize(match, result)
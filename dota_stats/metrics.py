@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""Prometheus style metrics for the fetch pipeline.
+
+Counters, gauges and histograms live in a `Registry` and are rendered in the
+Prometheus text exposition format, either from a small HTTP endpoint
+(`serve`) or written periodically to a file for the node_exporter textfile
+collector (`TextfileWriter`). Metrics are thread-safe and cheap enough to
+update from the fetch hot path; there is no dependency on
+`prometheus_client`.
+"""
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, suits API requests as well as database writes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Common part of all metric types, values are kept per label set."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("{} takes labels {}".format(
+                self.name, self.label_names))
+        # Label values are strings in the exposition format, and mixed types
+        # (e.g. status 200 and 'error') could not be sorted when rendering
+        return tuple(str(labels[t]) for t in self.label_names)
+
+    def values(self):
+        """Current values as {label values: value}."""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        """Text exposition lines for this metric."""
+
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for key, value in sorted(self.values().items()):
+            lines.append("{}{} {}".format(
+                self.name, _format_labels(self.label_names, key),
+                _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Add `amount` to the count for `labels`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value which goes up and down. A gauge may be backed by a function
+    evaluated on every render, e.g. a queue size."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        """Set the value for `labels`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function, **labels):
+        """Evaluate `function()` for the value of `labels` when rendered."""
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def values(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            values[key] = function()
+        return values
+
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """Record one observation for `labels`."""
+
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0]*len(self.buckets), 0.0]
+            counts = self._values[key]
+            counts[0][idx] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the `with` block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def values(self):
+        with self._lock:
+            return {k: (list(v[0]), v[1]) for k, v in self._values.items()}
+
+    def count(self, **labels):
+        """Number of observations for `labels`."""
+        counts = self.values().get(self._key(labels))
+        return 0 if counts is None else sum(counts[0])
+
+    def quantile(self, fraction, **labels):
+        """Estimate a quantile by linear interpolation within the bucket,
+        as PromQL `histogram_quantile` does."""
+
+        counts = self.values().get(self._key(labels))
+        if counts is None or sum(counts[0]) == 0:
+            return 0.0
+
+        rank = fraction * sum(counts[0])
+        seen = 0
+        for i, count in enumerate(counts[0]):
+            if count > 0 and seen + count >= rank:
+                lower = self.buckets[i-1] if i > 0 else 0.0
+                upper = self.buckets[i]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-2]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for key, (counts, total) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.label_names, key,
+                                              ("le", _format_value(bound))),
+                    cumulative))
+            labels = _format_labels(self.label_names, key)
+            lines.append("{}_sum{} {}".format(self.name, labels,
+                                              _format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, labels,
+                                                cumulative))
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        """Add `metric`, returns it."""
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        """New registered `Counter`."""
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        """New registered `Gauge`."""
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        """New registered `Histogram`."""
+        return self.register(Histogram(name, documentation, labels,
+                                       buckets))
+
+    def render(self):
+        """All metrics in the text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def serve(port, registry=REGISTRY, host=''):
+    """Serve `registry` on http://host:port/metrics from a daemon thread.
+    Returns the server, `shutdown()` stops it."""
+
+    class Handler(BaseHTTPRequestHandler):
+        """Metrics scrape handler"""
+
+        def do_GET(self):    # pylint: disable=invalid-name
+            """Render the registry"""
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):   # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http",
+                     daemon=True).start()
+    return server
+
+
+def write_textfile(path, registry=REGISTRY):
+    """Atomically write `registry` to `path` (textfile collector)."""
+
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as file_handle:
+        file_handle.write(registry.render())
+    os.replace(tmp, path)
+
+
+class TextfileWriter(threading.Thread):
+    """Rewrite a textfile every `interval` seconds until `close`, which
+    writes a final copy."""
+
+    def __init__(self, path, interval=15, registry=REGISTRY):
+        super().__init__(name="metrics-textfile", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            write_textfile(self.path, self.registry)
+
+    def close(self):
+        """Stop and write the final values."""
+        self._stop_event.set()
+        self.join()
+        write_textfile(self.path, self.registry)
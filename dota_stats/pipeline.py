@@ -0,0 +1,910 @@
+# -*- coding: utf-8 -*-
+"""Fetch pipeline shared by the `fetch.py` engines and coordinator workers:
+API requests, deduplication, history sweeps and database writes. The
+thread engine (`fetch_heroes`) lives here as well, the asyncio engine is in
+`fetch_async.py` and coordinator mode in `coordinator.py`.
+
+To avoid duplicate data pulls `fetch.py` loads an index of already fetched
+matches within a time horizon (`match_index.MatchIndex`). Before any detail
+request a match is claimed, first in the index and then in the claim table
+shared by all fetch processes (`crawl_state.ClaimTable`), so each match is
+fetched once across heroes, threads and skill levels. `fetch_heroes`
+creates a ThreadPoolExecutor which is used to parallelize data pulls and
+process. It calls `fetch_matches`, which uses the `GetMatchHistory`
+endpoint to fetch recent matches for a specified `hero` and `skill` level.
+This continues in a loop until no more matches are found.
+
+The matches IDs are passed in the `process_matches` along with some metadata
+and the executor. The internal dictionary is updated to prevent "re-pulls" of
+matches. `process_matches` calls `process_match` in either a single thread or
+multiple threads depending on the multithreading setup. This is point at which
+the process is parallelized. `process_match` calls `fetch_match` to grab a
+single match from the API. Once the page is fetched, `summarize_page` parses
+it in one go with `match_parse.parse_matches`. Rejections are counted by
+reason and reported at the end of the run.
+
+Control is returned to `process_matches` and valid matches are handed to
+the `MatchWriter` thread, which drains them from a bounded queue and writes
+them into the database in batches with `write_matches`. Fetching the next
+page therefore overlaps with database writes, and the fetch blocks if the
+database falls behind.
+"""
+import time
+import logging
+import os
+import sys
+import json
+import queue
+import asyncio
+import threading
+from collections import Counter
+from functools import partial
+from concurrent import futures
+import datetime as dt
+import requests
+import numpy as np
+from dota_stats import meta, metrics
+from dota_stats.db_util import Match, MatchPlayer, ITEM_SLOTS, \
+    get_session, remove_sessions, upsert_rows, lineup_columns, \
+    advance_watermark, mark_dirty_hours, existing_matches, win_rate_deltas, \
+    apply_win_rate_deltas
+from dota_stats.rate_limit import AdaptiveRateLimiter
+from dota_stats.match_index import MatchIndex
+from dota_stats.match_parse import VALID_LOBBY_TYPES, parse_matches
+from dota_stats.crawl_state import ClaimTable, CheckpointTable
+from dota_stats.response_cache import ResponseCache, normalize_url
+
+try:
+    import orjson
+except ImportError:     # Optional faster decoder, falls back to stdlib
+    orjson = None
+
+
+# Globals
+API_URL = os.environ.get('DOTA_API_URL', 'https://api.steampowered.com')
+NUM_THREADS = int(os.environ['DOTA_THREADS'])    # 1 = single threaded
+WRITE_BATCH = int(os.environ.get('DOTA_WRITE_BATCH', 0))  # 0 = row by row
+WIN_RATE_STREAM = int(os.environ.get('DOTA_WIN_RATE_STREAM', 0)) != 0
+WRITE_QUEUE = 5000      # Parsed matches held before the fetch blocks
+MAX_MATCH_LEN = 4*3600  # Seconds a sweep looks back past the previous one
+MATCH_HORIZON = 7      # Days a fetched match is remembered for
+MATCH_MAX = int(os.environ.get('DOTA_MATCH_MAX', 2000000))  # Index ceiling
+CLAIM_TIME = 1800      # Seconds a match claim lasts until it is written
+LIVE_ENDPOINTS = {'GetMatchHistory'}  # Responses recorded but never served
+
+HEADERS = {
+    'Accept': 'gzip',
+    'Content-Encoding': 'gzip',
+    'Content-Type': 'application/json',
+}
+
+# Shared HTTP session so connections (and TLS handshakes) are re-used between
+# requests, sized so every worker thread can hold a connection.
+HTTP = requests.Session()
+HTTP.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=max(NUM_THREADS, 10)))
+
+# Globals used in multi-threading
+MATCH_IDS = MatchIndex(MATCH_HORIZON*24*3600, max_size=MATCH_MAX)
+CLAIMS = ClaimTable()
+CHECKPOINTS = CheckpointTable()
+RESPONSES = ResponseCache()
+
+# Process wide limiter shared by every call to the Steam API
+LIMITER = AdaptiveRateLimiter(
+    rate=float(os.environ.get('DOTA_RATE', 10)),
+    max_rate=float(os.environ.get('DOTA_MAX_RATE', 100)))
+
+# Metrics, exposed with --metrics-port/--metrics-file
+API_REQUESTS = metrics.REGISTRY.counter(
+    'dota_fetch_api_requests_total', 'Steam API requests by endpoint and '
+    'HTTP status (error = no response)', ('endpoint', 'status'))
+API_LATENCY = metrics.REGISTRY.histogram(
+    'dota_fetch_api_latency_seconds', 'Steam API request latency',
+    ('endpoint',))
+CACHE_HITS = metrics.REGISTRY.counter(
+    'dota_fetch_response_cache_hits_total', 'API responses served from the '
+    'response cache', ('endpoint',))
+HISTORY_EMPTY = metrics.REGISTRY.counter(
+    'dota_fetch_history_empty_total', 'Empty GetMatchHistory pages retried')
+MATCH_NOT_FOUND = metrics.REGISTRY.counter(
+    'dota_fetch_match_not_found_total', 'GetMatchDetails responses without '
+    'match data')
+DEDUP = metrics.REGISTRY.counter(
+    'dota_fetch_dedup_total', 'History matches by deduplication result (seen '
+    'in the index, claimed by another process, new)', ('result',))
+PARSED = metrics.REGISTRY.counter(
+    'dota_fetch_matches_parsed_total', 'Matches by filter stage and result '
+    '(valid or rejection reason)', ('stage', 'result'))
+PARSE_SECONDS = metrics.REGISTRY.histogram(
+    'dota_fetch_parse_seconds', 'Time to parse a page of match details')
+WRITE_SECONDS = metrics.REGISTRY.histogram(
+    'dota_fetch_db_write_seconds', 'Time per database write batch')
+WRITTEN = metrics.REGISTRY.counter(
+    'dota_fetch_matches_written_total', 'Matches written to the database')
+WRITE_QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'dota_fetch_write_queue_depth', 'Summaries waiting for the database '
+    'writer')
+metrics.REGISTRY.gauge(
+    'dota_fetch_rate_limit', 'Current API rate limit, requests/second'
+).set_function(lambda: LIMITER.rate)
+metrics.REGISTRY.gauge(
+    'dota_fetch_rate_limit_waiting', 'Requests waiting on the rate limiter'
+).set_function(lambda: LIMITER.waiting)
+metrics.REGISTRY.gauge(
+    'dota_fetch_match_index_size', 'Matches in the index of seen matches'
+).set_function(lambda: len(MATCH_IDS))
+
+
+# Logging
+log = logging.getLogger("dota")
+if int(os.environ['DOTA_LOGGING']) == 0:
+    log.setLevel(logging.INFO)
+else:
+    log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler(sys.stdout)
+fmt = logging.Formatter(
+        fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt="%Y-%m-%dT%H:%M:%S %Z")
+ch.setFormatter(fmt)
+log.addHandler(ch)
+
+
+class APIException(Exception):
+    """Used to indicate an error fetching from the Valve API"""
+
+
+class LeaseLost(Exception):
+    """Raised from `on_page` when a work unit has been leased to another
+    worker, the unit is abandoned"""
+
+
+def sleep_schedule():
+    """Randomized back-off schedule used by the fetch retry loops."""
+
+    schedule = np.logspace(-0.5, 3, 20)
+    schedule += schedule*np.random.rand(20)
+    return [np.random.uniform(0.3*sleep, 0.7*sleep) for sleep in schedule]
+
+
+def decode_json(content):
+    """Decode a raw (bytes) API response, with orjson if it is installed."""
+
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def parse_result(content):
+    """Returns the `result` section of a successful response body."""
+
+    resp_json = decode_json(content)
+    if 'error' in resp_json['result']:
+        raise APIException(resp_json['result']['error'])
+    return resp_json['result']
+
+
+def endpoint_name(url):
+    """API method of a request URL, e.g. GetMatchDetails."""
+    return url.split("?")[0].rstrip("/").split("/")[-2]
+
+
+def cached_result(url):
+    """Result for `url` from the response cache, None if it is not cached.
+    History pages change as matches finish, outside replay mode they are
+    stored for corpora but never served. In replay mode a request missing
+    from the corpus is an error."""
+
+    if not RESPONSES.replay and endpoint_name(url) in LIVE_ENDPOINTS:
+        return None
+
+    content = RESPONSES.get(url)
+    if content is not None:
+        CACHE_HITS.inc(endpoint=endpoint_name(url))
+        return parse_result(content)
+    if RESPONSES.replay:
+        raise APIException("Not in response corpus: {}".format(
+            normalize_url(url)))
+    return None
+
+
+def parse_response(status_code, content, reason, sent=None):
+    """Handle a raw API response to a request sent at `sent` (monotonic).
+    Returns the `result` section of the JSON, or None if the request should
+    be retried."""
+
+    LIMITER.record(status_code, sent)
+
+    # Normal response
+    if status_code == 200:
+        return parse_result(content)
+
+    # Error handling, throttling is handled by the rate limiter so these
+    # can be retried straight away.
+    if status_code == 429:
+        log.error("Too many requests")
+    elif status_code == 503:
+        log.error("Service unavailable")
+    elif status_code == 403:
+        raise APIException("Forbidden - Check Steam API key")
+    else:
+        log.error("Unknown repsonse %d %s", status_code, reason)
+
+    return None
+
+
+def record_response(url, sent, status_code, content, reason):
+    """Count a response to `url`, sent at `sent` (monotonic), and handle it
+    with `parse_response`. Successful responses go into the response
+    cache."""
+
+    endpoint = endpoint_name(url)
+    API_LATENCY.observe(time.monotonic() - sent, endpoint=endpoint)
+    API_REQUESTS.inc(endpoint=endpoint, status=status_code)
+    result = parse_response(status_code, content, reason, sent)
+    if result is not None:
+        RESPONSES.put(url, content)
+    return result
+
+
+def details_url(match_id):
+    """`GetMatchDetails` request for `match_id`."""
+
+    url = API_URL + "/IDOTA2Match_570/"
+    url += "GetMatchDetails/V001/?key={0}&match_id={1}"
+    return url.format(os.environ['STEAM_KEY'], match_id)
+
+
+def history_url(skill, start_at_match_id, hero):
+    """`GetMatchHistory` request for the page of `hero` matches at `skill`
+    starting at `start_at_match_id`."""
+
+    url = API_URL + "/IDOTA2Match_570/GetMatchHistory/"
+    url += "V001/?key={0}&skill={1}&start_at_match_id={2}&hero_id={3}"
+    return url.format(os.environ["STEAM_KEY"], skill, start_at_match_id, hero)
+
+
+def fetch_url(url):
+    """Simple wait loop around fetching to deal with things like network
+    outages, etc... Requests are paced by `LIMITER`, the back-off schedule
+    only applies after network errors and unexpected responses."""
+
+    result = cached_result(url)
+    if result is not None:
+        return result
+
+    backoff = 0
+    for sleep in sleep_schedule():
+        time.sleep(backoff)
+        LIMITER.acquire()
+        backoff = sleep
+        sent = time.monotonic()
+        try:
+            resp = HTTP.get(url, headers=HEADERS, timeout=60)
+        except requests.exceptions.ConnectionError as conn_error:
+            API_REQUESTS.inc(endpoint=endpoint_name(url), status='error')
+            log.error("Connection error: %r", conn_error)
+        except requests.exceptions.ReadTimeout as timeout_error:
+            API_REQUESTS.inc(endpoint=endpoint_name(url), status='error')
+            log.error("Timeout error: %r", timeout_error)
+        else:
+            result = record_response(url, sent, resp.status_code,
+                                     resp.content, resp.reason)
+            if result is not None:
+                return result
+            if resp.status_code in (429, 503):
+                backoff = 0
+
+    raise ValueError("Could not fetch (timeout?): {}".format(url))
+
+
+def check_match(match, match_id, skill):
+    """Tag the match with `skill` and check the details response. If
+    something went wrong, log to file and raise."""
+
+    match['api_skill'] = skill
+
+    if 'start_time' not in match.keys():
+        if not os.path.exists('error'):
+            os.makedirs('error')
+        with open("./error/{}.json".format(match_id), "w") as file_handle:
+            file_handle.write(json.dumps(match))
+        raise APIException("Bad match JSON {}".format(match_id))
+
+    return match
+
+
+def fetch_match(match_id, skill):
+    """Skill is optional, this simply sets an object in the json
+    for reference"""
+
+    url = details_url(match_id)
+
+    match = {}
+    for _ in range(10):
+        match = fetch_url(url)
+        if 'start_time' in match.keys() or RESPONSES.replay:
+            break
+
+        log.error("Match ID not found: %s", str(match_id))
+        MATCH_NOT_FOUND.inc()
+        RESPONSES.evict(url)
+        time.sleep(1)
+
+    return check_match(match, match_id, skill)
+
+
+def process_match(skill, match_id):
+    """Fetch a single match, used by the multi-threading engine. Returns None
+    on API errors."""
+
+    try:
+        return fetch_match(match_id, skill)
+    except APIException as e_msg:
+        log.error("{0:30.30} {1}". format("API Error", str(e_msg)))
+        return None
+
+
+def summarize_page(match_ids, matches, hero, skill):
+    """Parse a page of fetched matches (None for failed fetches) of
+    `match_ids`, returning the summaries of the valid ones. Rejections are
+    counted in `PARSED` and the rejected matches are recorded as dealt with
+    in `MATCH_IDS`, failed fetches are released for another try."""
+
+    release_matches([i for i, m in zip(match_ids, matches) if m is None])
+    matches = [m for m in matches if m is not None]
+    with PARSE_SECONDS.time():
+        summaries, rejections = parse_matches(matches)
+    for reason, count in rejections.items():
+        PARSED.inc(count, stage='details', result=reason)
+    PARSED.inc(len(summaries), stage='details', result='Valid')
+
+    valid = {t['match_id'] for t in summaries}
+    rejected = [m for m in matches if m['match_id'] not in valid]
+    if rejected:
+        CLAIMS.confirm([m['match_id'] for m in rejected])
+        MATCH_IDS.record([m['match_id'] for m in rejected],
+                         [m['start_time'] for m in rejected])
+
+    log.debug("Hero %3d skill %d: %d valid, rejected %s", hero, skill,
+              len(summaries), dict(rejections))
+    return summaries
+
+
+def log_rejections():
+    """Log the share of fetched matches discarded, by reason."""
+
+    totals = Counter()
+    for (_, reason), count in PARSED.values().items():
+        totals[reason] += count
+
+    total = sum(totals.values())
+    if total == 0:
+        return
+    for reason, count in totals.most_common():
+        log.info("{0:20} {1:8d} {2:6.1%}".format(reason, count,
+                                                 count / total))
+
+
+def match_to_row(summary):
+    """Convert a parsed match summary into a `dota_matches` row."""
+
+    row = {
+        'match_id': summary['match_id'],
+        'start_time': summary['start_time'],
+        'radiant_win': summary['radiant_win'],
+        'api_skill': summary['api_skill'],
+    }
+    row.update(lineup_columns(summary['radiant_heroes'],
+                              summary['dire_heroes']))
+    return row
+
+
+def match_to_player_rows(summary):
+    """Convert a parsed match summary into `dota_match_players` rows, slots
+    the API did not report are NULL."""
+
+    rows = []
+    for player in summary['players']:
+        row = {
+            'match_id': summary['match_id'],
+            'hero': player['hero'],
+            'start_time': summary['start_time'],
+            'radiant': player['radiant'],
+            'player_slot': player['player_slot'],
+            'gold_spent': player['gold_spent'],
+        }
+        row.update((t, player.get(t)) for t in ITEM_SLOTS)
+        rows.append(row)
+    return rows
+
+
+def write_matches(session, matches, batch_size=None, stream=None):
+    """Write matches and their players to database. If `batch_size`
+    (default `WRITE_BATCH`) is set, matches are upserted `batch_size` matches
+    per statement in a single transaction, otherwise each match is merged
+    and committed on its own. Players are written before their match, a
+    match row always has its players. Once the matches are written their
+    win rate hour buckets are flagged and the start time watermark is
+    advanced.
+
+    If `stream` (default `WIN_RATE_STREAM`) is set, matches not yet in the
+    database are also added onto their `dota_hero_win_rate` buckets.
+    """
+    if batch_size is None:
+        batch_size = WRITE_BATCH
+    if stream is None:
+        stream = WIN_RATE_STREAM
+    if not matches:
+        return
+
+    new = {}
+    if stream:
+        existing = existing_matches(session, [t['match_id'] for t in matches])
+        new = {t['match_id']: t for t in matches
+               if t['match_id'] not in existing}
+
+    if batch_size > 0:
+        upsert_rows(session, MatchPlayer.__table__,
+                    [row for summary in matches for row in
+                     match_to_player_rows(summary)],
+                    batch_size * 10)
+        upsert_rows(session, Match.__table__,
+                    [match_to_row(summary) for summary in matches],
+                    batch_size)
+    else:
+        for summary in matches:
+            # pylint: disable=no-member
+            for row in match_to_player_rows(summary):
+                session.merge(MatchPlayer(**row))
+            session.merge(Match(**match_to_row(summary)))
+            session.commit()
+            # pylint: enable=no-member
+
+    # Hours are flagged before the deltas in case applying them fails, and
+    # again after so a batch aggregation which read the matches before the
+    # deltas landed (counting them twice) is redone.
+    hours = [(t['start_time'], t['api_skill']) for t in matches]
+    if stream:
+        mark_dirty_hours(session, hours)
+        apply_win_rate_deltas(session, win_rate_deltas(new.values()))
+    mark_dirty_hours(session, hours)
+    advance_watermark(session, max(t['start_time'] for t in matches))
+
+
+class MatchWriter(threading.Thread):
+    """Dedicated database writer thread. Fetch workers `put` parsed summaries
+    onto a bounded queue which is drained in batches, `put` blocks while the
+    queue is full so the fetch cannot run away from the database. `close`
+    flushes everything still queued before returning. Once a write fails the
+    writer stops accepting work: `put` raises the error and whatever is
+    still queued is released rather than written.
+    """
+
+    _STOP = object()
+
+    def __init__(self, batch_size=None, max_queue=WRITE_QUEUE):
+        super().__init__(name="match-writer", daemon=True)
+        if batch_size is None:
+            batch_size = WRITE_BATCH
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.write_time = 0.0
+        self.error = None
+
+    def put(self, summary):
+        """Queue a summary for writing, blocks while the queue is full."""
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(summary, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    async def put_async(self, summary):
+        """Queue a summary from the event loop without blocking it."""
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put_nowait(summary)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.05)
+
+    def _next_batch(self):
+        """Block for the next item then take whatever else is queued."""
+        batch = [self.queue.get()]
+        WRITE_QUEUE_DEPTH.set(self.queue.qsize())
+        while len(batch) < max(self.batch_size, 100):
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def after_write(self, callback):
+        """Call `callback` from the writer thread once everything queued so
+        far is committed. It is never called if a write has failed."""
+        self.put(callback)
+
+    async def after_write_async(self, callback):
+        """Asyncio version of `after_write`."""
+        await self.put_async(callback)
+
+    def run(self):
+        # Sessions are not thread safe, the writer has its own
+        session = get_session()
+
+        stopped = False
+        while not stopped:
+            batch = []
+            for item in self._next_batch():
+                if item is self._STOP:
+                    stopped = True
+                elif callable(item):
+                    self._write(session, batch)
+                    batch = []
+                    self._call(item)
+                else:
+                    batch.append(item)
+            self._write(session, batch)
+
+        remove_sessions()
+
+    def _write(self, session, batch):
+        """Write a batch of summaries, or release them once writing has
+        failed."""
+
+        if not batch:
+            return
+        if self.error is not None:
+            # Queued before producers saw the error, fetch them again
+            release_matches([t['match_id'] for t in batch])
+            return
+
+        try:
+            start = time.monotonic()
+            write_matches(session, batch, self.batch_size)
+            elapsed = time.monotonic() - start
+            WRITE_SECONDS.observe(elapsed)
+            WRITTEN.inc(len(batch))
+            self.write_time += elapsed
+            self.written += len(batch)
+            CLAIMS.confirm([t['match_id'] for t in batch])
+            MATCH_IDS.record([t['match_id'] for t in batch],
+                             [t['start_time'] for t in batch])
+        except Exception as e_msg:   # pylint: disable=broad-except
+            # Keep draining so producers don't block forever, the error
+            # is raised to them on the next `put` and from `close`.
+            log.error("Database write failed: %r", e_msg)
+            session.rollback()
+            self.error = e_msg
+            release_matches([t['match_id'] for t in batch])
+
+    def _call(self, callback):
+        """Run an `after_write` callback, a failure stops the writer like a
+        failed write."""
+
+        if self.error is not None:
+            return
+        try:
+            callback()
+        except Exception as e_msg:   # pylint: disable=broad-except
+            log.error("Write callback failed: %r", e_msg)
+            self.error = e_msg
+
+    def close(self):
+        """Flush remaining summaries and stop the thread."""
+        self.queue.put(self._STOP)
+        self.join()
+        log.info("%d matches written to database", self.written)
+        if self.error is not None:
+            raise self.error
+
+
+def prefilter_matches(matches):
+    """Drop `GetMatchHistory` entries which cannot pass `parse_match`, using
+    the lobby type and player list of the history page, before any detail
+    request is made. Dropped matches are counted in `PARSED` and
+    recorded as dealt with in `MATCH_IDS`. Unknown lobby types and heroes go
+    through, `validate_matches` raises on those."""
+
+    if not matches:
+        return matches
+
+    lobby = np.array([m.get('lobby_type', 0) for m in matches])
+    known = np.isin(lobby, list(meta.LOBBY_ENUM.values()))
+    reasons = np.where(known & ~np.isin(lobby, VALID_LOBBY_TYPES),
+                       "Lobby Type", "").astype(object)
+
+    # Players as listed on the history page, only hero ID and slot
+    for i, match in enumerate(matches):
+        players = match.get('players', [])
+        if reasons[i] or not players:
+            continue
+        if {} in players:
+            reasons[i] = "Min Players"
+        elif min(t.get('hero_id', -1) for t in players) == 0:
+            reasons[i] = "Null Hero ID"
+
+    keep = reasons == ""
+    if keep.all():
+        return matches
+
+    for reason, count in Counter(reasons[~keep].tolist()).items():
+        PARSED.inc(count, stage='history', result=reason)
+    rejected = [m for m, k in zip(matches, keep) if not k]
+    MATCH_IDS.record([m['match_id'] for m in rejected],
+                     [m['start_time'] for m in rejected])
+    log.info("%d matches rejected from history metadata", len(rejected))
+
+    return [m for m, k in zip(matches, keep) if k]
+
+
+def claim_matches(matches, sweep):
+    """Claim matches from a `GetMatchHistory` page of `sweep`, returning the
+    match IDs this worker should fetch. A match is skipped if it is already
+    in `MATCH_IDS` or has been claimed by another fetch process. Claims are
+    confirmed once the match is written, see `release_matches` otherwise.
+    The matches claimed, here or by another process, are held back by
+    `sweep` until they are written."""
+
+    log.debug("%d matches for processing", len(matches))
+    num_matches = len(matches)
+    matches = [m for m in matches if MATCH_IDS.add(m['match_id'],
+                                                   m['start_time'])]
+    DEDUP.inc(num_matches - len(matches), result='seen')
+    matches = prefilter_matches(matches)
+    sweep.hold(matches)
+    match_ids = CLAIMS.claim([m['match_id'] for m in matches],
+                             [m['start_time'] for m in matches], CLAIM_TIME)
+
+    # Held by another process, which may still fail to write them
+    owned = set(match_ids)
+    MATCH_IDS.discard([m['match_id'] for m in matches
+                       if m['match_id'] not in owned])
+    DEDUP.inc(len(matches) - len(match_ids), result='claimed')
+    DEDUP.inc(len(match_ids), result='new')
+    log.info("%d matches after removing duplicates.", len(match_ids))
+
+    return match_ids
+
+
+def release_matches(match_ids):
+    """Hand back claimed matches which were not written, so this or another
+    fetch process tries them again."""
+
+    if match_ids:
+        log.info("%d claimed matches released", len(match_ids))
+        CLAIMS.release(match_ids)
+        MATCH_IDS.discard(match_ids)
+
+
+def process_matches(writer, matches, sweep, executor):
+    """Loop over a page of matches of `sweep`, parsing JSON output and
+    queueing valid matches for the database writer.
+    """
+    hero, skill = sweep.hero, sweep.skill
+    match_ids = claim_matches(matches, sweep)
+
+    if NUM_THREADS == 1:
+        matches = [process_match(skill, match_id) for match_id in match_ids]
+    else:
+        f_p = partial(process_match, skill)
+        matches = executor.map(f_p, match_ids, timeout=3600)
+
+    summaries = summarize_page(match_ids, list(matches), hero, skill)
+    for summary in summaries:
+        writer.put(summary)
+
+    log.info("%d valid matches queued for database (%d waiting)",
+             len(summaries), writer.queue.qsize())
+
+
+def fetch_matches_loop(skill, start_at_match_id, hero):
+    """Loop until we find matches. There is a bug in valve API with load
+    balancing, sometimes the API returns no matches, so we'll re-try a few
+    times if we expect more matches.
+    """
+    url = history_url(skill, start_at_match_id, hero)
+
+    resp = {}
+    for retry in range(20):
+        resp = fetch_url(url)
+
+        log.error("num_results (try %d) %d", retry, resp['num_results'])
+
+        # If we found results, break out of loop
+        if resp['num_results'] > 0 or RESPONSES.replay:
+            break
+
+        HISTORY_EMPTY.inc()
+        RESPONSES.evict(url)
+        time.sleep(1)
+
+    return resp
+
+
+class HistorySweep:
+    """Position of a backward sweep over the match history of a (hero,
+    skill), persisted in `CHECKPOINTS`. A sweep resumes an unfinished one
+    where it left off. Otherwise it pages back until matches started more
+    than MAX_MATCH_LEN before the last completed sweep did: the history is
+    listed as matches finish, a match in progress then may show up below
+    matches that sweep already saw. Matches seen twice are dropped by
+    `MATCH_IDS` and `CLAIMS`.
+
+    Matches the sweep has claimed, or found claimed by another process,
+    are held back until some process has written them: the checkpoint
+    does not move below them, and the next sweep looks back far enough to
+    see them again. A match released after a failed fetch, or claimed by
+    a process which then failed, is therefore not lost."""
+
+    def __init__(self, hero, skill):
+        self.hero = hero
+        self.skill = skill
+        self.held = {}      # Start time by match ID of the matches held back
+        swept, started, cursor = CHECKPOINTS.get(hero, skill)
+        self.started = started or time.time()
+        self.oldest = 0 if swept is None else swept - MAX_MATCH_LEN
+        self.start_at_match_id = cursor or 9999999999
+        self.done = False
+        if cursor is not None:
+            log.info("Resuming sweep at match ID %d", cursor)
+
+    def page(self, resp):
+        """Advance past a `GetMatchHistory` page, returns the matches which
+        may have finished since the last completed sweep."""
+
+        matches = resp['matches'] if resp['num_results'] > 0 else []
+        if matches:
+            self.start_at_match_id = min(t['match_id'] for t in matches)-1
+
+        new = [t for t in matches if t['start_time'] >= self.oldest]
+        if len(new) < len(matches):
+            log.info("Reached checkpoint (started %s)",
+                     dt.datetime.utcfromtimestamp(self.oldest).isoformat())
+            self.done = True
+        elif resp['results_remaining'] == 0:
+            self.done = True
+        else:
+            log.info("Remaining %d (Match ID %d)", resp['results_remaining'],
+                     self.start_at_match_id)
+        return new
+
+    def hold(self, matches):
+        """Hold back `GetMatchHistory` matches until they are written."""
+        self.held.update({t['match_id']: t['start_time'] for t in matches})
+
+    def _unwritten(self):
+        """Matches held back which no process has written yet, as start time
+        by match ID, the others are let go. Called from the writer thread,
+        the dict is only updated and copied whole."""
+
+        held = self.held.copy()
+        unwritten = set(CLAIMS.pending(list(held)))
+        for match_id in set(held) - unwritten:
+            self.held.pop(match_id, None)
+        return {t: held[t] for t in unwritten}
+
+    def checkpoint(self, cursor):
+        """Everything above `cursor` has been dealt with, see
+        `MatchWriter.after_write`, except for the matches held back. The
+        checkpoint stays at the newest of those."""
+
+        cursor = max([cursor] + list(self._unwritten()))
+        CHECKPOINTS.advance(self.hero, self.skill, self.started, cursor)
+
+    def finish(self):
+        """Sweep complete, the next one looks back from its start, or from
+        the oldest match still held back."""
+
+        started = min([self.started] + list(self._unwritten().values()))
+        CHECKPOINTS.finish(self.hero, self.skill, started)
+
+
+def fetch_matches(writer, hero, skill, executor, on_page=None):
+    """Gets list of matches by page. This is just the index, not the
+    individual match results. `on_page(pages, matches)` is called after each
+    page with running totals.
+    """
+    counter = 1
+    num_matches = 0
+    start = time.time()
+    sweep = HistorySweep(hero, skill)
+
+    while not sweep.done:
+        log.info("Fetching more matches: %d", counter)
+
+        resp = fetch_matches_loop(skill, sweep.start_at_match_id, hero)
+
+        matches = sweep.page(resp)
+        if matches:
+            process_matches(writer, matches, sweep, executor)
+        writer.after_write(partial(sweep.checkpoint,
+                                   sweep.start_at_match_id))
+        log.debug("Rate limit %(rate).2f/s, %(waiting)d waiting",
+                  LIMITER.stats())
+
+        num_matches += len(resp['matches'])
+        if on_page is not None:
+            on_page(counter, num_matches)
+
+        counter = counter+1
+
+    writer.after_write(sweep.finish)
+
+    mpm = str(60*counter/(time.time()-start))
+    log.debug("Matches per minute: %s", mpm)
+
+
+def unit_callback(on_page, hero, skill):
+    """Per page callback `on_page(hero, skill, pages, matches)` bound to a
+    single (hero, skill) unit."""
+    return None if on_page is None else partial(on_page, hero, skill)
+
+
+def fetch_heroes(writer, units, on_page=None):
+    """Main loop over (hero, skill) `units` for the thread engine. Create the
+    thread pool now to prevent constant creation and destruction of threads.
+    """
+
+    executor = futures.ThreadPoolExecutor(max_workers=int(NUM_THREADS))
+    counter = 1
+
+    for hero, skill in units:
+        log.info("---------------------------------------------------------")
+        log.info(">>>>>>>> Hero: %s %d Skill: %d <<<<<<<<",
+                 meta.HERO_DICT[hero], counter, skill)
+        log.info("---------------------------------------------------------")
+        try:
+            fetch_matches(writer, hero, skill, executor,
+                          unit_callback(on_page, hero, skill))
+        except LeaseLost:
+            log.error("Lease lost: hero %d skill %d", hero, skill)
+        counter += 1
+
+    executor.shutdown()
+
+
+def start_metrics(opts, worker=None):
+    """Expose metrics as asked for on the command line. Coordinator worker
+    number `worker` serves on the port after the coordinator's plus
+    `worker` and writes its own textfile. Returns the textfile writer, if
+    any."""
+
+    if opts.metrics_port:
+        port = opts.metrics_port
+        if worker is not None:
+            port += 1 + worker
+        metrics.serve(port)
+        log.info("Metrics on port %d", port)
+
+    if not opts.metrics_file:
+        return None
+
+    path = opts.metrics_file
+    if worker is not None:
+        root, ext = os.path.splitext(path)
+        path = "{}_w{}{}".format(root, worker, ext)
+    textfile = metrics.TextfileWriter(path)
+    textfile.start()
+    return textfile
+
+
+def index_path(opts):
+    """Snapshot of `MATCH_IDS` for the skill level of the run."""
+    return os.path.join(opts.cache_dir, "seen_{}.npy".format(opts.skill))
+
+
+def close_state():
+    """Close the index of seen matches, the claims and the checkpoints once
+    the writer has stopped."""
+
+    MATCH_IDS.close()
+    CLAIMS.close()
+    CHECKPOINTS.close()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Adaptive token bucket used to pace calls to the Steam API.
+
+The bucket refills at `rate` tokens per second. Every successful response
+increases the rate additively and throttling responses (429/503) cut it
+multiplicatively, so the crawl settles just under whatever rate the API is
+currently willing to serve. Responses to requests sent before the last cut
+do not cut again, a burst of concurrent 429s reflects the rate at which
+they were sent and only counts once. A single instance is shared by every
+thread (and the event loop) in a process.
+"""
+import asyncio
+import threading
+import time
+
+
+class AdaptiveRateLimiter:
+    """Thread-safe additive increase, multiplicative decrease token bucket.
+
+        rate:       initial requests per second
+        min_rate:   floor for the rate after repeated throttling
+        max_rate:   ceiling for the rate after repeated success
+        burst:      maximum number of tokens held by the bucket
+        increase:   requests per second added for each success
+    """
+
+    def __init__(self, rate, min_rate=0.1, max_rate=100.0, burst=10,
+                 increase=0.05):
+        self._lock = threading.Lock()
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.burst = float(burst)
+        self.increase = float(increase)
+        self.waiting = 0
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._decreased = float('-inf')
+
+    def _refill(self):
+        """Add tokens accumulated since last call, lock must be held."""
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self):
+        """Take a token and return the number of seconds the caller has to
+        wait before using it. Tokens may go negative, callers queue up behind
+        each other in reservation order."""
+
+        with self._lock:
+            self._refill()
+            self._tokens -= 1.0
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Block the calling thread until a request may be made."""
+
+        wait = self.reserve()
+        if wait > 0:
+            self._add_waiting(1)
+            try:
+                time.sleep(wait)
+            finally:
+                self._add_waiting(-1)
+
+    async def acquire_async(self):
+        """Asyncio version of `acquire`."""
+
+        wait = self.reserve()
+        if wait > 0:
+            self._add_waiting(1)
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._add_waiting(-1)
+
+    def _add_waiting(self, delta):
+        with self._lock:
+            self.waiting += delta
+
+    def record(self, status_code, sent=None):
+        """Adapt the rate to an HTTP status code. `sent` is the
+        `time.monotonic()` at which the request went out, throttling of a
+        request sent before the previous decrease is ignored."""
+
+        with self._lock:
+            self._refill()
+            if status_code == 200:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            elif status_code in (429, 503):
+                if sent is not None and sent < self._decreased:
+                    return
+                factor = 0.5 if status_code == 429 else 0.75
+                self.rate = max(self.min_rate, self.rate * factor)
+                self._tokens = min(self._tokens, 0.0)
+                self._decreased = time.monotonic()
+
+    def stats(self):
+        """Current rate (requests/second) and number of callers queued."""
+
+        with self._lock:
+            return {'rate': self.rate, 'waiting': self.waiting}
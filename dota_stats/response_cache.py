@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of Steam API responses used by `fetch.py`.
+
+Responses are stored under the SHA-256 of the normalized request URL: scheme
+and host are dropped, the query is sorted and the API key is removed, so the
+same request made with a different key or against a different API host maps
+to the same entry. Entries are the raw response bodies, sharded into
+sub-directories by the first two hex digits of the hash.
+
+In normal mode an entry older than `ttl` seconds is treated as missing and
+refetched. In replay mode the cache is a recorded corpus: entries never
+expire and a request which is not in the corpus fails instead of going out
+to the network.
+"""
+import os
+import time
+import hashlib
+import tempfile
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+
+def normalize_url(url):
+    """Path and sorted query of `url` without the API key."""
+
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query) if k != 'key')
+    return parts.path.rstrip('/') + '?' + urlencode(query)
+
+
+class ResponseCache:
+    """Response cache, does nothing until `open` is called.
+
+        ttl:        seconds an entry is served for, None = forever
+        replay:     serve only from the cache, never from the network
+    """
+
+    def __init__(self):
+        self.path = None
+        self.ttl = None
+        self.replay = False
+
+    @property
+    def enabled(self):
+        """True once `open` has been called."""
+        return self.path is not None
+
+    def open(self, path, ttl=None, replay=False):
+        """Use the cache (or corpus, if `replay`) in directory `path`."""
+
+        if not replay and not os.path.exists(path):
+            os.makedirs(path)
+        if replay and not os.path.isdir(path):
+            raise ValueError("No response corpus at {}".format(path))
+        self.path = path
+        self.ttl = ttl
+        self.replay = replay
+
+    def entry(self, url):
+        """File holding the response for `url`."""
+
+        digest = hashlib.sha256(normalize_url(url).encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, url):
+        """Cached response body for `url`, or None."""
+
+        if self.path is None:
+            return None
+
+        entry = self.entry(url)
+        try:
+            if not self.replay and self.ttl is not None and \
+                    time.time() - os.path.getmtime(entry) > self.ttl:
+                return None
+            with open(entry, "rb") as file_handle:
+                return file_handle.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, content):
+        """Store the response body for `url`, replay corpora are read-only."""
+
+        if self.path is None or self.replay:
+            return
+
+        entry = self.entry(url)
+        directory = os.path.dirname(entry)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first, readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as file_handle:
+            file_handle.write(content)
+        os.replace(tmp, entry)
+
+    def evict(self, url):
+        """Drop the entry for `url`, e.g. an incomplete response."""
+
+        if self.path is None or self.replay:
+            return
+        try:
+            os.remove(self.entry(url))
+        except FileNotFoundError:
+            pass
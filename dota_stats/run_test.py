@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 """Unit testing for dota-stats"""
 import unittest
+from unittest import mock
+import collections
 import logging
 import os
 import json
+import time
+import threading
+import tempfile
 import numpy as np
 import pandas as pd
-import fetch
 from dota_stats import meta, db_util, win_rate_pick_rate, dotautil, \
-    fetch_summary, win_rate_position
+    fetch_summary, win_rate_position, rate_limit, metrics, pipeline, \
+    match_parse
 
 # Globals
 BIGINT = 9223372036854775808    # Max bitmask
@@ -28,7 +33,7 @@ class TestDumpBug(unittest.TestCase):
             return
 
         match_id = str(DUMP_BUG)
-        match = fetch.fetch_match(match_id, 0)
+        match = pipeline.fetch_match(match_id, 0)
         with open("./testing/{}.json".format(match_id), "w") as filename:
             filename.write(json.dumps(match, indent=4))
             self.assertTrue(match is not None)
@@ -49,6 +54,7 @@ class TestDB(unittest.TestCase):
         # Create and upgrade database
         db_util.create_database()
         os.system("alembic upgrade head >/dev/null 2>&1")
+        db_util.reset_watermarks()
 
         cls.engine, cls.session = db_util.connect_database()
 
@@ -95,8 +101,8 @@ class TestFetch(TestDB):
 
         old_key = os.environ["STEAM_KEY"]
         os.environ["STEAM_KEY"] = "AAAAA"
-        with self.assertRaises(fetch.APIException) as context:
-            _ = fetch.fetch_match(111, 1)
+        with self.assertRaises(pipeline.APIException) as context:
+            _ = pipeline.fetch_match(111, 1)
 
         self.assertEqual(str(context.exception),
                          'Forbidden - Check Steam API key')
@@ -105,8 +111,8 @@ class TestFetch(TestDB):
     def test_bad_match_id(self):
         """Bad Match ID"""
 
-        with self.assertRaises(fetch.APIException) as context:
-            _ = fetch.fetch_match(111, 1)
+        with self.assertRaises(pipeline.APIException) as context:
+            _ = pipeline.fetch_match(111, 1)
         self.assertEqual(str(context.exception), 'Match ID not found')
 
     def test_feeding_bit_detection(self):
@@ -116,7 +122,7 @@ class TestFetch(TestDB):
             match = json.loads(filename.read())
 
         with self.assertRaises(Exception) as context:
-            fetch.parse_match(match)
+            match_parse.parse_match(match)
 
         self.assertTrue(context.exception.__str__() == 'Feeding')
 
@@ -126,10 +132,12 @@ class TestFetch(TestDB):
 
         with open("./testing/backpack.json") as filename:
             match = json.loads(filename.read())
-        parsed_match = fetch.parse_match(match)
-        item_dict = json.loads(parsed_match['items'])
-        jugg = item_dict[str(meta.REVERSE_HERO_DICT['juggernaut'])]
-        self.assertTrue(meta.ITEMS['phase_boots']['id'] in jugg)
+        parsed_match = match_parse.parse_match(match)
+        jugg = [t for t in pipeline.match_to_player_rows(parsed_match) if
+                t['hero'] == meta.REVERSE_HERO_DICT['juggernaut']][0]
+        backpack = [jugg['backpack_{}'.format(i)] for i in range(4)]
+        self.assertTrue(meta.ITEMS['phase_boots']['id'] in backpack)
+        self.assertIsNone(jugg['item_neutral'])
 
         # Test no items detection
         file_handle = open("./testing/no_items.json")
@@ -138,7 +146,7 @@ class TestFetch(TestDB):
         file_handle.close()
 
         with self.assertRaises(Exception) as context:
-            fetch.parse_match(match)
+            match_parse.parse_match(match)
 
         self.assertTrue(context.exception.__str__() == 'No items')
 
@@ -148,39 +156,164 @@ class TestFetch(TestDB):
             match = json.loads(filename.read())
 
         with self.assertRaises(Exception) as context:
-            fetch.parse_match(match)
+            match_parse.parse_match(match)
 
         self.assertTrue(context.exception.__str__() == 'Null Hero ID')
 
+    def test_parse_matches(self):
+        """Page of matches is parsed in one go, rejections by reason"""
+
+        page = []
+        for name in ["backpack", "bots", "no_items", "null_hero",
+                     "write_match"]:
+            with open("./testing/{}.json".format(name)) as filename:
+                page.append(json.loads(filename.read()))
+            page[-1]['api_skill'] = 1
+
+        summaries, rejections = match_parse.parse_matches(page)
+        self.assertEqual([t['match_id'] for t in summaries],
+                         [page[0]['match_id'], page[4]['match_id']])
+        self.assertEqual(rejections, {'Feeding': 1, 'No items': 1,
+                                      'Null Hero ID': 1})
+        self.assertEqual(summaries[1], match_parse.parse_match(page[4]))
+
+    def test_prefilter(self):
+        """History entries which can't pass parse_match are dropped"""
+
+        history = [{'match_id': 1, 'lobby_type': 7, 'players': [
+                        {'player_slot': 0, 'hero_id': 1}]},
+                   {'match_id': 2, 'lobby_type': 4, 'players': [
+                        {'player_slot': 0, 'hero_id': 1}]},
+                   {'match_id': 3, 'lobby_type': 0, 'players': [
+                        {'player_slot': 0, 'hero_id': 0}]}]
+        for match in history:
+            match['start_time'] = int(time.time())
+
+        matches = pipeline.prefilter_matches(history)
+        self.assertEqual([t['match_id'] for t in matches], [1])
+
     def test_dummy_matches(self):
         """Test dummy matches"""
 
         rows = self.session.query(db_util.Match).all()
-        radiant = [json.loads(t.radiant_heroes) for t in rows]
-        dire = [json.loads(t.dire_heroes) for t in rows]
+        radiant = [t.radiant_heroes for t in rows]
+        dire = [t.dire_heroes for t in rows]
 
         # There should be an anti-mage in each game
         antimage = sum([1 in t for t in radiant]) + sum([1 in t for t in dire])
         self.assertEqual(antimage, 6)
 
+    def test_hero_masks(self):
+        """Hero, pair and counter lookups against the bitmask columns"""
+
+        rows = self.session.query(db_util.Match).all()
+
+        def expected(allies, enemies):
+            total = wins = 0
+            for row in rows:
+                for team, other, win in [
+                        (row.radiant_heroes, row.dire_heroes, row.radiant_win),
+                        (row.dire_heroes, row.radiant_heroes,
+                         1 - row.radiant_win)]:
+                    if set(allies) <= set(team) and set(enemies) <= set(other):
+                        total += 1
+                        wins += win
+            return total, wins
+
+        for allies, enemies in [([1], []), ([1, 86], []), ([1], [93]),
+                                ([], [44])]:
+            self.assertEqual(db_util.count_matches(allies, enemies),
+                             expected(allies, enemies))
+
+        radiant = db_util.find_matches([1], team='radiant')
+        dire = db_util.find_matches([1], team='dire')
+        self.assertEqual(len(radiant) + len(dire), 6)
+        self.assertTrue(all(1 in db_util.unpack_heroes(t[2])[0]
+                            for t in radiant))
+
     def test_orm_writes(self):
         """ Write some matches and test using ORM """
 
         with open("./testing/write_match.json") as filename:
             match = json.loads(filename.read())
 
-        match = fetch.parse_match(match)
+        match = match_parse.parse_match(match)
         match_id = match['match_id']
-        fetch.write_matches(self.session, [match])
+        pipeline.write_matches(self.session, [match])
 
         match_read = self.session.query(db_util.Match).\
             filter(db_util.Match.match_id == match_id).first()
 
         self.assertEqual(match_read.match_id, match['match_id'])
-        self.assertEqual(json.loads(match_read.radiant_heroes),
-                         match['radiant_heroes'])
-        self.assertEqual(json.loads(match_read.dire_heroes),
-                         match['dire_heroes'])
+        self.assertEqual(match_read.radiant_heroes, match['radiant_heroes'])
+        self.assertEqual(match_read.dire_heroes, match['dire_heroes'])
+
+        players = self.session.query(db_util.MatchPlayer).\
+            filter(db_util.MatchPlayer.match_id == match_id).all()
+        self.assertEqual(sorted(t.hero for t in players if t.radiant),
+                         sorted(match['radiant_heroes']))
+        self.assertEqual({t.player_slot for t in players},
+                         {0, 1, 2, 3, 4, 128, 129, 130, 131, 132})
+        self.assertGreaterEqual(db_util.get_max_start_time(),
+                                match['start_time'])
+
+    def test_batch_writes(self):
+        """Batched upserts store the same rows as per match merges, also
+        when an existing match is written again"""
+
+        with open("./testing/write_match.json") as filename:
+            match = match_parse.parse_match(json.loads(filename.read()))
+
+        def stored(match_id):
+            """Match and player rows of `match_id`, without the ID"""
+            self.session.expire_all()
+            rows = [self.session.query(db_util.Match).filter(
+                db_util.Match.match_id == match_id).one()]
+            rows += self.session.query(db_util.MatchPlayer).filter(
+                db_util.MatchPlayer.match_id == match_id).order_by(
+                    db_util.MatchPlayer.player_slot).all()
+            return [{c.name: getattr(row, c.name) for c in
+                     row.__table__.columns if c.name != 'match_id'}
+                    for row in rows]
+
+        merged = dict(match, match_id=2)
+        batched = dict(match, match_id=3)
+        pipeline.write_matches(self.session, [merged], batch_size=0)
+        pipeline.write_matches(self.session, [batched], batch_size=10)
+        self.assertEqual(stored(3), stored(2))
+
+        # Re-written with a different result and player
+        players = [dict(t, gold_spent=t['gold_spent'] + 1)
+                   for t in match['players']]
+        for summary, batch_size in [(merged, 0), (batched, 10)]:
+            summary.update(radiant_win=not match['radiant_win'],
+                           players=players)
+            pipeline.write_matches(self.session, [summary],
+                                batch_size=batch_size)
+        self.assertEqual(stored(3), stored(2))
+        self.assertNotEqual(stored(2)[0]['radiant_win'],
+                            match['radiant_win'])
+        self.assertEqual(stored(2)[1]['gold_spent'],
+                         min(players, key=lambda t: t['player_slot'])[
+                             'gold_spent'])
+
+    def test_win_rate_stream(self):
+        """New matches are added onto their win rate buckets once"""
+
+        with open("./testing/write_match.json") as filename:
+            match = match_parse.parse_match(json.loads(filename.read()))
+        match['match_id'] = 1
+
+        stmt = "select * from dota_hero_win_rate where time={}".format(
+            db_util.hour_buckets(match['start_time'])[-1])
+        for _ in range(2):
+            pipeline.write_matches(self.session, [match], stream=True)
+            df_out = pd.read_sql(stmt, self.engine)
+            self.assertEqual(len(df_out), 10)
+            self.assertEqual(df_out['radiant_total'].sum(), 5)
+            self.assertEqual(df_out['dire_total'].sum(), 5)
+            self.assertEqual(df_out['radiant_win'].sum() +
+                             df_out['dire_win'].sum(), 5)
 
 
 class TestDBUtil(unittest.TestCase):
@@ -196,6 +329,293 @@ class TestDBUtil(unittest.TestCase):
         self.assertEqual(end[0], 1609250400)
         self.assertEqual(begin[-1], 1609210800)
 
+    def test_hour_buckets(self):
+        """Matches on the hour count towards both adjacent buckets"""
+
+        self.assertEqual(db_util.hour_buckets(1609250400 + 1), [1609254000])
+        self.assertEqual(db_util.hour_buckets(1609250400),
+                         [1609250400, 1609254000])
+
+    def test_win_rate_deltas(self):
+        """Streamed counts agree with the batch aggregation"""
+
+        row = collections.namedtuple('row', ['radiant_win', 'heroes'])
+        heroes = meta.HEROES[:15]
+        matches = [{'match_id': i, 'start_time': 1609250400 + 60*i,
+                    'api_skill': 1, 'radiant_win': i % 3 == 0,
+                    'radiant_heroes': heroes[i % 5:i % 5 + 5],
+                    'dire_heroes': heroes[10 - i % 5:15 - i % 5]}
+                   for i in range(1, 20)]
+
+        deltas = db_util.win_rate_deltas(matches)
+        self.assertEqual({t['time'] for t in deltas}, {1609254000})
+
+        df_batch = win_rate_pick_rate.parse_records(
+            [row(int(t['radiant_win']), db_util.pack_heroes(
+                t['radiant_heroes'], t['dire_heroes'])) for t in matches])
+        df_batch = df_batch.set_index('hero')
+        for delta in deltas:
+            for col in db_util.WIN_RATE_COUNTS:
+                self.assertEqual(delta[col], df_batch.loc[delta['hero'], col])
+        self.assertEqual(sum(t['radiant_total'] for t in deltas), 5 * 19)
+
+    def test_partition_clauses(self):
+        """Daily partition names and bounds"""
+
+        self.assertEqual(db_util.partition_name(1606003200), "p20201121")
+        self.assertEqual(
+            db_util.partition_clauses([1606003200, 1606089600]),
+            "PARTITION p20201121 VALUES LESS THAN (1606003200), "
+            "PARTITION p20201122 VALUES LESS THAN (1606089600), "
+            "PARTITION pfuture VALUES LESS THAN MAXVALUE")
+
+    def test_engine_registry(self):
+        """One pooled engine per process, one session per thread"""
+
+        engine = db_util.get_engine()
+        self.assertIs(db_util.get_engine(), engine)
+        self.assertEqual(engine.pool.size(), db_util.POOL_SIZE)
+
+        session = db_util.get_session()
+        self.assertIs(db_util.get_session(), session)
+        self.assertIs(session.get_bind(), engine)
+
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(db_util.get_session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], session)
+
+        # Nothing inherited from a parent process, the engine stays
+        db_util.dispose_engines()
+        self.assertIs(db_util.get_engine(), engine)
+
+        db_util.remove_sessions()
+        self.assertIsNot(db_util.get_session(), session)
+
+
+class TestWatermark(TestDB):
+    """Test the cached start time watermark"""
+
+    def test_watermark(self):
+        """Watermark matches the newest match and only moves forward"""
+
+        with self.engine.connect() as conn:
+            newest = conn.execute("select max(start_time) from "
+                                  "dota_matches").scalar()
+        self.assertEqual(db_util.get_max_start_time(max_age=0), newest)
+
+        seen = []
+
+        def callback(*args):
+            seen.append(args)
+
+        db_util.subscribe_watermark(callback)
+        try:
+            db_util.advance_watermark(self.session, newest - 100)
+            self.assertEqual(db_util.get_max_start_time(max_age=0), newest)
+            self.assertEqual(seen, [])
+
+            db_util.advance_watermark(self.session, newest + 100)
+            self.assertEqual(seen, [(db_util.START_TIME, newest + 100)])
+        finally:
+            db_util.unsubscribe_watermark(callback)
+        self.assertEqual(db_util.wait_for_watermark(newest, timeout=1),
+                         newest + 100)
+        self.assertIsNone(db_util.wait_for_watermark(
+            newest + 100, timeout=0.1, interval=0.05))
+
+
+class TestPartitions(TestDB):
+    """Test daily partitions and partition based purge"""
+
+    def test_partitions(self):
+        """Partitions are pre-created and purge keeps recent data"""
+
+        day = db_util.DAY
+        today = int(time.time()) // day * day
+        with self.engine.connect() as conn:
+            partitions = db_util.get_partitions(conn, "dota_matches")
+        self.assertGreaterEqual(partitions[-1][1],
+                                today + (db_util.PARTITION_AHEAD + 1) * day)
+
+        db_util.create_partitions(db_util.PARTITION_AHEAD + 2)
+        with self.engine.connect() as conn:
+            for table, _ in db_util.PARTITIONED_TABLES:
+                self.assertEqual(db_util.get_partitions(conn, table)[-1][1],
+                                 today + (db_util.PARTITION_AHEAD + 3) * day)
+
+        count = self.session.query(db_util.Match).count()
+        db_util.purge_database(1)
+        self.assertEqual(self.session.query(db_util.Match).count(), count)
+
+    def test_delete_chunked(self):
+        """Chunked purge deletes exactly the rows before the cutoff"""
+
+        times = sorted(t.start_time for t in
+                       self.session.query(db_util.Match).all())
+        cutoff = times[2]
+
+        with self.engine.connect() as conn:
+            self.assertIsInstance(db_util.estimate_rows(
+                conn, "dota_matches", "start_time<={}".format(cutoff)), int)
+            deleted = db_util.delete_chunked(conn, "dota_matches",
+                                             "start_time", cutoff,
+                                             chunk_size=2, pause=0)
+        self.assertEqual(deleted, 3)
+        self.assertEqual(sorted(t.start_time for t in self.session.query(
+            db_util.Match).all()), times[3:])
+
+
+class TestHeroLineups(unittest.TestCase):
+    """Test packed hero lineups"""
+
+    def test_pack_heroes(self):
+        """Pack, unpack and batch decode lineups"""
+
+        radiant, dire = [1, 86, 50, 39, 28], [93, 44, 25, 2, 300]
+        packed = db_util.pack_heroes(radiant, dire)
+        self.assertEqual(len(packed), 20)
+        self.assertEqual(db_util.unpack_heroes(packed), (radiant, dire))
+
+        heroes = db_util.decode_heroes([packed, db_util.pack_heroes(
+            dire, radiant)])
+        self.assertEqual(heroes.shape, (2, 10))
+        self.assertEqual(heroes[0, :5].tolist(), radiant)
+        self.assertEqual(heroes[1, :5].tolist(), dire)
+        self.assertEqual(db_util.decode_heroes([]).shape, (0, 10))
+
+        with self.assertRaises(ValueError):
+            db_util.pack_heroes(radiant, dire[:4])
+
+
+class TestBitmask(unittest.TestCase):
+    """Test hero bitmasks"""
+
+    def test_bitmask(self):
+        """Encode, decode and SQL conditions"""
+
+        heroes = [1, 63, 64, 135, 191]
+        chunks = dotautil.Bitmask.encode(heroes)
+        self.assertEqual(chunks, [2 + BIGINT, 1, 2**7 + BIGINT])
+        self.assertEqual(dotautil.Bitmask.decode(chunks), heroes)
+
+        lineups = np.array([heroes, [2, 3, 4, 5, 6]])
+        masks = dotautil.Bitmask.encode_array(lineups)
+        self.assertEqual(masks.dtype, np.uint64)
+        self.assertEqual(masks.tolist(), [chunks, dotautil.Bitmask.encode(
+            [2, 3, 4, 5, 6])])
+
+        self.assertEqual(dotautil.Bitmask.contains('dire', [1, 64]),
+                         "(dire_mask_0 & 2) = 2 AND (dire_mask_1 & 1) = 1")
+        self.assertEqual(dotautil.Bitmask.contains('radiant', []), "1=1")
+
+        with self.assertRaises(ValueError):
+            dotautil.Bitmask.encode([192])
+        with self.assertRaises(ValueError):
+            db_util.hero_filter()
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test the adaptive token bucket used to pace API calls"""
+
+    def test_adaptive_rate(self):
+        """Success raises the rate, throttling cuts it sharply"""
+
+        limiter = rate_limit.AdaptiveRateLimiter(rate=10, max_rate=10.5,
+                                                 increase=0.1)
+        for _ in range(10):
+            limiter.record(200)
+        self.assertAlmostEqual(limiter.stats()['rate'], 10.5)
+
+        limiter.record(429)
+        self.assertAlmostEqual(limiter.stats()['rate'], 5.25)
+        limiter.record(503)
+        self.assertAlmostEqual(limiter.stats()['rate'], 5.25*0.75)
+
+    def test_concurrent_throttling(self):
+        """A burst of 429s to requests in flight together cuts the rate
+        once, a 429 to a request sent after the cut cuts it again"""
+
+        limiter = rate_limit.AdaptiveRateLimiter(rate=8)
+        sent = time.monotonic()
+        threads = [threading.Thread(target=limiter.record, args=(429, sent))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertAlmostEqual(limiter.stats()['rate'], 4.0)
+
+        limiter.record(429, time.monotonic())
+        self.assertAlmostEqual(limiter.stats()['rate'], 2.0)
+
+    def test_reserve(self):
+        """Burst tokens are free, after that callers queue at 1/rate"""
+
+        limiter = rate_limit.AdaptiveRateLimiter(rate=2, burst=2)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertAlmostEqual(limiter.reserve(), 0.5, places=2)
+        self.assertAlmostEqual(limiter.reserve(), 1.0, places=2)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test Prometheus style metrics"""
+
+    def test_render(self):
+        """Counters, gauges and histograms in the exposition format"""
+
+        registry = metrics.Registry()
+        requests = registry.counter('requests_total', 'Requests',
+                                    ('status',))
+        depth = registry.gauge('depth', 'Queue depth')
+        latency = registry.histogram('latency_seconds', 'Latency',
+                                     buckets=(0.1, 1.0))
+
+        requests.inc(status=200)
+        requests.inc(2, status=200)
+        depth.set_function(lambda: 7)
+        for value in [0.05, 0.5, 0.5, 5.0]:
+            latency.observe(value)
+
+        text = registry.render()
+        self.assertIn('requests_total{status="200"} 3', text)
+        self.assertIn('depth 7', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('latency_seconds_count 4', text)
+        self.assertAlmostEqual(latency.quantile(0.5), 0.55)
+
+        with self.assertRaises(ValueError):
+            requests.inc()
+
+    def test_mixed_label_types(self):
+        """Int and str values of one label render together"""
+
+        registry = metrics.Registry()
+        requests = registry.counter('requests_total', 'Requests',
+                                    ('status',))
+        requests.inc(status=200)
+        requests.inc(status='error')
+        requests.inc(status='200')
+
+        text = registry.render()
+        self.assertIn('requests_total{status="200"} 2', text)
+        self.assertIn('requests_total{status="error"} 1', text)
+
+    def test_textfile(self):
+        """Textfile collector output"""
+
+        registry = metrics.Registry()
+        registry.counter('runs_total', 'Runs').inc()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "fetch.prom")
+            metrics.write_textfile(path, registry)
+            with open(path) as file_handle:
+                self.assertIn("runs_total 1\n", file_handle.read())
+
 
 class TestWinRatePickRate(TestDB):
     """Test code to calculate win rate vs. pick rate tables"""
@@ -203,7 +623,7 @@ class TestWinRatePickRate(TestDB):
     def test_win_rate_pick_rate(self):
         """Test code to calculate win rate vs. pick rate tables"""
 
-        win_rate_pick_rate.main(days=1, skill=1)
+        win_rate_pick_rate.main(days=1, skill=1, full=True)
 
         engine, _ = db_util.connect_database()
         stmt = "select * from dota_hero_win_rate"
@@ -220,6 +640,59 @@ class TestWinRatePickRate(TestDB):
             50,
             sum(df_out[['radiant_total', 'dire_total']].sum(axis=1)))
 
+    def test_incremental(self):
+        """Only hours flagged by new matches are aggregated, with the same
+        result as a full rebuild"""
+
+        stmt = "select * from dota_hero_win_rate where radiant_total>0 or " \
+               "dire_total>0 order by time_hero_skill"
+        win_rate_pick_rate.main(days=1, skill=1, full=True)
+        df_full = pd.read_sql(stmt, self.engine)
+
+        with self.engine.connect() as conn:
+            conn.execute("delete from dota_hero_win_rate")
+            matches = conn.execute("select start_time, api_skill from "
+                                   "dota_matches").fetchall()
+        db_util.mark_dirty_hours(self.session, matches)
+
+        win_rate_pick_rate.main(days=1, skill=1)
+        pd.testing.assert_frame_equal(pd.read_sql(stmt, self.engine),
+                                      df_full)
+
+        # Nothing new, nothing rewritten
+        with self.engine.connect() as conn:
+            conn.execute("delete from dota_hero_win_rate")
+        win_rate_pick_rate.main(days=1, skill=1)
+        self.assertEqual(len(pd.read_sql(stmt, self.engine)), 0)
+
+    def test_dirty_hours_kept(self):
+        """Flags survive a failed aggregation and a match written while
+        the bucket was being read"""
+
+        with self.engine.connect() as conn:
+            matches = conn.execute("select start_time, api_skill from "
+                                   "dota_matches").fetchall()
+        db_util.mark_dirty_hours(self.session, matches)
+        with self.engine.connect() as conn:
+            flagged = db_util.get_dirty_hours(conn, 1, 2**40)
+        self.assertTrue(len(flagged) > 0)
+
+        with mock.patch.object(win_rate_pick_rate, 'write_to_database',
+                               side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                win_rate_pick_rate.main(days=1, skill=1)
+        with self.engine.connect() as conn:
+            self.assertEqual(db_util.get_dirty_hours(conn, 1, 2**40).keys(),
+                             flagged.keys())
+
+            db_util.mark_dirty_hours(self.session, matches[:1])
+            db_util.clear_dirty_hours(conn, 1, flagged)
+            remaining = db_util.get_dirty_hours(conn, 1, 2**40)
+        self.assertEqual(set(remaining),
+                         set(db_util.hour_buckets(matches[0][0])))
+
+        win_rate_pick_rate.main(days=1, skill=1, full=True)
+
 
 class TestMLEncoding(unittest.TestCase):
     """Test one-hot encoding for machine learning"""
@@ -398,8 +871,7 @@ class TestWinRatePosition(TestDB):
         for match in self.session.query(db_util.Match).all():
             rows.append((
                 match.match_id,
-                match.radiant_heroes,
-                match.dire_heroes,
+                match.heroes,
                 match.radiant_win
             ))
 
@@ -431,6 +903,6 @@ class TestWinRatePosition(TestDB):
 
 
 if __name__ == '__main__':
-    fetch.log.setLevel(logging.CRITICAL)
+    pipeline.log.setLevel(logging.CRITICAL)
     win_rate_pick_rate.log.setLevel(logging.CRITICAL)
     unittest.main()
@@ -0,0 +1,668 @@
+# -*- coding: utf-8 -*-
+"""Unit testing for the dota-stats fetch pipeline, no database required"""
+import unittest
+from unittest import mock
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import time
+import threading
+import tempfile
+from dota_stats import rate_limit, match_index, crawl_state, \
+    response_cache, pipeline, match_parse, fetch_async, coordinator
+from dota_stats.benchmarks import fake_steam
+
+
+class TestMatchIndex(unittest.TestCase):
+    """Test the bounded index of fetched match IDs"""
+
+    def test_add_contains(self):
+        """Entries are found before and after merging into the arrays"""
+
+        now = int(time.time())
+        index = match_index.MatchIndex(3600, buffer_size=3)
+        index.update([10, 5], [now, now])
+        self.assertTrue(index.add(7, now))
+        self.assertFalse(index.add(5, now))
+        for match_id in [11, 12, 13]:
+            index.add(match_id, now)
+
+        self.assertEqual(len(index), 6)
+        for match_id in [5, 7, 10, 11, 12, 13]:
+            self.assertTrue(match_id in index)
+        self.assertFalse(6 in index)
+
+        index.discard([5, 13])
+        self.assertFalse(5 in index)
+        self.assertFalse(13 in index)
+        self.assertEqual(len(index), 4)
+
+    def test_eviction(self):
+        """Entries beyond the horizon or memory ceiling are dropped"""
+
+        now = int(time.time())
+        index = match_index.MatchIndex(3600, max_size=3)
+        index.update([1, 2, 3, 4, 5],
+                     [now-7200, now-30, now-20, now-10, now])
+        self.assertFalse(1 in index)
+        self.assertFalse(2 in index)
+        self.assertEqual(len(index), 3)
+
+    def test_snapshot_journal(self):
+        """Snapshot plus journal restore the index in a new process"""
+
+        now = int(time.time())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "seen.npy")
+
+            index = match_index.MatchIndex(3600)
+            index.update([1, 2], [now, now])
+            index.save(path)
+            index.open_journal(path)
+            index.record([3, 4], [now, now])
+            index.close()
+
+            restored = match_index.MatchIndex(3600)
+            self.assertTrue(restored.load(path))
+            self.assertEqual(len(restored), 4)
+            self.assertTrue(4 in restored)
+
+    def test_worker_journals(self):
+        """Journals of worker processes are replayed, then folded into the
+        snapshot"""
+
+        now = int(time.time())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "seen.npy")
+            merged = match_index.MatchIndex(3600)
+            merged.update([1], [now])
+            merged.save(path)
+
+            for owner, match_id in [("w0", 2), ("w1", 3)]:
+                worker = match_index.MatchIndex(3600)
+                worker.open_journal(path, owner)
+                worker.record([match_id], [now])
+                worker.close()
+
+            merged.replay(path)
+            self.assertEqual(len(merged), 3)
+            merged.save(path)
+            self.assertEqual(match_index.journals(path), [path + ".journal"])
+
+            restored = match_index.MatchIndex(3600)
+            self.assertTrue(restored.load(path))
+            self.assertEqual(len(restored), 3)
+
+
+class TestCrawlState(unittest.TestCase):
+    """Test crawl state shared between fetch processes"""
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, "crawl.db")
+
+    def test_claims(self):
+        """Each match can only be claimed once across processes"""
+
+        claims1 = crawl_state.ClaimTable()
+        claims2 = crawl_state.ClaimTable()
+        claims1.open(self.path)
+        claims2.open(self.path)
+
+        self.assertEqual(claims1.claim([1, 2, 3], [10, 10, 10], 60),
+                         [1, 2, 3])
+        self.assertEqual(claims2.claim([2, 3, 4], [10, 10, 20], 60), [4])
+
+        # Purged claims are available again
+        claims1.purge(15)
+        self.assertEqual(claims2.claim([1, 4], [10, 20], 60), [1])
+
+        claims1.close()
+        claims2.close()
+
+    def test_claim_leases(self):
+        """Released and expired claims can be claimed again, confirmed
+        claims can't"""
+
+        claims1 = crawl_state.ClaimTable()
+        claims2 = crawl_state.ClaimTable()
+        claims1.open(self.path)
+        claims2.open(self.path)
+
+        self.assertEqual(claims1.claim([1, 2, 3], [10, 10, 10], 60),
+                         [1, 2, 3])
+        self.assertEqual(claims2.claim([4, 5], [10, 10], -1), [4, 5])
+        claims1.confirm([1])
+        claims1.release([1, 2])
+        claims2.confirm([5])
+
+        # 2 released, 4 expired, 1 and 5 confirmed, 3 still leased
+        self.assertEqual(claims2.claim([1, 2, 3, 4, 5], [10]*5, 60), [2, 4])
+        self.assertEqual(claims1.claim([4], [10], 60), [])
+
+        claims1.close()
+        claims2.close()
+
+    def test_release_failed(self):
+        """Matches whose detail fetch failed are handed back"""
+
+        now = int(time.time())
+        history = [{'match_id': i, 'start_time': now, 'lobby_type': 7,
+                    'players': [{'player_slot': 0, 'hero_id': 1}]}
+                   for i in [1, 2]]
+        claims = crawl_state.ClaimTable()
+        claims.open(self.path)
+        index = match_index.MatchIndex(3600)
+
+        page = {'num_results': 2, 'results_remaining': 0,
+                'matches': history}
+
+        with mock.patch.object(pipeline, 'CLAIMS', claims), \
+                mock.patch.object(pipeline, 'MATCH_IDS', index):
+            sweep = pipeline.HistorySweep(1, 1)
+            match_ids = pipeline.claim_matches(sweep.page(page), sweep)
+            self.assertEqual(match_ids, [1, 2])
+            self.assertEqual(pipeline.claim_matches(history, sweep), [])
+
+            pipeline.summarize_page(match_ids, [None, None], 1, 1)
+            self.assertFalse(1 in index)
+            self.assertEqual(pipeline.claim_matches(history, sweep), [1, 2])
+        claims.close()
+
+    def test_work_queue(self):
+        """Work units are leased once, expired or released units return"""
+
+        work = crawl_state.WorkQueue()
+        work.open(self.path)
+        work.seed([(1, 1), (2, 1)])
+
+        self.assertEqual(work.lease("w0", 60), (1, 1))
+        self.assertEqual(work.lease("w1", -1), (2, 1))
+        self.assertTrue(work.renew("w0", 1, 1, 60, 3, 300))
+        self.assertFalse(work.renew("w1", 1, 1, 60, 3, 300))
+
+        # Expired lease is picked up by another worker
+        self.assertEqual(work.lease("w0", 60), (2, 1))
+        work.complete("w0", 2, 1)
+        self.assertIsNone(work.lease("w1", 60))
+
+        work.release("w0")
+        self.assertEqual(work.lease("w1", 60), (1, 1))
+        work.complete("w1", 1, 1)
+
+        states, leased = work.summary()
+        self.assertEqual(states, {'done': 2})
+        self.assertEqual(leased, [])
+        work.close()
+
+    def test_checkpoints(self):
+        """Sweep position is kept until the sweep finishes"""
+
+        checkpoints = crawl_state.CheckpointTable()
+        self.assertEqual(checkpoints.get(1, 1), (None, None, None))
+
+        checkpoints.open(self.path)
+        checkpoints.advance(1, 1, 1000.0, 900)
+        self.assertEqual(checkpoints.get(1, 1), (None, 1000.0, 900))
+        checkpoints.finish(1, 1, 1000.0)
+        self.assertEqual(checkpoints.get(1, 1), (1000.0, None, None))
+
+        # Last sweep time never moves backward
+        checkpoints.finish(1, 1, 500.0)
+        self.assertEqual(checkpoints.get(1, 1), (1000.0, None, None))
+        self.assertEqual(checkpoints.get(2, 1), (None, None, None))
+
+        checkpoints.reset()
+        self.assertEqual(checkpoints.get(1, 1), (None, None, None))
+        checkpoints.close()
+
+    def test_sweep_lookback(self):
+        """A match which finished after the last sweep is picked up even
+        though its ID is below the newest match that sweep saw"""
+
+        checkpoints = crawl_state.CheckpointTable()
+        checkpoints.open(self.path)
+        swept = time.time() - 600
+        checkpoints.finish(1, 1, swept)
+
+        # Match 95 started before the last sweep, finished after it
+        page = {'num_results': 4, 'results_remaining': 100, 'matches': [
+            {'match_id': 120, 'start_time': swept + 300},
+            {'match_id': 110, 'start_time': swept - 1200},
+            {'match_id': 95, 'start_time': swept - 3600},
+            {'match_id': 90,
+             'start_time': swept - pipeline.MAX_MATCH_LEN - 1}]}
+        with mock.patch.object(pipeline, 'CHECKPOINTS', checkpoints):
+            sweep = pipeline.HistorySweep(1, 1)
+            new = sweep.page(page)
+            self.assertEqual([t['match_id'] for t in new], [120, 110, 95])
+            self.assertTrue(sweep.done)
+            self.assertEqual(sweep.start_at_match_id, 89)
+
+            sweep.finish()
+            self.assertEqual(checkpoints.get(1, 1),
+                             (sweep.started, None, None))
+        checkpoints.close()
+
+    def test_sweep_holds_unwritten(self):
+        """A match claimed by another process is not passed by the
+        checkpoint, so it is swept again once that process releases it"""
+
+        now = int(time.time())
+        history = [{'match_id': i, 'start_time': now - 10*i, 'lobby_type': 7,
+                    'players': [{'player_slot': 0, 'hero_id': 1}]}
+                   for i in [120, 110, 100]]
+        page = {'num_results': 3, 'results_remaining': 0,
+                'matches': history}
+
+        claims, other = crawl_state.ClaimTable(), crawl_state.ClaimTable()
+        claims.open(self.path)
+        other.open(self.path)
+        checkpoints = crawl_state.CheckpointTable()
+        checkpoints.open(self.path)
+        other.claim([110], [now - 1100], 60)
+
+        with mock.patch.object(pipeline, 'CLAIMS', claims), \
+                mock.patch.object(pipeline, 'CHECKPOINTS', checkpoints), \
+                mock.patch.object(pipeline, 'MATCH_IDS',
+                                  match_index.MatchIndex(3600)):
+            sweep = pipeline.HistorySweep(1, 1)
+            match_ids = pipeline.claim_matches(sweep.page(page), sweep)
+            self.assertEqual(match_ids, [120, 100])
+            claims.confirm(match_ids)
+
+            sweep.checkpoint(sweep.start_at_match_id)
+            self.assertEqual(checkpoints.get(1, 1)[2], 110)
+
+            # The other process fails, the next sweep looks back to 110
+            other.release([110])
+            sweep.checkpoint(sweep.start_at_match_id)
+            self.assertEqual(checkpoints.get(1, 1)[2], 110)
+            sweep.finish()
+            self.assertEqual(checkpoints.get(1, 1)[0], now - 1100)
+
+            sweep = pipeline.HistorySweep(1, 1)
+            self.assertEqual(pipeline.claim_matches(sweep.page(page), sweep),
+                             [110])
+
+            # Once written the match no longer holds the checkpoint
+            claims.confirm([110])
+            sweep.checkpoint(sweep.start_at_match_id)
+            self.assertEqual(checkpoints.get(1, 1)[2], 99)
+
+        claims.close()
+        other.close()
+        checkpoints.close()
+
+
+def crashing_worker(owner, _, opts):
+    """Stand-in for `coordinator.run_worker`, the first worker dies holding a
+    lease"""
+
+    work = crawl_state.WorkQueue()
+    work.open(os.path.join(opts.cache_dir, "crawl.db"))
+    for _ in coordinator.leased_units(work, owner):
+        with open(os.path.join(opts.cache_dir, owner), "w"):
+            pass
+        if owner == "w0":
+            os._exit(3)     # pylint: disable=protected-access
+    work.close()
+
+
+class TestCoordinator(unittest.TestCase):
+    """Test coordinator mode: work units, workers and crash recovery"""
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, "crawl.db")
+        self.opts = argparse.Namespace(
+            workers=2, skill=1, engine='threads', cache_dir=tmp_dir,
+            rescan=False, replay=None, metrics_port=None, metrics_file=None)
+
+    def test_leased_units(self):
+        """Units are leased in turn and completed once the next is asked
+        for"""
+
+        work = crawl_state.WorkQueue()
+        work.open(self.path)
+        work.seed([(1, 1), (2, 1)])
+
+        units = coordinator.leased_units(work, "w0")
+        self.assertEqual(next(units), (1, 1))
+        self.assertEqual(work.summary()[0], {'leased': 1, 'pending': 1})
+        self.assertEqual(list(units), [(2, 1)])
+        self.assertEqual(work.summary()[0], {'done': 2})
+        work.close()
+
+    def test_run_worker(self):
+        """A unit whose lease is lost is abandoned, the worker carries on
+        with the next one"""
+
+        work = crawl_state.WorkQueue()
+        work.open(self.path)
+        work.seed([(1, 1), (2, 1)])
+        calls = []
+
+        def fetch_matches(_writer, hero, skill, _executor, on_page=None):
+            calls.append((hero, skill))
+            if len(calls) == 1:
+                work.release("w0")
+            on_page(1, 100)
+
+        patches = [
+            mock.patch.object(pipeline, 'fetch_matches', fetch_matches),
+            mock.patch.object(coordinator, 'dispose_engines', lambda: None),
+            mock.patch.object(pipeline, 'get_session', mock.MagicMock),
+            mock.patch.object(pipeline, 'remove_sessions', lambda: None),
+            mock.patch.object(coordinator.signal, 'signal'),
+            mock.patch.object(pipeline, 'LIMITER',
+                              rate_limit.AdaptiveRateLimiter(rate=10)),
+            mock.patch.object(pipeline, 'MATCH_IDS',
+                              match_index.MatchIndex(3600)),
+            mock.patch.object(pipeline, 'CLAIMS', crawl_state.ClaimTable()),
+            mock.patch.object(pipeline, 'CHECKPOINTS',
+                              crawl_state.CheckpointTable())]
+        for patch in patches:
+            patch.start()
+        try:
+            coordinator.run_worker("w0", 0, self.opts)
+            self.assertEqual(pipeline.LIMITER.rate, 5)
+        finally:
+            for patch in patches:
+                patch.stop()
+
+        # Lost unit 1 is leased again, once released
+        self.assertEqual(calls, [(1, 1), (1, 1), (2, 1)])
+        self.assertEqual(work.summary()[0], {'done': 2})
+        work.close()
+
+    def test_run_coordinator(self):
+        """A crashed worker's units are released and the worker is
+        replaced"""
+
+        with mock.patch.object(coordinator, 'run_worker', crashing_worker), \
+                mock.patch.object(coordinator, 'REPORT_TIME', 0.05):
+            coordinator.run_coordinator([(h, 1) for h in [1, 2, 3, 4]],
+                                        self.opts)
+
+        self.assertTrue(os.path.exists(os.path.join(self.opts.cache_dir,
+                                                    "w0r1")))
+        work = crawl_state.WorkQueue()
+        work.open(self.path)
+        self.assertEqual(work.summary(), ({'done': 4}, []))
+        work.close()
+
+
+class TestMatchWriter(unittest.TestCase):
+    """Test the database writer thread, without a database"""
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.written = []
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.fail = False
+
+        self.claims = crawl_state.ClaimTable()
+        self.claims.open(os.path.join(tmp_dir, "crawl.db"))
+        self.addCleanup(self.claims.close)
+        self.index = match_index.MatchIndex(3600)
+        for patch in [
+                mock.patch.object(pipeline, 'write_matches',
+                                  self.write_matches),
+                mock.patch.object(pipeline, 'get_session', mock.MagicMock),
+                mock.patch.object(pipeline, 'remove_sessions', lambda: None),
+                mock.patch.object(pipeline, 'CLAIMS', self.claims),
+                mock.patch.object(pipeline, 'MATCH_IDS', self.index)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write_matches(self, _, matches, _batch_size=None):
+        """Stand-in for `pipeline.write_matches`"""
+        self.started.set()
+        self.proceed.wait()
+        if self.fail:
+            raise RuntimeError("Lost connection")
+        self.written.extend(t['match_id'] for t in matches)
+
+    def claim(self, match_ids):
+        """Summaries for `match_ids`, claimed as `claim_matches` would"""
+        now = int(time.time())
+        for match_id in match_ids:
+            self.index.add(match_id, now)
+        self.claims.claim(match_ids, [now]*len(match_ids), 60)
+        return [{'match_id': t, 'start_time': now} for t in match_ids]
+
+    def test_flush_on_close(self):
+        """Everything queued is written, and confirmed, by close"""
+
+        writer = pipeline.MatchWriter(batch_size=10)
+        writer.start()
+        for summary in self.claim(range(250)):
+            writer.put(summary)
+        writer.close()
+
+        self.assertEqual(self.written, list(range(250)))
+        self.assertEqual(writer.written, 250)
+        self.assertEqual(self.claims.claim([0, 249], [0, 0], 60), [])
+
+    def test_backpressure(self):
+        """put blocks while the queue is full"""
+
+        self.proceed.clear()
+        writer = pipeline.MatchWriter(max_queue=2)
+        writer.start()
+        summaries = self.claim(range(4))
+        writer.put(summaries[0])
+        self.started.wait()
+        writer.put(summaries[1])
+        writer.put(summaries[2])
+
+        blocked = threading.Thread(target=writer.put, args=(summaries[3],))
+        blocked.start()
+        blocked.join(0.3)
+        self.assertTrue(blocked.is_alive())
+
+        self.proceed.set()
+        blocked.join()
+        writer.close()
+        self.assertEqual(self.written, [0, 1, 2, 3])
+
+    def test_after_write(self):
+        """Callbacks run once everything queued before them is written,
+        and not at all after a failed write"""
+
+        calls = []
+        writer = pipeline.MatchWriter()
+        writer.start()
+        summaries = self.claim([1, 2, 3])
+        writer.put(summaries[0])
+        writer.put(summaries[1])
+        writer.after_write(lambda: calls.append(list(self.written)))
+        writer.close()
+        self.assertEqual(calls, [[1, 2]])
+
+        self.fail = True
+        writer = pipeline.MatchWriter()
+        writer.start()
+        writer.put(summaries[2])
+        writer.after_write(lambda: calls.append(list(self.written)))
+        with self.assertRaises(RuntimeError):
+            writer.close()
+        self.assertEqual(calls, [[1, 2]])
+
+    def test_error(self):
+        """A failed write is raised to producers, nothing queued after it is
+        written and every unwritten match is released"""
+
+        self.proceed.clear()
+        self.fail = True
+        writer = pipeline.MatchWriter()
+        writer.start()
+        summaries = self.claim([1, 2, 3])
+        writer.put(summaries[0])
+        self.started.wait()
+        writer.put(summaries[1])
+        self.proceed.set()
+
+        with self.assertRaises(RuntimeError):
+            for _ in range(100):
+                writer.put(summaries[2])
+                time.sleep(0.05)
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+        self.assertEqual(self.written, [])
+        self.assertFalse(1 in self.index or 2 in self.index)
+        self.assertEqual(self.claims.claim([1, 2], [0, 0], 60), [1, 2])
+
+
+class TestResponseCache(unittest.TestCase):
+    """Test the on-disk API response cache"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_normalize(self):
+        """API key, host and parameter order don't change the entry"""
+
+        url1 = "https://api.steampowered.com/IDOTA2Match_570/GetMatchDetails" \
+               "/V001/?key=abc&match_id=1"
+        url2 = "http://127.0.0.1:8000/IDOTA2Match_570/GetMatchDetails/V001" \
+               "?match_id=1&key=xyz"
+        self.assertEqual(response_cache.normalize_url(url1),
+                         response_cache.normalize_url(url2))
+
+    def test_cache(self):
+        """Responses expire after the TTL, replay never goes to network"""
+
+        url = "https://api.steampowered.com/GetMatchDetails/V001/?match_id=1"
+        cache = response_cache.ResponseCache()
+        cache.put(url, b'{}')
+        self.assertIsNone(cache.get(url))
+
+        cache.open(self.tmp_dir, ttl=60)
+        cache.put(url, b'{"result": {}}')
+        self.assertEqual(cache.get(url), b'{"result": {}}')
+
+        os.utime(cache.entry(url), (time.time() - 120, time.time() - 120))
+        self.assertIsNone(cache.get(url))
+
+        # Replay corpus serves stale entries and is read-only
+        replay = response_cache.ResponseCache()
+        replay.open(self.tmp_dir, replay=True)
+        self.assertEqual(replay.get(url), b'{"result": {}}')
+        replay.put(url + "2", b'{}')
+        self.assertIsNone(replay.get(url + "2"))
+
+    def test_live_endpoints(self):
+        """History pages are recorded but only served in replay mode"""
+
+        history = "https://api.steampowered.com/IDOTA2Match_570/" \
+                  "GetMatchHistory/V001/?start_at_match_id=9999999999"
+        details = "https://api.steampowered.com/IDOTA2Match_570/" \
+                  "GetMatchDetails/V001/?match_id=1"
+        cache = response_cache.ResponseCache()
+        cache.open(self.tmp_dir, ttl=3600)
+        for url in [history, details]:
+            cache.put(url, b'{"result": {"status": 1}}')
+
+        with mock.patch.object(pipeline, 'RESPONSES', cache):
+            self.assertIsNone(pipeline.cached_result(history))
+            self.assertEqual(pipeline.cached_result(details), {'status': 1})
+
+        replay = response_cache.ResponseCache()
+        replay.open(self.tmp_dir, replay=True)
+        with mock.patch.object(pipeline, 'RESPONSES', replay):
+            self.assertEqual(pipeline.cached_result(history), {'status': 1})
+
+
+class TestFakeSteam(unittest.TestCase):
+    """Test the synthetic Steam API used for benchmarks"""
+
+    def test_synthetic_matches(self):
+        """History pages agree with details, details parse"""
+
+        fake = fake_steam.FakeSteam(matches=3000, reject=0.0)
+
+        page = fake.history(1, 9999999999)
+        self.assertEqual(page['num_results'], len(page['matches']))
+        remaining = page['results_remaining']
+        page = fake.history(1, page['matches'][-1]['match_id'] - 1)
+        self.assertEqual(remaining, page['num_results'] +
+                         page['results_remaining'])
+
+        for match in page['matches']:
+            self.assertIn(1, [t['hero_id'] for t in match['players']])
+            details = fake.details(match['match_id'])
+            self.assertEqual(details['start_time'], match['start_time'])
+
+        page = [fake.details(t['match_id']) for t in page['matches']]
+        for details in page:
+            details['api_skill'] = 1
+        summaries, rejections = match_parse.parse_matches(page)
+        self.assertEqual(len(summaries) + sum(rejections.values()),
+                         len(page))
+        self.assertTrue(len(summaries) > 0)
+
+
+class TestFetchEngines(unittest.TestCase):
+    """Run both fetch engines against the synthetic Steam API"""
+
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        cls.fake = fake_steam.FakeSteam(matches=3000)
+        cls.api_url = cls.fake.start(port=port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def crawl(self, engine, units):
+        """Summaries written by a crawl of `units` with `engine`"""
+
+        written = []
+        limiter = rate_limit.AdaptiveRateLimiter(rate=1000, max_rate=1000,
+                                                 burst=1000)
+        with mock.patch.object(pipeline, 'API_URL', self.api_url), \
+                mock.patch.object(pipeline, 'LIMITER', limiter), \
+                mock.patch.object(pipeline, 'MATCH_IDS',
+                                  match_index.MatchIndex(7*24*3600)), \
+                mock.patch.object(pipeline, 'write_matches',
+                                  lambda _, m, b=None: written.extend(m)), \
+                mock.patch.object(pipeline, 'get_session', mock.MagicMock), \
+                mock.patch.object(pipeline, 'remove_sessions', lambda: None):
+            writer = pipeline.MatchWriter()
+            writer.start()
+            if engine == 'async':
+                asyncio.run(fetch_async.fetch_heroes_async(writer, units, 32))
+            else:
+                pipeline.fetch_heroes(writer, units)
+            writer.close()
+        return sorted(written, key=lambda t: t['match_id'])
+
+    def test_async_engine(self):
+        """The async engine writes the same matches as the threads one"""
+
+        units = [(1, 1), (2, 1)]
+        threads = self.crawl('threads', units)
+        self.assertTrue(len(threads) > 0)
+        self.assertEqual(len({t['match_id'] for t in threads}),
+                         len(threads))
+        self.assertEqual(self.crawl('async', units), threads)
+
+
+if __name__ == '__main__':
+    pipeline.log.setLevel(logging.CRITICAL)
+    unittest.main()
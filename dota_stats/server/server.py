@@ -1,19 +1,20 @@
 # -*- coding: utf-8 -*-
-"""Flask server to display analytics results, uses a common instance of
-SQLAlchemy to deal with concurrency.
+"""Flask server to display analytics results, uses the process wide engine
+(connection pool) of `db_util` to deal with concurrency.
 """
 import json
-import os
 import plotly
 import plotly.graph_objs as go
 from flask import Flask, render_template
-from flask_sqlalchemy import SQLAlchemy
-from dota_stats import win_rate_pick_rate, fetch_summary
+from dota_stats import db_util, win_rate_pick_rate, fetch_summary
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DOTA_DB_URI']
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+
+
+@app.teardown_appcontext
+def remove_session(_):
+    """Discard the request thread's database session"""
+    db_util.remove_sessions()
 
 
 def get_health_chart(days, timezone, hour=True):
@@ -7,7 +7,7 @@ import logging
 import os
 import sys
 import datetime as dt
-import json
+import numpy as np
 import pandas as pd
 from dota_stats import db_util, dotautil, meta
 
@@ -25,69 +25,51 @@ ch.setFormatter(fmt)
 log.addHandler(ch)
 
 
+# Position of each hero ID in `meta.HEROES`, IDs which are not heroes map
+# past the end and are dropped
+HERO_INDEX = np.full(2**16, meta.NUM_HEROES, dtype=np.intp)
+HERO_INDEX[meta.HEROES] = np.arange(meta.NUM_HEROES)
+
+
 def parse_records(matches):
-    """Alternative version"""
-
-    rad_heroes = []
-    radiant_win = []
-    radiant_count = []
-    dire_heroes = []
-    dire_win = []
-    dire_count = []
-
-    for match in matches:
-        rhs = json.loads(match.radiant_heroes)
-        dhs = json.loads(match.dire_heroes)
-
-        for hero in rhs:
-            rad_heroes.append(hero)
-            radiant_count.append(1)
-            if match.radiant_win == 1:
-                radiant_win.append(1)
-            else:
-                radiant_win.append(0)
-
-        for hero in dhs:
-            dire_heroes.append(hero)
-            dire_count.append(1)
-            if match.radiant_win == 1:
-                dire_win.append(0)
-            else:
-                dire_win.append(1)
-
-    df_radiant = pd.DataFrame({'hero': rad_heroes,
-                               'radiant_win': radiant_win,
-                               'radiant_total': radiant_count})
-    df_radiant = df_radiant.groupby("hero").sum()
-    df_radiant.reset_index(inplace=True)
-
-    df_dire = pd.DataFrame({'hero': dire_heroes,
-                            'dire_win': dire_win,
-                            'dire_total': dire_count})
-    df_dire = df_dire.groupby("hero").sum()
-    df_dire.reset_index(inplace=True)
-
-    df_total = pd.DataFrame({'hero':  meta.HEROES})
-
-    df_total = df_total.merge(df_radiant, how='left', on='hero').\
-        merge(df_dire, how='left', on='hero')
-    df_total = df_total.fillna(0)
-
-    return df_total
+    """Radiant and dire wins and totals by hero for rows with `radiant_win`
+    and packed `heroes` columns."""
+
+    matches = list(matches)
+    radiant_win = np.array([t.radiant_win for t in matches]) == 1
+    heroes = db_util.decode_heroes([t.heroes for t in matches])
+    return count_heroes(heroes, radiant_win)
+
+
+def count_heroes(heroes, radiant_win):
+    """Wins and totals of every hero in `meta.HEROES` from an (n, 10) array
+    of lineups, radiant then dire, and the n match results."""
+
+    radiant = HERO_INDEX[heroes[:, :5]]
+    dire = HERO_INDEX[heroes[:, 5:]]
+
+    def count(index):
+        return np.bincount(index.reshape(-1),
+                           minlength=meta.NUM_HEROES + 1)[:meta.NUM_HEROES]
+
+    return pd.DataFrame({'hero': meta.HEROES,
+                         'radiant_win': count(radiant[radiant_win]),
+                         'radiant_total': count(radiant),
+                         'dire_win': count(dire[~radiant_win]),
+                         'dire_total': count(dire)})
 
 
 def write_to_database(summary, skill, end_time):
     """Update win rate data in database"""
 
     rows = []
-    engine, _ = db_util.connect_database()
+    engine = db_util.get_engine()
 
     # Coerce to integers
     summary = summary.astype('int')
 
     for _, row in summary.iterrows():
-        time_hero_skill = "{0}_H{1:03}_S{2}".format(
-            end_time, row['hero'], skill)
+        time_hero_skill = db_util.win_rate_key(end_time, row['hero'], skill)
 
         rows.append((
                 time_hero_skill,
@@ -105,13 +87,14 @@ def write_to_database(summary, skill, end_time):
            "%s, %s)"
     cursor.executemany(stmt, rows)
     conn.commit()
+    conn.close()    # Back to the pool
 
 
 def get_current_win_rate_table(days):
     """Sets a summary table for current win rates, spanning `days` worth of
     time"""
 
-    engine, _ = db_util.connect_database()
+    engine = db_util.get_engine()
     end = int(db_util.get_max_start_time())
     begin = int(end - days * 24 * 3600)
 
@@ -155,8 +138,9 @@ def get_current_win_rate_table(days):
     return grpd
 
 
-def main(days, skill):
-    """Main entry point"""
+def main(days, skill, full=False):
+    """Main entry point. Aggregates the hour buckets of the last `days` which
+    received matches since the previous run, or all of them if `full`."""
 
     text, begin, end = dotautil.TimeMethods.get_hour_blocks(
         db_util.get_max_start_time(),
@@ -164,11 +148,18 @@ def main(days, skill):
     )
 
     # Get database connection
-    engine, _ = db_util.connect_database()
+    engine = db_util.get_engine()
 
     with engine.connect() as conn:
-        for ttime, btime, etime in zip(text, begin, end):
-            stmt = "select radiant_win, radiant_heroes, dire_heroes from " \
+        dirty = db_util.get_dirty_hours(conn, skill, end[0])
+        blocks = list(zip(text, begin, end))
+        if not full:
+            blocks = [t for t in blocks if t[2] in dirty]
+        log.info("Skill level: %d Hours: %d of %d", skill, len(blocks),
+                 len(text))
+
+        for ttime, btime, etime in blocks:
+            stmt = "select radiant_win, heroes from " \
                    "dota_matches where start_time>={0} and start_time<={1}"\
                    " and api_skill={2};".format(btime, etime, skill)
             matches = conn.execute(stmt)
@@ -179,6 +170,14 @@ def main(days, skill):
             df_hero = parse_records(matches)
             write_to_database(df_hero, skill, etime)
 
+            # Only once the bucket is written, a failure leaves it flagged
+            if etime in dirty:
+                db_util.clear_dirty_hours(conn, skill,
+                                          {etime: dirty.pop(etime)})
+
+        # Whatever is left is older than the window and never aggregated
+        db_util.clear_dirty_hours(conn, skill, dirty)
+
 
 if __name__ == "__main__":
 
@@ -187,10 +186,13 @@ if __name__ == "__main__":
         description='Calculate win rate vs. pick rate at all skill levels.')
     parser.add_argument('days', type=int)
     parser.add_argument('skill', type=int)
+    parser.add_argument('--full', action='store_true',
+                        help='Rebuild every hour in the window, not just '
+                             'those which received matches.')
     args = parser.parse_args()
 
     if args.skill not in [1, 2, 3]:
         parser.print_help()
         sys.exit(-1)
 
-    main(args.days, args.skill)
+    main(args.days, args.skill, args.full)
@@ -9,7 +9,7 @@ from itertools import permutations
 import mariadb
 import pandas as pd
 import numpy as np
-from dota_stats import meta
+from dota_stats import meta, db_util
 
 MATCH_CUTOFF = 30  # Number of matches needed to calculate winrate
 
@@ -96,30 +96,31 @@ class HeroMaxLikelihood:
         """Given database rows, return two matrices, one for hero count
         by position, one for hero win by position.
 
-            row[1] - radiant heroes
-            row[2] - dire heroes
-            row[3] - radiant win
+            row[1] - packed heroes, see `db_util.pack_heroes`
+            row[2] - radiant win
 
         """
 
         total_count_mat = np.zeros((meta.NUM_HEROES, 5))
         total_win_mat = np.zeros((meta.NUM_HEROES, 5))
 
-        for row in rows:
-            radiant_heroes = json.loads(row[1])
-            dire_heroes = json.loads(row[2])
+        rows = list(rows)
+        heroes = db_util.decode_heroes([t[1] for t in rows]).tolist()
+        for row, lineup in zip(rows, heroes):
+            radiant_heroes = lineup[:5]
+            dire_heroes = lineup[5:]
 
             total_win_mat, total_count_mat = \
                 self.row_to_matrix(radiant_heroes,
                                    total_win_mat,
                                    total_count_mat,
-                                   bool(row[3]))
+                                   bool(row[2]))
 
             total_win_mat, total_count_mat = \
                 self.row_to_matrix(dire_heroes,
                                    total_win_mat,
                                    total_count_mat,
-                                   not bool(row[3]))
+                                   not bool(row[2]))
 
         return total_win_mat, total_count_mat
 
@@ -134,7 +135,7 @@ def main():
         database=os.environ['DOTA_DATABASE'])
     cursor = conn.cursor()
 
-    stmt = "SELECT match_id, radiant_heroes, dire_heroes, radiant_win FROM " \
+    stmt = "SELECT match_id, heroes, radiant_win FROM " \
            "dota_matches LIMIT 5000"
     cursor.execute(stmt)
 